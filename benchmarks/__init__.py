@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Benchmarks for libfb2 that run on synthetic game data.  See
+    :mod:`benchmarks.run` for how to run them.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
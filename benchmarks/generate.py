@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.generate
+    ~~~~~~~~~~~~~~~~~~~
+
+    Generates synthetic SB/TOC/CAS/CAT and fbdef files that look like the
+    real thing closely enough for benchmarking.  Everything is derived from
+    a seed so runs are reproducible.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import struct
+import random
+from hashlib import sha1
+from uuid import UUID
+
+from libfb2.sb import CAS_CAT_HEADER, CAS_HEADER
+from libfb2.fbdef import FB_DEF_HEADER
+from libfb2.types import Blob, SHA1, Unknown
+from libfb2.utils import DICE_HEADER, HASH_OFFSET, HASH_SIZE, \
+     MAGIC_OFFSET, MAGIC_SIZE, DATA_OFFSET, XORDecrypter
+
+
+def encode_varint(value):
+    rv = []
+    while 1:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            rv.append(chr(byte | 0x80))
+        else:
+            rv.append(chr(byte))
+            return ''.join(rv)
+
+
+def _encode(value):
+    if value is None:
+        return 0, ''
+    if isinstance(value, bool):
+        return 6, chr(value)
+    if isinstance(value, Unknown):
+        return value.code, value.bytes
+    if isinstance(value, (int, long)):
+        if -2 ** 31 <= value < 2 ** 31:
+            return 8, struct.pack('<i', value)
+        return 9, struct.pack('<q', value)
+    if isinstance(value, Blob):
+        return 19, encode_varint(len(value.bytes)) + value.bytes
+    if isinstance(value, SHA1):
+        return 16, value.bytes
+    if isinstance(value, UUID):
+        return 15, value.bytes
+    if isinstance(value, str):
+        return 7, encode_varint(len(value) + 1) + value + '\x00'
+    if isinstance(value, list):
+        body = ''.join(chr(code) + data for code, data
+                       in map(_encode, value)) + '\x00'
+        return 1, encode_varint(len(body)) + body
+    if isinstance(value, dict):
+        items = []
+        for key, item in sorted(value.items()):
+            code, data = _encode(item)
+            items.append(chr(code) + key + '\x00' + data)
+        body = ''.join(items) + '\x00'
+        return 2, encode_varint(len(body)) + body
+    raise TypeError('Cannot encode %r' % type(value).__name__)
+
+
+def dumps(value):
+    """Encodes a value in the SB format.  `None` can only be encoded as
+    the root value as it terminates lists and dicts.
+    """
+    code, data = _encode(value)
+    return chr(code) + data
+
+
+def encrypt(data, seed=0):
+    """Wraps data in a DICE header and XOR encrypts it."""
+    rnd = random.Random(seed)
+    magic = ''.join(chr(rnd.randrange(256)) for _ in xrange(MAGIC_SIZE))
+    hash = ''.join(rnd.choice('0123456789abcdef') for _ in xrange(HASH_SIZE))
+    header = DICE_HEADER.ljust(HASH_OFFSET, '\x00') + 'x' + hash + 'x'
+    header = header.ljust(MAGIC_OFFSET, '\x00') + magic
+    header = header.ljust(DATA_OFFSET, '\x00')
+    # XOR is its own inverse
+    return header + XORDecrypter(magic).decrypt(data)
+
+
+class Generator(object):
+    """Creates random but plausible values."""
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def bytes(self, length):
+        if not length:
+            return ''
+        value = self.random.getrandbits(length * 8)
+        return ('%0*x' % (length * 2, value)).decode('hex')
+
+    def sha1(self):
+        return SHA1(self.bytes(20))
+
+    def uuid(self):
+        return UUID(int=self.random.getrandbits(128))
+
+    def name(self, prefix, idx):
+        folders = ('characters', 'weapons', 'vehicles', 'levels', 'ui',
+                   'persistence', 'sound', 'fx')
+        return '%s/%s/asset_%06d' % (prefix, self.random.choice(folders), idx)
+
+    def bundle(self, ebx_count, res_count=None, chunk_count=None,
+               blob_size=0):
+        """A bundle metadata document in the shape of the ones that live
+        in .sb files.  Every typecode the parser handles is used.
+        """
+        if res_count is None:
+            res_count = ebx_count // 2
+        if chunk_count is None:
+            chunk_count = ebx_count // 4
+        rnd = self.random
+        rv = {
+            'path': 'win32/levels/mp_%03d' % rnd.randrange(100),
+            'magicSalt': rnd.getrandbits(31),
+            'alignMembers': True,
+            'ridSupport': False,
+            'storeCompressedSizes': False,
+            'totalSize': rnd.getrandbits(40) + 2 ** 32,
+            'dbxTotalSize': rnd.getrandbits(40) + 2 ** 32,
+            'ebx': [{
+                'name': self.name('ebx', idx),
+                'sha1': self.sha1(),
+                'size': rnd.randrange(1, 1 << 20),
+                'originalSize': rnd.randrange(1, 1 << 20),
+            } for idx in xrange(ebx_count)],
+            'res': [{
+                'name': self.name('res', idx),
+                'sha1': self.sha1(),
+                'size': rnd.randrange(1, 1 << 24),
+                'originalSize': rnd.randrange(1, 1 << 24),
+                'resType': rnd.getrandbits(31),
+                'resMeta': Blob(self.bytes(16)),
+                'resRid': Unknown(5, self.bytes(8)),
+            } for idx in xrange(res_count)],
+            'chunks': [{
+                'id': self.uuid(),
+                'sha1': self.sha1(),
+                'size': rnd.randrange(1, 1 << 24),
+                'rangeStart': 0,
+                'rangeEnd': rnd.randrange(1, 1 << 24),
+            } for idx in xrange(chunk_count)],
+            'chunkMeta': [{'h32': rnd.getrandbits(31), 'meta': Blob('')}
+                          for idx in xrange(chunk_count)],
+        }
+        if blob_size:
+            rv['payload'] = Blob(self.bytes(blob_size))
+        return rv
+
+
+def write_superbundle(basename, bundle_count=20, ebx_count=500,
+                      encrypted=False, seed=0):
+    """Writes a .toc/.sb pair.  The .sb file contains `bundle_count`
+    bundles and the .toc points to them.  Returns the number of bytes of
+    bundle data written.
+    """
+    gen = Generator(seed)
+    directory = os.path.dirname(basename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    bundles = []
+    offset = 0
+    with open(basename + '.sb', 'wb') as f:
+        for idx in xrange(bundle_count):
+            data = dumps(gen.bundle(ebx_count))
+            f.write(data)
+            bundles.append({
+                'id': '%s/bundle_%04d' % (os.path.basename(basename), idx),
+                'offset': offset,
+                'size': len(data),
+            })
+            offset += len(data)
+    toc = dumps({
+        'bundles': bundles,
+        'chunks': [{'id': gen.uuid(), 'sha1': gen.sha1()}
+                   for idx in xrange(bundle_count * 10)],
+        'cas': True,
+        'name': os.path.basename(basename),
+        'alwaysEmitSuperbundle': True,
+    })
+    if encrypted:
+        toc = encrypt(toc, seed)
+    with open(basename + '.toc', 'wb') as f:
+        f.write(toc)
+    return offset
+
+
+def write_catalog(directory, file_count=10000, cas_count=4, max_size=16384,
+                  encrypted=True, seed=0):
+    """Writes ``cas.cat`` with matching ``cas_NN.cas`` files into a
+    directory.  Returns a list of ``(sha1, size)`` tuples of all entries.
+    """
+    gen = Generator(seed)
+    rnd = gen.random
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = [open(os.path.join(directory, 'cas_%02d.cas' % (num + 1)), 'wb')
+             for num in xrange(cas_count)]
+    entries = []
+    try:
+        for idx in xrange(file_count):
+            size = rnd.randrange(max_size)
+            data = gen.bytes(size)
+            digest = sha1(data).digest()
+            cas_num = rnd.randrange(cas_count)
+            f = files[cas_num]
+            f.write(CAS_HEADER + digest + struct.pack('<i', size) + '\x00' * 4)
+            entries.append((digest, f.tell(), size, cas_num + 1))
+            f.write(data)
+    finally:
+        for f in files:
+            f.close()
+    rnd.shuffle(entries)
+    data = CAS_CAT_HEADER + ''.join(digest + struct.pack('<iii', *rest)
+                                    for digest, rest in
+                                    ((x[0], x[1:]) for x in entries))
+    if encrypted:
+        data = encrypt(data, seed)
+    with open(os.path.join(directory, 'cas.cat'), 'wb') as f:
+        f.write(data)
+    return [(SHA1(x[0]), x[2]) for x in entries]
+
+
+def make_fbdef(gen, idx, payload_size=4096):
+    """Creates the bytes of an fbdef (ebx) file."""
+    name = gen.name('ebx', idx) + '\x00'
+    headers = ''.join('%s\x00' % x for x in
+                      ('Asset', 'DataContainer', 'Name', 'Guid', 'Value'))
+    extra_uuids = gen.random.randrange(4)
+    uuids = ''.join(gen.uuid().bytes for _ in xrange((extra_uuids + 1) * 2))
+    chunk0 = gen.bytes(gen.random.randrange(64, 256))
+    chunk1 = gen.bytes(gen.random.randrange(64, 256))
+    unknown3 = gen.bytes(payload_size)
+    unknown4 = gen.bytes(16)
+    fields_size = len(FB_DEF_HEADER) + 11 * 4
+    fn_offset = fields_size + len(uuids) + len(headers) + len(chunk0) + \
+        len(chunk1) + len(unknown3)
+    fields = struct.pack('<11i', fn_offset, len(name) + len(unknown4),
+                         extra_uuids, 0, 0, len(chunk0), len(chunk1),
+                         len(headers), len(name), 0, payload_size)
+    return ''.join((FB_DEF_HEADER, fields, uuids, headers, chunk0, chunk1,
+                    unknown3, name, unknown4))
+
+
+def write_fbdefs(directory, count=100, seed=0):
+    """Writes `count` fbdef files into a directory and returns their
+    filenames.
+    """
+    gen = Generator(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rv = []
+    for idx in xrange(count):
+        filename = os.path.join(directory, 'asset_%06d.ebx' % idx)
+        with open(filename, 'wb') as f:
+            f.write(make_fbdef(gen, idx))
+        rv.append(filename)
+    return rv
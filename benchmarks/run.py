@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.run
+    ~~~~~~~~~~~~~~
+
+    Runs the benchmarks against synthetic inputs and writes the results as
+    JSON so they can be compared across commits::
+
+        $ python -m benchmarks.run -o results.json
+        $ python -m benchmarks.run --scale 0.1 load_plain iterload_selector
+
+    Every benchmark runs in its own process so that the peak memory usage
+    can be reported per benchmark.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from multiprocessing import Process, Queue
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks import generate
+
+
+benchmarks = []
+_benchmark_funcs = {}
+
+
+def benchmark(func):
+    """Registers a benchmark.  The function is invoked with the inputs
+    and has to return a tuple in the form ``(bytes, objects)`` with the
+    amount of data and the number of objects it processed.
+    """
+    benchmarks.append(func.__name__)
+    _benchmark_funcs[func.__name__] = func
+    return func
+
+
+def count_objects(value):
+    """Counts the values in a decoded SB tree."""
+    if hasattr(value, 'itervalues'):
+        return 1 + sum(count_objects(x) for x in value.itervalues())
+    if isinstance(value, list):
+        return 1 + sum(count_objects(x) for x in value)
+    return 1
+
+
+def get_peak_rss():
+    """Returns the peak resident set size in KB if it's available."""
+    if resource is None:
+        return None
+    rv = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rv //= 1024
+    return rv
+
+
+class Inputs(object):
+    """The generated input files of a benchmark run."""
+
+    def __init__(self, directory, scale=1.0):
+        self.directory = directory
+        self.scale = scale
+        self.plain_sb = os.path.join(directory, 'plain.sb')
+        self.encrypted_sb = os.path.join(directory, 'encrypted.sb')
+        self.superbundle = os.path.join(directory, 'Data', 'Win32', 'Levels',
+                                        'MP_001', 'MP_001')
+        self.catalog = os.path.join(directory, 'Data', 'cas.cat')
+        self.fbdef_dir = os.path.join(directory, 'ebx')
+
+    def scaled(self, value):
+        return max(1, int(value * self.scale))
+
+    def generate(self):
+        gen = generate.Generator(0)
+        data = generate.dumps(gen.bundle(self.scaled(20000)))
+        with open(self.plain_sb, 'wb') as f:
+            f.write(data)
+        with open(self.encrypted_sb, 'wb') as f:
+            f.write(generate.encrypt(data))
+        generate.write_superbundle(self.superbundle,
+                                   bundle_count=self.scaled(200),
+                                   ebx_count=50, encrypted=True)
+        generate.write_catalog(os.path.dirname(self.catalog),
+                               file_count=self.scaled(20000))
+        generate.write_fbdefs(self.fbdef_dir, count=self.scaled(500))
+
+    @property
+    def fbdefs(self):
+        return [os.path.join(self.fbdef_dir, x)
+                for x in sorted(os.listdir(self.fbdef_dir))]
+
+
+@benchmark
+def load_plain(inputs):
+    from libfb2.sb import load
+    rv = load(inputs.plain_sb)
+    return os.path.getsize(inputs.plain_sb), count_objects(rv)
+
+
+@benchmark
+def load_encrypted(inputs):
+    from libfb2.sb import load
+    rv = load(inputs.encrypted_sb)
+    return os.path.getsize(inputs.encrypted_sb), count_objects(rv)
+
+
+@benchmark
+def load_compact(inputs):
+    from libfb2.sb import load
+    rv = load(inputs.plain_sb, compact=True)
+    return os.path.getsize(inputs.plain_sb), count_objects(rv)
+
+
+@benchmark
+def loads_string(inputs):
+    from libfb2.sb import loads
+    with open(inputs.plain_sb, 'rb') as f:
+        data = f.read()
+    return len(data), count_objects(loads(data))
+
+
+@benchmark
+def iterload_selector(inputs):
+    from libfb2.sb import iterload
+    rv = list(iterload(inputs.plain_sb, 'ebx.*'))
+    return os.path.getsize(inputs.plain_sb), len(rv)
+
+
+@benchmark
+def iterload_sparse(inputs):
+    from libfb2.sb import iterload
+    rv = list(iterload(inputs.plain_sb, 'ebx.*[name^=ebx/persistence/]'))
+    return os.path.getsize(inputs.plain_sb), len(rv)
+
+
+@benchmark
+def open_superbundle(inputs):
+    from libfb2.sb import Bundle
+    with Bundle(inputs.superbundle) as bundle:
+        files = bundle.list_files()
+        rv = files[len(files) // 2].get_parsed_contents()
+    return os.path.getsize(inputs.superbundle + '.toc'), len(files)
+
+
+@benchmark
+def parse_superbundle(inputs):
+    from libfb2.sb import Bundle
+    objects = 0
+    with Bundle(inputs.superbundle) as bundle:
+        for bundle_file in bundle.iter_files():
+            objects += count_objects(bundle_file.get_parsed_contents())
+    return os.path.getsize(inputs.superbundle + '.sb'), objects
+
+
+@benchmark
+def export_superbundle(inputs):
+    from libfb2.export import export_superbundles
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        rv = export_superbundles(filename, [('MP_001', inputs.superbundle)],
+                                 workers=1, use_processes=False)
+    finally:
+        os.remove(filename)
+    return os.path.getsize(inputs.superbundle + '.sb'), rv['rows']
+
+
+@benchmark
+def catalog_open(inputs):
+    from libfb2.sb import CASCatalog
+    cat = CASCatalog(inputs.catalog)
+    return os.path.getsize(inputs.catalog), len(cat.files)
+
+
+@benchmark
+def catalog_open_cached(inputs):
+    from libfb2.sb import CASCatalog
+    from libfb2.cache import payload_cache, DEFAULT_PAYLOAD_CACHE_SIZE
+    payload_cache.directory = os.path.join(inputs.directory, 'payloads')
+    payload_cache.max_bytes = DEFAULT_PAYLOAD_CACHE_SIZE
+    CASCatalog(inputs.catalog)
+    start = time.time()
+    cat = CASCatalog(inputs.catalog)
+    elapsed = time.time() - start
+    return os.path.getsize(inputs.catalog), len(cat.files), elapsed
+
+
+@benchmark
+def catalog_get_file(inputs):
+    from libfb2.sb import CASCatalog
+    cat = CASCatalog(inputs.catalog)
+    keys = list(cat.files)
+    start = time.time()
+    for key in keys:
+        cat.get_file(key)
+    # only count the lookups themselves
+    return 0, len(keys), time.time() - start
+
+
+@benchmark
+def extract_all(inputs):
+    from libfb2.sb import CASCatalog
+    cat = CASCatalog(inputs.catalog)
+    dst = tempfile.mkdtemp(prefix='libfb2-extract-')
+    try:
+        rv = cat.extract_all(dst, workers=4)
+    finally:
+        shutil.rmtree(dst)
+    return rv['bytes'], rv['files']
+
+
+@benchmark
+def decrypt(inputs):
+    from libfb2.sb import decrypt
+    fd, dst = tempfile.mkstemp(prefix='libfb2-decrypt-')
+    os.close(fd)
+    try:
+        decrypt(inputs.catalog, dst)
+    finally:
+        os.remove(dst)
+    return os.path.getsize(inputs.catalog), 0
+
+
+@benchmark
+def fbdef_load(inputs):
+    from libfb2.fbdef import load
+    total = 0
+    filenames = inputs.fbdefs
+    for filename in filenames:
+        load(filename)
+        total += os.path.getsize(filename)
+    return total, len(filenames)
+
+
+@benchmark
+def fbdef_scan(inputs):
+    from libfb2.fbdef import load
+    total = 0
+    filenames = inputs.fbdefs
+    for filename in filenames:
+        load(filename, lazy=True)['name']
+        total += os.path.getsize(filename)
+    return total, len(filenames)
+
+
+def _run_benchmark(name, inputs, repeat, queue):
+    try:
+        # benchmarks measure the decryption unless they enable the cache
+        from libfb2.cache import set_payload_cache_size
+        set_payload_cache_size(0)
+        func = _benchmark_funcs[name]
+        base_rss = get_peak_rss()
+        best = None
+        for _ in xrange(repeat):
+            start = time.time()
+            rv = func(inputs)
+            elapsed = time.time() - start
+            if len(rv) == 3:
+                nbytes, objects, elapsed = rv
+            else:
+                nbytes, objects = rv
+            if best is None or elapsed < best:
+                best = elapsed
+        queue.put({
+            'name': name,
+            'seconds': best,
+            'bytes': nbytes,
+            'objects': objects,
+            'mb_per_s': best and nbytes / best / (1024 * 1024) or None,
+            'objects_per_s': best and objects / best or None,
+            'base_rss_kb': base_rss,
+            'peak_rss_kb': get_peak_rss(),
+        })
+    except Exception as e:
+        queue.put({'name': name, 'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def run_benchmark(name, inputs, repeat=3):
+    """Runs a single benchmark in a subprocess and returns the result."""
+    queue = Queue()
+    proc = Process(target=_run_benchmark, args=(name, inputs, repeat, queue))
+    proc.start()
+    rv = queue.get()
+    proc.join()
+    return rv
+
+
+def get_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0] \
+            .strip() or None
+    except OSError:
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks libfb2.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='the benchmarks to run (%s)' %
+                        ', '.join(benchmarks))
+    parser.add_argument('-o', '--output', help='write JSON results here')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale factor for the input sizes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best one is kept')
+    parser.add_argument('--workdir', help='keep the generated inputs here')
+    options = parser.parse_args(args)
+
+    names = options.names or benchmarks
+    for name in names:
+        if name not in _benchmark_funcs:
+            parser.error('unknown benchmark %r' % name)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='libfb2-bench-')
+    inputs = Inputs(workdir, options.scale)
+    try:
+        if not os.path.isfile(inputs.catalog):
+            sys.stderr.write('Generating inputs in %s...\n' % workdir)
+            proc = Process(target=inputs.generate)
+            proc.start()
+            proc.join()
+            if proc.exitcode:
+                raise RuntimeError('Could not generate inputs')
+        results = []
+        for name in names:
+            result = run_benchmark(name, inputs, options.repeat)
+            results.append(result)
+            if 'error' in result:
+                sys.stderr.write('%-20s %s\n' % (name, result['error']))
+            else:
+                sys.stderr.write('%-20s %8.3fs %10.1f MB/s %12.0f obj/s\n' % (
+                    name, result['seconds'], result['mb_per_s'] or 0,
+                    result['objects_per_s'] or 0))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    output = json.dumps({
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': options.scale,
+        'repeat': options.repeat,
+        'results': results,
+    }, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
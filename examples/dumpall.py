@@ -2,27 +2,19 @@
 A simple example script that dumps all the contents of the
 bundles onto the filesystem.
 """
-import os
-import shutil
 from libfb2.sb import CASCatalog
 
 
+def print_progress(done, total, bytes_written):
+    print 'Extracted %d/%d files (%d MB)' % \
+        (done, total, bytes_written // (1024 * 1024))
+
+
 def dump_all(source, dst):
     print 'Reading catalog...'
     cat = CASCatalog(source)
-    idx = 0
-    total = len(cat.files)
-    print 'Found %d files' % total
-
-    for idx, (hash, file) in enumerate(cat.files.iteritems()):
-        fn = os.path.join(dst, hash[0], hash[:2], hash)
-        directory = os.path.dirname(fn)
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
-        with open(fn, 'wb') as out:
-            print 'Extracting %s % 8d Bytes cas=%02d (%d/%d)' % \
-                (hash, file.size, file.cas_num, idx, total)
-            shutil.copyfileobj(file.open(), out)
+    print 'Found %d files' % len(cat.files)
+    cat.extract_all(dst, progress=print_progress, resume=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,21 @@
+"""
+Dumps all files that are new in one version of the game compared to an
+older one.
+"""
+from libfb2.sb import CASCatalog
+from libfb2.diff import diff_catalogs
+
+
+def dump_patch(old_source, new_source, dst):
+    old = CASCatalog(old_source)
+    new = CASCatalog(new_source)
+    added = [change.new_index for change in diff_catalogs(old, new)
+             if change.status == 'added']
+    print 'Found %d new files' % len(added)
+    new.extract_all(dst, indexes=added, resume=True)
+
+
+if __name__ == '__main__':
+    dump_patch(old_source=r'C:\Temp\BF3-R3\Data\cas.cat',
+               new_source=r'C:\Program Files (x86)\Origin Games\Battlefield 3\Data\cas.cat',
+               dst=r'C:\Temp\BF3-Patch')
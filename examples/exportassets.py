@@ -0,0 +1,42 @@
+"""
+Exports the assets of all superbundles into a column file and prints the
+total size of the res files per superbundle.  Uses NumPy if it's
+installed.
+"""
+import sys
+from libfb2.sb import CASCatalog
+from libfb2.export import ExportFile, KIND_CODES, export_catalog, numpy
+
+
+def print_progress(name, bundles, rows, seconds):
+    print 'Exported %s: %d bundles, %d assets in %.2fs' % \
+        (name, bundles, rows, seconds)
+
+
+def get_res_sizes(export):
+    code = KIND_CODES['res']
+    if numpy is not None:
+        columns = export.to_numpy()
+        res = columns['kind'] == code
+        return numpy.bincount(columns['superbundle'][res],
+                              columns['size'][res]).astype('int64')
+    rv = {}
+    for kind, superbundle, size in zip(export.get_column('kind'),
+                                       export.get_column('superbundle'),
+                                       export.get_column('size')):
+        if kind == code:
+            rv[superbundle] = rv.get(superbundle, 0) + size
+    return [rv.get(x, 0) for x in xrange(max(rv) + 1 if rv else 0)]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = r'C:\Program Files (x86)\Origin Games\Battlefield 3\Data\cas.cat'
+    output = len(sys.argv) > 2 and sys.argv[2] or 'assets.fb2c'
+    export_catalog(output, CASCatalog(filename), progress=print_progress)
+    with ExportFile(output) as export:
+        names = export.get_superbundle_names()
+        for name, size in zip(names, get_res_sizes(export)):
+            print '%-60s %10d MB' % (name, size // (1024 * 1024))
@@ -1,6 +1,7 @@
 """
 A simple example script that iterates over the dogtag definitions
-that can be found in the default_settings bundle.
+that can be found in the default_settings bundle.  The names are looked
+up in the asset index which is built on the first run.
 """
 from libfb2.sb import CASCatalog
 
@@ -10,14 +11,16 @@ cat = CASCatalog(CAS_PATH)
 
 
 def iter_dogtags():
-    """Iterates over all dogtags and their definition file."""
-    setting_bundle = cat.open_superbundle('Win32/default_settings_win32')
-    settings = setting_bundle.get_file('Win32/default_settings_win32')
-    ebx = settings.get_parsed_contents()['ebx']
-    for entry in ebx:
-        if entry['name'].startswith('persistence/dogtags/'):
-            dogtag_file = cat.get_file(entry['sha1'].hex)
-            yield entry['name'], dogtag_file.get_raw_contents()
+    """Iterates over all dogtags and their definition file.  The files
+    are read in one batch in the order they are stored in.
+    """
+    names = {}
+    for asset in cat.find_assets('persistence/dogtags/', kind='ebx',
+                                 superbundle='Win32/default_settings_win32'):
+        names.setdefault(asset.sha1, []).append(asset.name)
+    for sha1, contents in cat.fetch_many(names):
+        for name in names[sha1]:
+            yield name, contents
 
 
 if __name__ == '__main__':
@@ -10,7 +10,7 @@ MAP = 'MP_001'
 cat = CASCatalog(CAS_PATH)
 
 
-def show_map_data(show_related=False):
+def show_map_data(show_related=False, show_chunks=False):
     """Iterates over all dogtags and their definition file."""
     map_bundle = cat.open_superbundle('Win32/Levels/%s/%s' % (MAP, MAP))
     for file in map_bundle.iter_files():
@@ -18,6 +18,10 @@ def show_map_data(show_related=False):
         if show_related:
             for obj in file.iter_parse_contents('ebx.*'):
                 print ' ', obj['sha1'].hex, obj['name']
+        if show_chunks:
+            # the chunks are read in batches in the order of the CAS files
+            for id, data in file.iter_chunk_contents():
+                print ' ', id, data is not None and len(data) or 'missing'
     return ()
 
 
@@ -0,0 +1,24 @@
+"""
+Rebuilds the cas.cat file from the CAS files next to it.  This can be
+used to recover a damaged or missing catalog.  The rebuilt catalog is
+written next to it as cas.cat.rebuilt unless another output filename is
+given; an existing output file is not replaced.
+"""
+import sys
+from libfb2.sb import rebuild_catalog
+
+
+def print_progress(filename, entries, scanned, seconds):
+    print 'Scanned %s: %d entries, %d MB in %.2fs' % \
+        (filename, entries, scanned // (1024 * 1024), seconds)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print >> sys.stderr, 'usage: %s cas.cat [output]' % sys.argv[0]
+        sys.exit(1)
+    output = len(sys.argv) > 2 and sys.argv[2] or None
+    rv = rebuild_catalog(sys.argv[1], progress=print_progress,
+                         output=output)
+    print 'Wrote %d entries from %d CAS files to %s (%.1f MB/s)' % \
+        (rv['entries'], rv['cas_files'], rv['filename'], rv['mb_per_s'] or 0)
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.cache
+    ~~~~~~~~~~~~
+
+    Persistent caches that speed up opening catalogs and superbundles, a
+    cache for the decrypted payloads of encrypted files and an in-memory
+    LRU cache for contents.
+
+    The persistent caches live in ``~/.cache/libfb2`` (the ``libfb2``
+    folder of ``$XDG_CACHE_HOME`` or ``%LOCALAPPDATA%`` on Windows) unless
+    the `LIBFB2_CACHE_DIR` environment variable points somewhere else.
+    The payload cache is disabled by default because it writes the
+    decrypted plaintext of encrypted files larger than 64KB into the
+    ``payloads`` folder there.  Use :func:`set_payload_cache_size` with
+    a budget (for instance :data:`DEFAULT_PAYLOAD_CACHE_SIZE`) to enable
+    it.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import errno
+import tempfile
+import threading
+from array import array
+from hashlib import sha1
+from collections import OrderedDict
+
+from .columns import ColumnFile, ColumnFileException, write_columns, \
+     pack_ints, unpack_ints, pack_strings, rename_over
+from .utils import DICE_HEADER, HASH_OFFSET, HASH_SIZE, DATA_OFFSET, \
+     DecryptingMMapTypeReader, open_mmap
+from .types import BytesPrimitiveWrapper, Record
+
+
+INDEX_CACHE_VERSION = 1
+
+#: the default memory budget of the shared content cache
+DEFAULT_CONTENT_CACHE_SIZE = 256 * 1024 * 1024
+
+# lists longer than this are sampled when estimating their size
+ESTIMATE_SAMPLE_SIZE = 64
+
+#: the suggested disk budget of the decrypted payload cache
+DEFAULT_PAYLOAD_CACHE_SIZE = 512 * 1024 * 1024
+
+# payloads smaller than this decrypt faster than the cache file is opened
+PAYLOAD_CACHE_MIN_SIZE = 64 * 1024
+
+
+def get_cache_dir():
+    """Returns the directory for libfb2's caches.  Can be overridden with
+    the `LIBFB2_CACHE_DIR` environment variable.
+    """
+    rv = os.environ.get('LIBFB2_CACHE_DIR')
+    if rv:
+        return rv
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'libfb2', 'cache')
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'libfb2')
+
+
+def ensure_dir(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def read_header_hash(filename):
+    """Reads the hash from the DICE header of a file.  Returns an empty
+    string for unencrypted files.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(DICE_HEADER)) != DICE_HEADER:
+            return ''
+        f.seek(HASH_OFFSET + 1)
+        return f.read(HASH_SIZE)
+
+
+def get_file_key(filename):
+    """Returns a string that changes whenever the file is replaced: the
+    size, the mtime and the hash from the DICE header.
+    """
+    st = os.stat(filename)
+    return '%d:%r:%s' % (st.st_size, st.st_mtime, read_header_hash(filename))
+
+
+def _int32_column(values):
+    values = array('i', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tostring()
+
+
+class IndexCache(object):
+    """Caches the decoded entries of catalogs and the bundle tables of TOC
+    files on disk.  Entries are stored as column files named after the
+    absolute path of the source file and validated against the size, the
+    mtime and the DICE header hash so stale entries are detected and
+    replaced automatically.
+
+    The cache is opt-in, pass it as `index_cache` to :class:`CASCatalog`
+    or :class:`Bundle`.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(get_cache_dir(), 'index')
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_cache_filename(self, filename, kind):
+        path_hash = sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, '%s.%s' % (path_hash, kind))
+
+    def _get_meta(self, filename, kind):
+        return '%s:%d:%s\n%s' % (kind, INDEX_CACHE_VERSION,
+                                 get_file_key(filename),
+                                 os.path.abspath(filename))
+
+    def _open(self, filename, kind):
+        cache_filename = self.get_cache_filename(filename, kind)
+        try:
+            rv = ColumnFile(cache_filename)
+        except (EnvironmentError, ColumnFileException):
+            self.misses += 1
+            return None
+        if rv.meta != self._get_meta(filename, kind):
+            rv.close()
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rv
+
+    def _store(self, filename, kind, columns):
+        ensure_dir(self.directory)
+        write_columns(self.get_cache_filename(filename, kind), columns,
+                      meta=self._get_meta(filename, kind))
+
+    def load_catalog(self, filename):
+        """Returns the cached ``(digests, offsets, sizes, cas_nums)`` columns
+        of a catalog or `None`.  The columns are views over the memory
+        mapped cache file (a :class:`~libfb2.sb.PackedDigests` and
+        :class:`~libfb2.columns.IntColumn` objects) which stays mapped
+        as long as they are referenced.
+        """
+        from .sb import PackedDigests
+        cf = self._open(filename, 'cat')
+        if cf is None:
+            return None
+        try:
+            return (PackedDigests(*cf.get_region('digests')),
+                    cf.get_ints('offsets'),
+                    cf.get_ints('sizes'),
+                    cf.get_ints('cas_nums'))
+        except:
+            cf.close()
+            raise
+
+    def store_catalog(self, filename, digests, offsets, sizes, cas_nums):
+        """Stores the columns of a catalog."""
+        self._store(filename, 'cat', [
+            ('digests', 'S20', digests),
+            ('offsets', '<i4', _int32_column(offsets)),
+            ('sizes', '<i4', _int32_column(sizes)),
+            ('cas_nums', '<i4', _int32_column(cas_nums)),
+        ])
+
+    def load_toc(self, filename):
+        """Returns the cached bundle table of a TOC file as list of
+        ``(id, offset, size)`` tuples or `None`.
+        """
+        cf = self._open(filename, 'toc')
+        if cf is None:
+            return None
+        with cf:
+            return zip(cf.get_strings('id'),
+                       unpack_ints(cf.get_bytes('offset')),
+                       unpack_ints(cf.get_bytes('size')))
+
+    def store_toc(self, filename, bundles):
+        """Stores the bundle table of a TOC file."""
+        ids, offsets, sizes = zip(*bundles) or ((), (), ())
+        id_offsets, id_heap = pack_strings(ids)
+        self._store(filename, 'toc', [
+            ('id_offsets', '<i8', id_offsets),
+            ('id_heap', 'S1', id_heap),
+            ('offset', '<i8', pack_ints(offsets)),
+            ('size', '<i8', pack_ints(sizes)),
+        ])
+
+
+class PayloadCache(object):
+    """Caches the decrypted payloads of encrypted files such as .toc and
+    .cat files on disk so that they are decrypted only once.  Payloads
+    are keyed by the hash from the DICE header and the size and mtime of
+    the file and are read back memory mapped.
+
+    The cache files are written atomically so several processes can share
+    the directory.  If the files take more than `max_bytes` the least
+    recently used ones are removed, a budget of zero disables the cache.
+    The directory is only scanned for that on the first store and
+    whenever a running total of the stored sizes exceeds the budget.
+    Errors while reading or writing the cache are ignored and the file is
+    decrypted as usual.  By default the cache lives in the ``payloads``
+    folder of the cache directory.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_PAYLOAD_CACHE_SIZE,
+                 min_size=PAYLOAD_CACHE_MIN_SIZE):
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # the estimated size of the cache files and the directory it is
+        # for.  Other processes sharing the directory are only noticed on
+        # the next scan.
+        self._total = None
+        self._total_directory = None
+
+    def _get_directory(self):
+        if self._directory is not None:
+            return self._directory
+        return os.path.join(get_cache_dir(), 'payloads')
+
+    def _set_directory(self, value):
+        self._directory = value
+        with self._lock:
+            self._total_directory = None
+
+    directory = property(_get_directory, _set_directory)
+    del _get_directory, _set_directory
+
+    def get_key(self, buf, fp):
+        """Returns the cache key for an encrypted file that is memory
+        mapped to `buf` or `None` if the payload should not be cached.
+        """
+        if not self.max_bytes or len(buf) - DATA_OFFSET < self.min_size:
+            return None
+        try:
+            st = os.fstat(fp.fileno())
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+        if st.st_size != len(buf):
+            return None
+        return '%s:%d:%r' % (buf[HASH_OFFSET + 1:HASH_OFFSET + 1 + HASH_SIZE],
+                             st.st_size, st.st_mtime)
+
+    def get_filename(self, key):
+        return os.path.join(self.directory,
+                            sha1(key).hexdigest() + '.payload')
+
+    def load(self, key, size):
+        """Returns the memory mapped payload for a key or `None`."""
+        filename = self.get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                buf = open_mmap(f)
+        except EnvironmentError:
+            buf = None
+        if buf is not None and len(buf) != size:
+            buf.close()
+            buf = None
+        with self._lock:
+            if buf is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            # the mtime is what the eviction goes by
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return buf
+
+    def store(self, key, data):
+        """Stores a payload and returns `True` if it was written."""
+        if len(data) > self.max_bytes:
+            return False
+        directory = self.directory
+        tmp_filename = None
+        try:
+            ensure_dir(directory)
+            fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            rename_over(tmp_filename, self.get_filename(key))
+        except EnvironmentError:
+            if tmp_filename is not None:
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+            return False
+        with self._lock:
+            self.stores += 1
+            total = None
+            if self._total_directory == directory:
+                self._total += len(data)
+                total = self._total
+        if total is None or total > self.max_bytes:
+            self.evict()
+        return True
+
+    def evict(self):
+        """Removes the least recently used payloads until the cache fits
+        into its budget.  This scans the cache directory and resets the
+        running total of the stored sizes.
+        """
+        directory = self.directory
+        files = []
+        total = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.payload'):
+                continue
+            filename = os.path.join(directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, filename, st.st_size))
+            total += st.st_size
+        files.sort()
+        for mtime, filename, size in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # removed by another process or still mapped on Windows
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+        with self._lock:
+            self._total = total
+            self._total_directory = directory
+
+    def make_reader(self, buf, fp):
+        """Creates a :class:`~libfb2.utils.DecryptingMMapTypeReader` for
+        an encrypted file memory mapped to `buf`.  The payload comes from
+        the cache if possible and is stored in it otherwise.
+        """
+        key = self.get_key(buf, fp)
+        if key is None:
+            return DecryptingMMapTypeReader(buf, fp=fp)
+        payload = self.load(key, len(buf) - DATA_OFFSET)
+        if payload is not None:
+            return DecryptingMMapTypeReader(buf, fp=fp, payload=payload)
+        rv = DecryptingMMapTypeReader(buf, fp=fp)
+        self.store(key, rv.get_buffer()[0])
+        return rv
+
+    def clear(self):
+        """Removes all cached payloads."""
+        max_bytes = self.max_bytes
+        self.max_bytes = 0
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+
+    def get_stats(self):
+        """Returns the counters of the cache as dictionary."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stores': self.stores, 'evictions': self.evictions,
+                    'max_bytes': self.max_bytes,
+                    'hit_rate': lookups and float(self.hits) / lookups
+                    or 0.0}
+
+
+class LRUCache(object):
+    """A thread safe LRU cache that is limited by the total size of the
+    values in bytes instead of the number of items.  The size of a value
+    is ``len(value)`` unless it's passed to :meth:`set`.  Values larger
+    than the budget are not cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, size=None):
+        """Stores a value and returns `True` if it was cached."""
+        if size is None:
+            size = len(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return False
+            self._items[key] = (value, size)
+            self.size += size
+            self._evict()
+            return True
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            self.size -= self._items.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Changes the budget and evicts entries if necessary."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self.size -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_stats(self):
+        """Returns the counters of the cache as dictionary."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._items), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': lookups and float(self.hits) / lookups
+                    or 0.0}
+
+
+def estimate_size(value):
+    """Roughly estimates the memory used by a decoded SB tree in bytes.
+    The items of long lists are usually alike so only a sample of them is
+    looked at.
+    """
+    getsizeof = sys.getsizeof
+    rv = getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            rv += getsizeof(key) + estimate_size(item)
+    elif isinstance(value, list):
+        count = len(value)
+        if count > ESTIMATE_SAMPLE_SIZE:
+            sample = value[::count // ESTIMATE_SAMPLE_SIZE]
+            rv += sum(estimate_size(x) for x in sample) * count // len(sample)
+        else:
+            for item in value:
+                rv += estimate_size(item)
+    elif isinstance(value, Record):
+        for item in value.itervalues():
+            rv += estimate_size(item)
+    elif isinstance(value, BytesPrimitiveWrapper):
+        rv += getsizeof(value.bytes)
+    elif hasattr(value, '__dict__'):
+        rv += getsizeof(value.__dict__)
+    return rv
+
+
+#: the process wide cache for raw and parsed file contents
+content_cache = LRUCache(DEFAULT_CONTENT_CACHE_SIZE)
+
+
+def set_content_cache_size(max_bytes):
+    """Changes the memory budget of the shared content cache.  A budget
+    of zero disables the cache.
+    """
+    content_cache.resize(max_bytes)
+
+
+def get_content_cache_stats():
+    """Returns the hit, miss and eviction counters of the shared content
+    cache.
+    """
+    return content_cache.get_stats()
+
+
+#: the process wide cache for decrypted payloads of encrypted files.  It
+#: is disabled until a budget is set with :func:`set_payload_cache_size`.
+payload_cache = PayloadCache(max_bytes=0)
+
+
+def set_payload_cache_size(max_bytes):
+    """Changes the disk budget of the decrypted payload cache.  The cache
+    is disabled by default, pass a budget such as
+    :data:`DEFAULT_PAYLOAD_CACHE_SIZE` to enable it and zero to disable
+    it again.
+    """
+    payload_cache.max_bytes = max_bytes
+    if max_bytes:
+        payload_cache.evict()
+
+
+def get_payload_cache_stats():
+    """Returns the hit, miss and eviction counters of the decrypted
+    payload cache.
+    """
+    return payload_cache.get_stats()
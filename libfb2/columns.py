@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.columns
+    ~~~~~~~~~~~~~~
+
+    A simple memory mappable column file format.  The file starts with a
+    header, followed by an opaque metadata string and a directory of all
+    columns.  The columns themselves are stored 8 byte aligned one after
+    another so they can be used straight from the mapping:
+
+        char magic[4];          // "FB2C"
+        uint16 version;
+        uint16 column_count;
+        uint32 meta_size;
+        char meta[meta_size];
+        struct {
+            char name[32];
+            char dtype[8];      // NumPy style, for instance "<i4" or "S20"
+            uint64 offset;
+            uint64 size;
+        } columns[column_count];
+
+    Variable length strings are stored as two columns: a heap with all
+    strings one after another and an int64 offset column with one more
+    item than there are strings.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import mmap
+import struct
+import tempfile
+
+from .utils import make_view
+
+
+COLUMN_FILE_MAGIC = 'FB2C'
+COLUMN_FILE_VERSION = 1
+
+_header = struct.Struct('<4sHHI')
+_column_entry = struct.Struct('<32s8sQQ')
+
+# struct codes of the integer dtypes
+_int_codes = {'<i4': '<i', '<i8': '<q'}
+
+# the number of items :class:`IntColumn` unpacks at once when iterating
+_iter_batch = 4096
+
+
+class ColumnFileException(Exception):
+    pass
+
+
+def pack_ints(values, dtype='<q'):
+    """Packs a sequence of integers into the bytes of a column."""
+    return struct.pack('%s%d%s' % (dtype[0], len(values), dtype[1]), *values)
+
+
+def unpack_ints(data, dtype='<q'):
+    """Unpacks the bytes of an integer column into a tuple."""
+    size = struct.calcsize(dtype)
+    return struct.unpack('%s%d%s' % (dtype[0], len(data) // size, dtype[1]),
+                         data)
+
+
+def pack_strings(strings):
+    """Packs a list of strings into ``(offsets, heap)`` column data."""
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return pack_ints(offsets), ''.join(strings)
+
+
+def unpack_strings(offsets, heap):
+    """Reverses :func:`pack_strings`."""
+    offsets = unpack_ints(offsets)
+    heap = str(heap)
+    return [heap[offsets[idx]:offsets[idx + 1]]
+            for idx in xrange(len(offsets) - 1)]
+
+
+class IntColumn(object):
+    """Read-only sequence view over an integer column in a buffer such as
+    a memory mapped column file.  Items are unpacked on access so the
+    column is never copied.
+    """
+    __slots__ = ('_buf', '_offset', '_length', '_st')
+
+    def __init__(self, buf, offset, size, dtype='<q'):
+        self._buf = buf
+        self._offset = offset
+        self._st = struct.Struct(dtype)
+        self._length = size // self._st.size
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError(idx)
+        return self._st.unpack_from(self._buf, self._offset +
+                                    idx * self._st.size)[0]
+
+    def __iter__(self):
+        code = self._st.format
+        size = self._st.size
+        for start in xrange(0, self._length, _iter_batch):
+            count = min(_iter_batch, self._length - start)
+            for value in struct.unpack_from('%s%d%s' % (code[0], count,
+                                                         code[1]),
+                                            self._buf,
+                                            self._offset + start * size):
+                yield value
+
+
+def write_columns(filename, columns, meta=''):
+    """Writes a column file.  `columns` is a list of ``(name, dtype,
+    data)`` tuples where `data` is a string or a list of strings that are
+    written one after another.  The file is written to a temporary file
+    first and then moved into place so readers never see partial files.
+    Names longer than 32 bytes and dtypes longer than 8 bytes are
+    rejected with a :exc:`ValueError`.
+    """
+    columns = [(name, dtype, isinstance(data, basestring) and [data] or data)
+               for name, dtype, data in columns]
+    for name, dtype, data in columns:
+        if len(name) > 32:
+            raise ValueError('Column name %r is longer than 32 bytes' % name)
+        if len(dtype) > 8:
+            raise ValueError('Column dtype %r is longer than 8 bytes' %
+                             dtype)
+    directory_size = _column_entry.size * len(columns)
+    offset = _header.size + len(meta) + directory_size
+    entries = []
+    for name, dtype, data in columns:
+        size = sum(len(x) for x in data)
+        offset += -offset % 8
+        entries.append(_column_entry.pack(name, dtype, offset, size))
+        offset += size
+
+    directory = os.path.dirname(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory or '.',
+                                        prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(COLUMN_FILE_MAGIC, COLUMN_FILE_VERSION,
+                                 len(columns), len(meta)))
+            f.write(meta)
+            f.write(''.join(entries))
+            for _, _, data in columns:
+                f.write('\x00' * (-f.tell() % 8))
+                for chunk in data:
+                    f.write(chunk)
+        rename_over(tmp_filename, filename)
+    except:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def rename_over(src, dst):
+    """Renames a file replacing the destination.  This is atomic on POSIX
+    systems, on Windows the destination has to be removed first.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+class ColumnFile(object):
+    """Memory maps a column file for reading."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            try:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                raise ColumnFileException('Could not map column file')
+        try:
+            self._read_directory()
+        except:
+            self._buf.close()
+            raise
+
+    def _read_directory(self):
+        buf = self._buf
+        if len(buf) < _header.size:
+            raise ColumnFileException('Truncated column file')
+        magic, version, count, meta_size = _header.unpack_from(buf, 0)
+        if magic != COLUMN_FILE_MAGIC or version != COLUMN_FILE_VERSION:
+            raise ColumnFileException('Not a column file')
+        offset = _header.size
+        self.meta = buf[offset:offset + meta_size]
+        offset += meta_size
+        self.columns = {}
+        self.column_names = []
+        for idx in xrange(count):
+            name, dtype, data_offset, size = \
+                _column_entry.unpack_from(buf, offset)
+            offset += _column_entry.size
+            name = name.rstrip('\x00')
+            if data_offset + size > len(buf):
+                raise ColumnFileException('Truncated column file')
+            self.columns[name] = (dtype.rstrip('\x00'), data_offset, size)
+            self.column_names.append(name)
+
+    def get_dtype(self, name):
+        return self.columns[name][0]
+
+    def get_view(self, name):
+        """Returns a zero-copy view of the column data."""
+        dtype, offset, size = self.columns[name]
+        return make_view(self._buf, offset, size)
+
+    def get_bytes(self, name):
+        """Returns a copy of the column data as string."""
+        dtype, offset, size = self.columns[name]
+        return self._buf[offset:offset + size]
+
+    def get_region(self, name):
+        """Returns ``(buffer, offset, size)`` of the column data in the
+        mapping.  The buffer stays valid until the file is closed.
+        """
+        dtype, offset, size = self.columns[name]
+        return self._buf, offset, size
+
+    def get_ints(self, name):
+        """Returns an :class:`IntColumn` view of an ``<i4`` or ``<i8``
+        column.
+        """
+        dtype, offset, size = self.columns[name]
+        if dtype not in _int_codes:
+            raise ColumnFileException('Column %r is not an integer '
+                                      'column' % name)
+        return IntColumn(self._buf, offset, size, _int_codes[dtype])
+
+    def get_strings(self, name):
+        """Returns a list of strings stored with :func:`pack_strings` as
+        ``name + '_offsets'`` and ``name + '_heap'`` columns.
+        """
+        return unpack_strings(self.get_bytes(name + '_offsets'),
+                              self.get_bytes(name + '_heap'))
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.diff
+    ~~~~~~~~~~~
+
+    Compares two catalogs, for instance of two versions of the game.  Both
+    catalogs are sorted by digest so the comparison is a single merge over
+    the columns without building any dictionaries::
+
+        old = CASCatalog('bf3-r3/Data/cas.cat')
+        new = CASCatalog('bf3-r4/Data/cas.cat')
+        added = [change.new_index for change in diff_catalogs(old, new)
+                 if change.status == 'added']
+        new.extract_all('/tmp/patch', indexes=added)
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import namedtuple
+
+from .types import SHA1
+
+
+class Change(namedtuple('Change', 'status sha1 old_index new_index assets')):
+    """A difference between two catalogs.  `status` is ``'added'``,
+    ``'removed'`` or ``'relocated'`` (the contents moved to a different
+    place in the CAS files).  The indexes point into the columns of the
+    old and new catalog and are `None` if the entry does not exist there.
+    `assets` is the list of :class:`~libfb2.index.Asset` entries that
+    reference the file or `None` if assets were not requested.
+    """
+    __slots__ = ()
+
+    def get_file(self, old, new):
+        """Returns the :class:`~libfb2.sb.CASFile` of the change from the
+        new catalog or from the old one for removed entries.
+        """
+        if self.new_index is not None:
+            return new.make_file(self.new_index)
+        return old.make_file(self.old_index)
+
+
+def iter_catalog_changes(old, new, relocated=True):
+    """Merges the digest columns of two catalogs and yields ``(status,
+    old_index, new_index)`` tuples sorted by digest.  This is the low
+    level version of :func:`diff_catalogs`.
+    """
+    old_digests = old.digests
+    new_digests = new.digests
+    old_len = len(old_digests)
+    new_len = len(new_digests)
+    i = j = 0
+    while i < old_len and j < new_len:
+        a = old_digests[i]
+        b = new_digests[j]
+        if a == b:
+            if relocated and (old.cas_nums[i] != new.cas_nums[j] or
+                              old.offsets[i] != new.offsets[j] or
+                              old.sizes[i] != new.sizes[j]):
+                yield 'relocated', i, j
+            i += 1
+            j += 1
+        elif a < b:
+            yield 'removed', i, None
+            i += 1
+        else:
+            yield 'added', None, j
+            j += 1
+    for i in xrange(i, old_len):
+        yield 'removed', i, None
+    for j in xrange(j, new_len):
+        yield 'added', None, j
+
+
+def diff_catalogs(old, new, relocated=True, assets=False):
+    """Compares two :class:`~libfb2.sb.CASCatalog` objects in one linear
+    pass and yields :class:`Change` tuples sorted by digest.  If
+    `relocated` is disabled entries that only moved are not reported.
+
+    With `assets` enabled every change is mapped to the superbundles and
+    bundles that reference the file through the asset indexes of the
+    catalogs (the old one for removed files).
+    """
+    old_index = new_index = None
+    if assets:
+        old_index = old.get_asset_index()
+        new_index = new.get_asset_index()
+    for status, i, j in iter_catalog_changes(old, new, relocated):
+        if j is not None:
+            digest = new.digests[j]
+        else:
+            digest = old.digests[i]
+        change_assets = None
+        if assets:
+            if status == 'removed':
+                change_assets = old_index.find_by_sha1(digest)
+            else:
+                change_assets = new_index.find_by_sha1(digest)
+        yield Change(status, SHA1(digest), i, j, change_assets)
+
+
+def summarize_changes(changes):
+    """Counts changes by status and by superbundle.  Returns a dictionary
+    in the form ``{'added': 1, ..., 'superbundles': {name: count}}``.
+    """
+    rv = {'added': 0, 'removed': 0, 'relocated': 0, 'superbundles': {}}
+    superbundles = rv['superbundles']
+    for change in changes:
+        rv[change.status] += 1
+        for name in set(x.superbundle for x in change.assets or ()):
+            superbundles[name] = superbundles.get(name, 0) + 1
+    return rv
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.export
+    ~~~~~~~~~~~~~
+
+    Exports the ebx, res and chunk entries of all bundles of one or more
+    superbundles into a column file (see :mod:`libfb2.columns`) so that
+    questions about the whole game can be answered with a few vectorized
+    operations instead of walking the decoded bundles::
+
+        export_catalog('/tmp/assets.fb2c', cat)
+        with ExportFile('/tmp/assets.fb2c') as export:
+            columns = export.to_numpy()
+            res = columns['kind'] == KIND_CODES['res']
+            per_superbundle = numpy.bincount(columns['superbundle'][res],
+                                             columns['size'][res])
+
+    Every entry is a row with these columns:
+
+        ``kind``            0 for ebx, 1 for res and 2 for chunks
+        ``superbundle``     index into the superbundle names
+        ``bundle``          index into the bundle names
+        ``name``            the asset name, the id for chunks
+        ``sha1``            the raw digest (zeros if there is none)
+        ``size``            the size or -1
+        ``original_size``   the uncompressed size or -1
+        ``type``            the res type or 0
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import struct
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .columns import ColumnFile, write_columns, pack_strings, unpack_ints
+from .index import ASSET_KINDS, find_superbundles, iter_meta_entries
+
+
+EXPORT_VERSION = 1
+
+#: the kinds in the order of their codes in the ``kind`` column
+KINDS = tuple(kind for key, kind in ASSET_KINDS)
+KIND_CODES = dict((kind, code) for code, kind in enumerate(KINDS))
+
+_row_columns = [
+    ('kind', '|u1'),
+    ('superbundle', '<i4'),
+    ('bundle', '<i4'),
+    ('name_offsets', '<i8'),
+    ('name_heap', 'S1'),
+    ('sha1', 'S20'),
+    ('size', '<i8'),
+    ('original_size', '<i8'),
+    ('type', '<i4'),
+]
+
+
+# struct codes of the integer dtypes
+_struct_codes = {'<i4': '<i', '<i8': '<q'}
+
+
+class ExportException(Exception):
+    pass
+
+
+def _get_meta():
+    return 'export:%d' % EXPORT_VERSION
+
+
+def _pack(dtype, values):
+    return struct.pack('%s%d%s' % (dtype[0], len(values), dtype[-1]),
+                       *values)
+
+
+def _rebase(dtype, data, base):
+    if not base:
+        return data
+    code = _struct_codes[dtype]
+    return _pack(code, [x + base for x in unpack_ints(data, code)])
+
+
+def _int_or(value, default):
+    if isinstance(value, (int, long)):
+        return value
+    return default
+
+
+def _export_superbundle(job):
+    """Decodes the bundles of a superbundle and returns the packed
+    columns of its entries.  Bundle numbers and name offsets are relative
+    to the superbundle.
+    """
+    from .sb import Bundle
+    name, basename = job
+    start = timer()
+    bundle_ids = []
+    kinds = []
+    bundle_nums = []
+    names = []
+    sha1s = []
+    sizes = []
+    original_sizes = []
+    types = []
+    with Bundle(basename) as bundle:
+        for bundle_num, bundle_file in enumerate(bundle.iter_files()):
+            bundle_ids.append(bundle_file.id)
+            meta = bundle_file.get_parsed_contents(cache=False, compact=True)
+            for asset_name, kind, entry in iter_meta_entries(meta):
+                kinds.append(KIND_CODES[kind])
+                bundle_nums.append(bundle_num)
+                names.append(asset_name)
+                digest = entry.get('sha1')
+                sha1s.append(digest is not None and digest.bytes or
+                             '\x00' * 20)
+                sizes.append(_int_or(entry.get('size'), -1))
+                original_sizes.append(_int_or(entry.get('originalSize'), -1))
+                types.append(_int_or(entry.get('resType'), 0))
+    name_offsets, name_heap = pack_strings(names)
+    columns = {
+        'kind': _pack('<B', kinds),
+        'bundle': _pack('<i', bundle_nums),
+        # the leading zero is dropped so the parts can be concatenated
+        'name_offsets': name_offsets[8:],
+        'name_heap': name_heap,
+        'sha1': ''.join(sha1s),
+        'size': _pack('<q', sizes),
+        'original_size': _pack('<q', original_sizes),
+        'type': _pack('<i', types),
+    }
+    return name, bundle_ids, len(kinds), columns, timer() - start
+
+
+def export_superbundles(filename, superbundles, workers=None,
+                        use_processes=True, progress=None):
+    """Exports the entries of superbundles into a column file.
+    `superbundles` is a list of ``(name, basename)`` tuples where the
+    basename is the path of the superbundle without extension.  The
+    superbundles are decoded in parallel by a pool of `workers` processes
+    (or threads if `use_processes` is disabled).  The file is replaced
+    atomically.
+
+    `progress` is called as ``progress(name, bundles, rows, seconds)`` for
+    every exported superbundle.  Returns a dictionary with the number of
+    superbundles, bundles and rows and the time it took.
+    """
+    start = timer()
+    superbundles = list(superbundles)
+    superbundle_names = []
+    bundle_names = []
+    bundle_superbundles = []
+    parts = dict((name, []) for name, dtype in _row_columns)
+    rows = 0
+    heap_size = 0
+
+    pool_cls = use_processes and Pool or ThreadPool
+    pool = pool_cls(workers)
+    try:
+        for name, bundle_ids, count, columns, seconds in \
+                pool.imap(_export_superbundle, superbundles):
+            superbundle_num = len(superbundle_names)
+            superbundle_names.append(name)
+            parts['kind'].append(columns['kind'])
+            parts['superbundle'].append(_pack('<i', [superbundle_num] *
+                                              count))
+            parts['bundle'].append(_rebase('<i4', columns['bundle'],
+                                           len(bundle_names)))
+            parts['name_offsets'].append(_rebase(
+                '<i8', columns['name_offsets'], heap_size))
+            for key in 'name_heap', 'sha1', 'size', 'original_size', 'type':
+                parts[key].append(columns[key])
+            heap_size += len(columns['name_heap'])
+            bundle_names.extend(bundle_ids)
+            bundle_superbundles.extend([superbundle_num] * len(bundle_ids))
+            rows += count
+            if progress is not None:
+                progress(name, len(bundle_ids), count, seconds)
+    finally:
+        pool.close()
+        pool.join()
+
+    parts['name_offsets'].insert(0, _pack('<q', [0]))
+    columns = [(name, dtype, parts[name]) for name, dtype in _row_columns]
+    for name, strings in (('superbundle_names', superbundle_names),
+                          ('bundle_names', bundle_names)):
+        offsets, heap = pack_strings(strings)
+        columns.append((name + '_offsets', '<i8', offsets))
+        columns.append((name + '_heap', 'S1', heap))
+    columns.append(('bundle_superbundle', '<i4',
+                    _pack('<i', bundle_superbundles)))
+    write_columns(filename, columns, meta=_get_meta())
+
+    return {'superbundles': len(superbundle_names),
+            'bundles': len(bundle_names), 'rows': rows,
+            'seconds': timer() - start}
+
+
+def export_directory(filename, directory, names=None, **options):
+    """Exports all superbundles below a directory or the ones in `names`.
+    Keyword arguments are forwarded to :func:`export_superbundles`.
+    """
+    if names is None:
+        names = find_superbundles(directory)
+    return export_superbundles(filename, [
+        (name, os.path.join(directory, name)) for name in names], **options)
+
+
+def export_catalog(filename, cat, names=None, **options):
+    """Exports the superbundles next to a :class:`~libfb2.sb.CASCatalog`.
+    For a :class:`~libfb2.sb.LayeredCatalog` superbundles of a layer hide
+    the ones with the same name in the layers after it.  Keyword
+    arguments are forwarded to :func:`export_superbundles`.
+    """
+    superbundles = []
+    seen = set()
+    for layer in getattr(cat, 'layers', None) or [cat]:
+        directory = os.path.dirname(layer.filename)
+        for name in find_superbundles(directory):
+            if name in seen or (names is not None and name not in names):
+                continue
+            seen.add(name)
+            superbundles.append((name, os.path.join(directory, name)))
+    superbundles.sort()
+    return export_superbundles(filename, superbundles, **options)
+
+
+class ExportFile(object):
+    """Reads a file written by :func:`export_superbundles`.  Columns can
+    be read as plain Python values or, if NumPy is installed, as memory
+    mapped arrays with :meth:`to_numpy`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._cf = ColumnFile(filename)
+        if self._cf.meta != _get_meta():
+            self._cf.close()
+            raise ExportException('Not an export file or wrong version')
+
+    def __len__(self):
+        return self._cf.columns['kind'][2]
+
+    @property
+    def column_names(self):
+        return self._cf.column_names
+
+    def get_column(self, name):
+        """Returns a list with the values of a column.  Names are returned
+        with :meth:`get_names`.
+        """
+        dtype = self._cf.get_dtype(name)
+        data = self._cf.get_bytes(name)
+        if dtype == 'S20':
+            return [data[idx:idx + 20] for idx in xrange(0, len(data), 20)]
+        if dtype == '|u1':
+            return map(ord, data)
+        return list(unpack_ints(data, _struct_codes[dtype]))
+
+    def get_names(self):
+        """Returns the names of all rows."""
+        return self._cf.get_strings('name')
+
+    def get_superbundle_names(self):
+        return self._cf.get_strings('superbundle_names')
+
+    def get_bundle_names(self):
+        return self._cf.get_strings('bundle_names')
+
+    def to_numpy(self):
+        """Returns a dictionary with all columns as read-only NumPy arrays
+        that are memory mapped from the file.  Strings are returned as the
+        ``*_offsets`` and ``*_heap`` columns they are stored in.
+        """
+        if numpy is None:
+            raise RuntimeError('NumPy is not installed')
+        rv = {}
+        for name in self._cf.column_names:
+            dtype, offset, size = self._cf.columns[name]
+            dtype = numpy.dtype(dtype)
+            if not size:
+                rv[name] = numpy.zeros(0, dtype=dtype)
+                continue
+            rv[name] = numpy.memmap(self.filename, dtype=dtype, mode='r',
+                                    offset=offset,
+                                    shape=(size // dtype.itemsize,))
+        return rv
+
+    def close(self):
+        self._cf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -8,89 +8,190 @@
     :copyright: (c) Copyright 2011 by Armin Ronacher, Pilate.
     :license: BSD, see LICENSE for more details.
 """
-from StringIO import StringIO
+import os
+import struct
 from uuid import UUID
-from .utils import TypeReader
+from itertools import izip
+from collections import namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from . import stats
+from .utils import TypeReader, MMapTypeReader, make_reader, pread
+from .types import LazyBlob
 
 
 FB_DEF_HEADER = '\xce\xd1\xb2\x0f'
 
+# the magic followed by the eleven int32 fields of the header
+_fbdef_header = struct.Struct('<4s11i')
+
 
 class FBDefException(Exception):
     pass
 
 
-class FBDefParser(object):
+class FBDefHeader(namedtuple('FBDefHeader', 'fn_offset fn_to_eof '
+                             'extra_uuids unknown0 unknown1 chunk0_size '
+                             'chunk1_size header_size fn_size unknown2 '
+                             'payload_size')):
+    """The fixed size header of a definition file."""
+    __slots__ = ()
 
-    def __init__(self, fp):
-        self.reader = TypeReader(fp)
 
-    def parse(self):
-        rv = {}
-        self.parse_header()
+def parse_fbdef_header(data, offset=0):
+    """Decodes the header at `offset` of a string or buffer with a single
+    unpack and returns it as :class:`FBDefHeader`.
+    """
+    if len(data) - offset < _fbdef_header.size:
+        raise FBDefException('Expected fbdef header')
+    values = _fbdef_header.unpack_from(data, offset)
+    if values[0] != FB_DEF_HEADER:
+        raise FBDefException('Expected fbdef header')
+    return FBDefHeader._make(values[1:])
 
-        fn_offset = self.reader.read_sst('i')
-        fn_to_eof = self.reader.read_sst('i')
-        extra_uuids = self.reader.read_sst('i')
 
-        # TODO: what are those?
-        rv['unknown0'] = self.reader.read_sst('i')
-        rv['unknown1'] = self.reader.read_sst('i')
+class FBDefParser(object):
+    """Parses a definition file from a file object or reader.  If `lazy`
+    is enabled the chunks and unknown regions are returned as
+    :class:`~libfb2.types.LazyBlob` views instead of strings so only the
+    header, the uuids, the header table and the name are decoded.
+    """
+
+    def __init__(self, fp, lazy=False):
+        if isinstance(fp, TypeReader):
+            self.reader = fp
+        else:
+            self.reader = make_reader(fp)
+        self.lazy = lazy
 
-        chunk0_size = self.reader.read_sst('i')
-        chunk1_size = self.reader.read_sst('i')
-        header_size = self.reader.read_sst('i')
-        fn_size = self.reader.read_sst('i')
+    def parse(self):
+        rv = {}
+        header = self.parse_header()
 
+        # TODO: what are those?
+        rv['unknown0'] = header.unknown0
+        rv['unknown1'] = header.unknown1
         # TODO: what is this?
-        rv['unknown2'] = self.reader.read_sst('i')
-
-        payload_size = self.reader.read_sst('i')
+        rv['unknown2'] = header.unknown2
 
         # TODO: That's currently our best guess
-        rv['uuids'] = self.parse_uuids(extra_uuids)
-        rv['headers'] = self.parse_headers(header_size)
+        rv['uuids'] = self.parse_uuids(header.extra_uuids)
+        rv['headers'] = self.parse_headers(header.header_size)
 
-        rv['chunk0'] = self.reader.read(chunk0_size)
-        rv['chunk1'] = self.reader.read(chunk1_size)
+        rv['chunk0'] = self.read_region(header.chunk0_size)
+        rv['chunk1'] = self.read_region(header.chunk1_size)
 
-        rv['unknown3'] = self.reader.read(fn_offset - self.reader.tell())
-        rv['name'] = self.reader.read(fn_size)
-        rv['unknown4'] = self.reader.read(fn_to_eof - fn_size)
+        rv['unknown3'] = self.read_region(header.fn_offset -
+                                          self.reader.tell())
+        rv['name'] = self.reader.read(header.fn_size)
+        rv['unknown4'] = self.read_region(header.fn_to_eof - header.fn_size)
 
+        if stats.active is not None:
+            self.reader.count_consumed()
         return rv
 
-    def parse_uuids(self, extra):
-        rv = []
-        for x in xrange((extra + 1) * 2):
-            rv.append(UUID(bytes=self.reader.read(16)))
+    def read_region(self, length):
+        """Reads a region of the file or skips over it and returns a lazy
+        view in lazy mode.
+        """
+        if not self.lazy:
+            return self.reader.read(length)
+        rv = LazyBlob(self.reader, self.reader.tell(), length)
+        self.reader.skip(length)
         return rv
 
+    def parse_uuids(self, extra):
+        data = self.reader.read((extra + 1) * 32)
+        return [UUID(bytes=data[offset:offset + 16])
+                for offset in xrange(0, len(data), 16)]
+
     def parse_headers(self, size):
         headers = self.reader.read(size).split('\x00')
         if not headers or headers.pop() != '':
             raise FBDefException('Invalid header list')
-        return headers
+        # the same names show up in thousands of files
+        return map(intern, headers)
 
     def parse_header(self):
-        header = self.reader.read(len(FB_DEF_HEADER))
-        if header != FB_DEF_HEADER:
-            raise FBDefException('Expected fbdef header')
+        return parse_fbdef_header(self.reader.read(_fbdef_header.size))
 
 
-def load(fp_or_filename):
+def load(fp_or_filename, lazy=False):
+    """Loads a definition file.  Lazy views stay readable after the file
+    was closed if it was memory mapped which is the case for all real
+    files.
+    """
     if hasattr(fp_or_filename, 'read'):
         fp = fp_or_filename
         close = False
     else:
         fp = open(fp_or_filename, 'rb')
         close = True
+    parser = FBDefParser(fp, lazy)
     try:
-        return FBDefParser(fp).parse()
+        return parser.parse()
     finally:
+        if not lazy and parser.reader is not fp:
+            parser.reader.release()
         if close:
             fp.close()
 
 
-def loads(string):
-    return load(StringIO(string))
+def loads(string, lazy=False):
+    return FBDefParser(MMapTypeReader(string), lazy).parse()
+
+
+def _get_cas_location(file):
+    if file.fp is not None:
+        return file.fp.name, file.offset
+    return file.cat.get_cas_filename(file.cas_num), file.offset
+
+
+def _load_cas_entry(job):
+    filename, offset, size = job
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        data = pread(fd, offset, size)
+    finally:
+        os.close(fd)
+    if len(data) != size:
+        raise FBDefException('Unexpected end of CAS file')
+    return loads(data)
+
+
+def _load_cas_file(job):
+    file, lazy = job
+    return file, loads(file.read_bytes(), lazy)
+
+
+def load_many(files, lazy=True, workers=4, use_processes=False):
+    """Parses many definition files from :class:`~libfb2.sb.CASFile`
+    objects and yields ``(file, definition)`` tuples.  The files are read
+    in the order they are stored in the CAS files by a pool of `workers`
+    threads and returned in the order they finish.
+
+    With `use_processes` the files are parsed in worker processes which
+    helps if the parsing and not the reading is the bottleneck.  As the
+    results have to be sent back they are never lazy in that case and
+    they are returned in CAS order.
+    """
+    files = sorted(files, key=_get_cas_location)
+    if use_processes:
+        pool = Pool(workers)
+        jobs = [_get_cas_location(file) + (file.size,) for file in files]
+        results = izip(files, pool.imap(_load_cas_entry, jobs, 16))
+    else:
+        pool = ThreadPool(workers)
+        results = pool.imap_unordered(_load_cas_file,
+                                      [(file, lazy) for file in files], 16)
+    finished = False
+    try:
+        for rv in results:
+            yield rv
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.index
+    ~~~~~~~~~~~~
+
+    A persisted index of all assets in all superbundles of a game.  Every
+    ebx, res and chunk entry of every bundle is recorded with the
+    superbundle and bundle it lives in so that assets can be found by
+    name without opening any superbundle::
+
+        index = AssetIndex.for_catalog(cat)
+        index.update()
+        for asset in index.find('persistence/dogtags/', kind='ebx'):
+            print asset.name, asset.sha1
+
+    The index is a SQLite database.  Superbundles are reindexed when their
+    .toc or .sb file changes, unchanged ones are skipped.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sqlite3
+import threading
+from hashlib import sha1
+from collections import namedtuple
+
+from .cache import get_cache_dir, get_file_key, ensure_dir
+from .types import SHA1, Record
+
+
+ASSET_INDEX_VERSION = 2
+
+#: the lists of a bundle that are indexed and the kind they are stored as
+ASSET_KINDS = (('ebx', 'ebx'), ('res', 'res'), ('chunks', 'chunk'))
+
+_schema = '''
+create table if not exists superbundles (
+    id integer primary key,
+    name text unique not null,
+    key text not null
+);
+create table if not exists assets (
+    name text not null,
+    kind text not null,
+    sha1 blob,
+    size integer,
+    superbundle integer not null,
+    bundle text not null
+);
+create index if not exists assets_name on assets (name);
+create index if not exists assets_superbundle on assets (superbundle);
+create index if not exists assets_sha1 on assets (sha1);
+'''
+
+
+class Asset(namedtuple('Asset', 'name kind sha1 size superbundle bundle')):
+    """An entry of the asset index.  Chunks have no name, for them the
+    string form of the chunk id is used.
+    """
+    __slots__ = ()
+
+
+def _prefix_end(prefix):
+    """Returns the smallest string that is larger than all strings that
+    start with `prefix` or `None` if there is no such string.
+    """
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def find_superbundles(directory):
+    """Finds all superbundles below a directory and returns their names
+    relative to it (with forward slashes and without extension).
+    """
+    rv = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            base, ext = os.path.splitext(filename)
+            if ext.lower() != '.toc' or \
+               not os.path.isfile(os.path.join(dirpath, base + '.sb')):
+                continue
+            path = os.path.relpath(os.path.join(dirpath, base), directory)
+            rv.append(path.replace(os.path.sep, '/'))
+    return rv
+
+
+def iter_meta_entries(meta):
+    """Iterates over ``(name, kind, entry)`` tuples of the ebx, res and
+    chunk entries of a decoded bundle.  Chunks are named after their id.
+    """
+    if not isinstance(meta, (dict, Record)):
+        return
+    for key, kind in ASSET_KINDS:
+        for entry in meta.get(key) or ():
+            if not isinstance(entry, (dict, Record)):
+                continue
+            name = entry.get('name')
+            if name is None and 'id' in entry:
+                name = str(entry['id'])
+            if name is None:
+                continue
+            yield name, kind, entry
+
+
+def iter_bundle_assets(bundle):
+    """Iterates over ``(name, kind, sha1, size, bundle_id)`` tuples of
+    all entries in the bundles of a :class:`~libfb2.sb.Bundle`.
+    """
+    for bundle_file in bundle.iter_files():
+        meta = bundle_file.get_parsed_contents(cache=False)
+        for name, kind, entry in iter_meta_entries(meta):
+            digest = entry.get('sha1')
+            yield (name, kind, digest is not None and digest.bytes or None,
+                   entry.get('size'), bundle_file.id)
+
+
+class AssetIndex(object):
+    """The asset index stored in `filename`.  Use :meth:`for_catalog` to
+    get the index of a catalog in the default location.  The index can be
+    used from multiple threads.
+    """
+
+    def __init__(self, filename, directory=None, cat=None):
+        self.filename = filename
+        self.directory = directory
+        self.cat = cat
+        self._lock = threading.Lock()
+        ensure_dir(os.path.dirname(os.path.abspath(filename)))
+        self._con = sqlite3.connect(filename, check_same_thread=False)
+        self._con.text_factory = str
+        with self._lock:
+            self._init_schema()
+
+    @classmethod
+    def for_catalog(cls, cat, filename=None):
+        """Opens the index for the superbundles next to a
+        :class:`~libfb2.sb.CASCatalog`.  By default the index is stored in
+        the cache directory.
+        """
+        directory = os.path.dirname(cat.filename)
+        if filename is None:
+            filename = os.path.join(get_cache_dir(), 'assets', '%s.db' %
+                                    sha1(os.path.abspath(directory))
+                                    .hexdigest())
+        return cls(filename, directory, cat)
+
+    def _init_schema(self):
+        con = self._con
+        version = con.execute('pragma user_version').fetchone()[0]
+        if version != ASSET_INDEX_VERSION:
+            con.executescript('drop table if exists assets;'
+                              'drop table if exists superbundles;')
+            con.execute('pragma user_version = %d' % ASSET_INDEX_VERSION)
+        con.executescript(_schema)
+        con.commit()
+
+    def get_superbundle_key(self, name):
+        """Returns the string the index uses to detect that a superbundle
+        changed.
+        """
+        basename = os.path.join(self.directory, name)
+        return '%s|%s' % (get_file_key(basename + '.toc'),
+                          get_file_key(basename + '.sb'))
+
+    def update(self, names=None, progress=None):
+        """Brings the index up to date.  All superbundles in the directory
+        are indexed (or the ones in `names`), unchanged ones are skipped
+        and superbundles that no longer exist are removed.  `progress` is
+        called with the name of every superbundle that is reindexed.
+
+        Returns a dictionary with the number of ``'indexed'``,
+        ``'skipped'`` and ``'removed'`` superbundles.
+        """
+        from .sb import Bundle
+        if self.directory is None:
+            raise RuntimeError('Index has no superbundle directory')
+        all_names = find_superbundles(self.directory)
+        if names is None:
+            names = all_names
+        rv = {'indexed': 0, 'skipped': 0, 'removed': 0}
+
+        with self._lock:
+            known = dict((name, (id, key)) for id, name, key in
+                         self._con.execute('select id, name, key '
+                                           'from superbundles'))
+        existing = set(all_names)
+        for name in known:
+            if name not in existing:
+                self._remove_superbundle(known[name][0])
+                rv['removed'] += 1
+
+        for name in names:
+            key = self.get_superbundle_key(name)
+            if name in known and known[name][1] == key:
+                rv['skipped'] += 1
+                continue
+            if progress is not None:
+                progress(name)
+            with Bundle(os.path.join(self.directory, name),
+                        cat=self.cat) as bundle:
+                self._store_superbundle(name, key, iter_bundle_assets(bundle))
+            rv['indexed'] += 1
+        return rv
+
+    def _remove_superbundle(self, id):
+        with self._lock:
+            with self._con:
+                self._con.execute('delete from assets where superbundle = ?',
+                                  (id,))
+                self._con.execute('delete from superbundles where id = ?',
+                                  (id,))
+
+    def _store_superbundle(self, name, key, assets):
+        # parse everything before taking the lock so that the index stays
+        # usable while a superbundle is decoded
+        rows = [(name_, kind, digest is not None and buffer(digest) or None,
+                 size, bundle_id) for name_, kind, digest, size, bundle_id
+                in assets]
+        with self._lock:
+            with self._con:
+                row = self._con.execute('select id from superbundles '
+                                        'where name = ?', (name,)).fetchone()
+                if row is not None:
+                    self._con.execute('delete from assets where '
+                                      'superbundle = ?', (row[0],))
+                    self._con.execute('update superbundles set key = ? '
+                                      'where id = ?', (key, row[0]))
+                    id = row[0]
+                else:
+                    id = self._con.execute('insert into superbundles '
+                                           '(name, key) values (?, ?)',
+                                           (name, key)).lastrowid
+                self._con.executemany('insert into assets values '
+                                      '(?, ?, ?, ?, %d, ?)' % id, rows)
+
+    def _query(self, where, args):
+        query = ('select a.name, a.kind, a.sha1, a.size, s.name, a.bundle '
+                 'from assets a join superbundles s on a.superbundle = s.id '
+                 'where %s order by a.name, s.name, a.bundle' %
+                 ' and '.join(where))
+        with self._lock:
+            rows = self._con.execute(query, args).fetchall()
+        return [Asset(name, kind, digest is not None and SHA1(str(digest))
+                      or None, size, superbundle, bundle)
+                for name, kind, digest, size, superbundle, bundle in rows]
+
+    def _filter(self, where, args, kind, superbundle):
+        if kind is not None:
+            where.append('a.kind = ?')
+            args.append(kind)
+        if superbundle is not None:
+            where.append('s.name = ?')
+            args.append(superbundle)
+        return self._query(where, args)
+
+    def find(self, prefix, kind=None, superbundle=None):
+        """Returns all assets whose name starts with `prefix` sorted by
+        name.  The result can be limited to a kind (``'ebx'``, ``'res'``
+        or ``'chunk'``) and a superbundle.
+        """
+        where = ['a.name >= ?']
+        args = [prefix]
+        end = _prefix_end(prefix)
+        if end is not None:
+            where.append('a.name < ?')
+            args.append(end)
+        return self._filter(where, args, kind, superbundle)
+
+    def get(self, name, kind=None, superbundle=None):
+        """Returns all assets with exactly the given name.  The same asset
+        usually is contained in more than one bundle.
+        """
+        return self._filter(['a.name = ?'], [name], kind, superbundle)
+
+    def find_by_sha1(self, sha1, kind=None, superbundle=None):
+        """Returns all assets that reference a file.  The checksum can be
+        given as raw digest, hex digest or :class:`~libfb2.types.SHA1`.
+        """
+        if isinstance(sha1, SHA1):
+            sha1 = sha1.bytes
+        elif len(sha1) == 40:
+            sha1 = sha1.decode('hex')
+        return self._filter(['a.sha1 = ?'], [buffer(sha1)], kind,
+                            superbundle)
+
+    def list_superbundles(self):
+        """Returns the names of all indexed superbundles."""
+        with self._lock:
+            return [x[0] for x in self._con.execute(
+                'select name from superbundles order by name')]
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class LayeredAssetIndex(object):
+    """Combines the asset indexes of the layers of a
+    :class:`~libfb2.sb.LayeredCatalog` with the layer that takes
+    precedence first.  It answers the same queries as :class:`AssetIndex`
+    but superbundles of a layer hide the ones with the same name in the
+    layers after it.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = list(indexes)
+
+    def update(self, names=None, progress=None):
+        """Updates the index of every layer and returns the summed
+        counters.
+        """
+        rv = {'indexed': 0, 'skipped': 0, 'removed': 0}
+        for index in self.indexes:
+            for key, value in index.update(names, progress).iteritems():
+                rv[key] += value
+        return rv
+
+    def _merge(self, method, *args):
+        rv = []
+        hidden = set()
+        for index in self.indexes:
+            rv.extend(asset for asset in getattr(index, method)(*args)
+                      if asset.superbundle not in hidden)
+            hidden.update(index.list_superbundles())
+        rv.sort(key=lambda x: (x.name, x.superbundle, x.bundle))
+        return rv
+
+    def find(self, prefix, kind=None, superbundle=None):
+        return self._merge('find', prefix, kind, superbundle)
+
+    def get(self, name, kind=None, superbundle=None):
+        return self._merge('get', name, kind, superbundle)
+
+    def find_by_sha1(self, sha1, kind=None, superbundle=None):
+        return self._merge('find_by_sha1', sha1, kind, superbundle)
+
+    def list_superbundles(self):
+        rv = set()
+        for index in self.indexes:
+            rv.update(index.list_superbundles())
+        return sorted(rv)
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
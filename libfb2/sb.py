@@ -10,26 +10,101 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import re
+import sys
 import shutil
-from StringIO import StringIO
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Mapping, OrderedDict, deque
+from Queue import Queue
 from uuid import UUID
-from itertools import izip, chain
+from heapq import merge
+from itertools import chain, izip, izip_longest
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from hashlib import sha1 as sha1_hash
+from timeit import default_timer as timer
 
 from .utils import TypeReader, DecryptingTypeReader, \
-     open_fp_or_filename
-from .types import Blob, SHA1, Unknown
+     MMapTypeReader, DecryptingMMapTypeReader, PositionalTypeReader, \
+     BufferedTypeReader, FilePool, open_fp_or_filename, open_mmap, \
+     make_decrypting_reader, pread, SBException, MAGIC_SIZE
+from .types import Blob, LazyBlob, SHA1, Unknown, CompactSHA1, \
+     CompactUUID, make_record
+from . import stats
+from .selector import Selector, compile_selector
+from .columns import rename_over
+from .cache import get_file_key, content_cache, estimate_size
 
 
 CAS_CAT_HEADER = 'Nyan' * 4
 CAS_HEADER = '\xfa\xce\x0f\xf0'
+CAS_CAT_ENTRY_SIZE = 32
+CAS_ENTRY_HEADER_SIZE = 32
+# window of the sequential reads if a CAS cannot be memory mapped
+CAS_SCAN_WINDOW = 1024 * 1024
+
+# multiple of the magic size so that every block starts at the same
+# keystream offset.
+DECRYPT_BLOCK_SIZE = MAGIC_SIZE * 4096
+
+# extraction reads in blocks of this size and hands out work to the
+# workers in batches of about this many bytes.
+EXTRACT_BLOCK_SIZE = 1024 * 1024
+EXTRACT_BATCH_SIZE = 64 * 1024 * 1024
+
+# verification hashes work batches of about this many bytes; a checkpoint
+# is written after every batch.
+VERIFY_BATCH_SIZE = 64 * 1024 * 1024
+VERIFY_CHECKPOINT_VERSION = 1
+
+# fetch_many merges reads of entries that are at most FETCH_MAX_GAP bytes
+# apart into reads of up to FETCH_MAX_READ bytes and keeps at most
+# FETCH_WINDOW bytes in flight.
+FETCH_MAX_GAP = 64 * 1024
+FETCH_MAX_READ = 8 * 1024 * 1024
+FETCH_WINDOW = 64 * 1024 * 1024
+
+# bundle files up to this size are read into memory in one go
+BUNDLE_READ_SIZE = 16 * 1024 * 1024
+
+# sizes of the values that can be skipped without looking at them
+_fixed_value_sizes = {0: 0, 5: 8, 6: 1, 8: 4, 9: 8, 15: 16, 16: 20}
+
+# header of an entry in a CAS file and the part of a catalog entry after
+# the digest
+_cas_entry_header = struct.Struct('<4s20si4x')
+_cat_entry_tail = struct.Struct('<iii')
 
 
 def generate_one(item):
     yield item
 
 
-class SBException(Exception):
-    pass
+def _instrument_iter(iterator, callback):
+    """Measures the time spent in an iterator (excluding the time the
+    consumer spends) and reports it together with the number of items to
+    the callback once the iterator is exhausted or closed.
+    """
+    seconds = 0.0
+    objects = 0
+    try:
+        while 1:
+            start = timer()
+            try:
+                obj = iterator.next()
+            except StopIteration:
+                break
+            finally:
+                seconds += timer() - start
+            objects += 1
+            yield obj
+    finally:
+        if stats.active is not None:
+            callback(seconds, objects)
 
 
 class CASException(Exception):
@@ -39,26 +114,62 @@ class CASException(Exception):
 class CommonFileAccessMethodsMixin(object):
     """Assumes that give accsess to a file returned by the :meth:`open`
     method of the class.
+
+    Classes using the mixin have to provide a `get_cache_key` method that
+    returns a tuple identifying the contents.  They are cached in the
+    process wide :data:`~libfb2.cache.content_cache` under that key.
+    Parsed contents are cached by default, raw contents only if asked
+    for.
     """
-    _parsed_contents = None
 
-    def get_raw_contents(self):
+    def get_raw_contents(self, cache=False):
+        key = ('raw',) + self.get_cache_key()
+        if cache:
+            rv = content_cache.get(key)
+            if rv is not None:
+                return rv
+        start = timer()
         with self.open() as f:
-            return f.read()
+            rv = f.read()
+        if stats.active is not None:
+            stats.active.add_file(self, timer() - start, length=len(rv))
+        if cache:
+            content_cache.set(key, rv)
+        return rv
 
     def iter_parse_contents(self, selector):
         with self.open() as f:
-            for obj in iterload(f, selector):
+            iterator = iterload(f, selector)
+            if stats.active is not None:
+                iterator = _instrument_iter(iterator, self.add_file_stats)
+            for obj in iterator:
                 yield obj
 
-    def get_parsed_contents(self, cache=True):
-        if self._parsed_contents is not None:
-            return self._parsed_contents
+    def get_parsed_contents(self, cache=True, compact=False):
+        """Parses the contents of the file.  With `cache` disabled the
+        shared cache is bypassed.  The returned tree is shared with other
+        callers if it came from the cache and must not be modified.  If
+        `compact` is enabled the tree is decoded in compact form (see
+        :class:`SBParser`).
+        """
+        key = (compact and 'parsed-compact' or 'parsed',) + \
+            self.get_cache_key()
+        if cache:
+            rv = content_cache.get(key)
+            if rv is not None:
+                return rv
+        start = timer()
         with self.open() as f:
-            rv = load(f)
-            if cache:
-                self._parsed_contents = rv
-            return rv
+            rv = load(f, compact=compact)
+        if stats.active is not None:
+            stats.active.add_file(self, timer() - start,
+                                  stats.count_objects(rv), self.size)
+        if cache and rv is not None:
+            content_cache.set(key, rv, estimate_size(rv))
+        return rv
+
+    def add_file_stats(self, seconds, objects):
+        stats.active.add_file(self, seconds, objects)
 
 
 class BundleFile(CommonFileAccessMethodsMixin):
@@ -76,42 +187,249 @@ class BundleFile(CommonFileAccessMethodsMixin):
         for chunk in meta['chunks']:
             yield chunk['id'], self.bundle.cat.get_file(chunk['sha1'].hex)
 
+    def iter_chunk_contents(self, **options):
+        """Reads the contents of all chunks of the bundle with
+        :meth:`CASCatalog.fetch_many` and yields ``(id, data)`` tuples in
+        the order the reads complete.  `data` is `None` for chunks that
+        are not in the catalog.  Keyword arguments are forwarded to
+        :meth:`~CASCatalog.fetch_many`.
+        """
+        if self.bundle.cat is None:
+            raise RuntimeError('Catalog not loaded')
+        ids_by_sha1 = {}
+        for chunk in self.get_parsed_contents()['chunks']:
+            ids_by_sha1.setdefault(chunk['sha1'], []).append(chunk['id'])
+        for sha1, data in self.bundle.cat.fetch_many(ids_by_sha1, **options):
+            for id in ids_by_sha1[sha1]:
+                yield id, data
+
+    def get_cache_key(self):
+        return ('bundle', os.path.abspath(self.bundle.sb_filename),
+                self.offset, self.size)
+
+    def read_at(self, offset, length):
+        """Positional read from the superbundle's .sb file."""
+        return self.bundle.pool.pread(self.bundle.sb_filename, offset, length)
+
     def open(self):
-        f = open(self.bundle.basename + '.sb', 'rb')
-        f.seek(self.offset)
-        return TypeReader(f, self.size)
+        """Opens the bundle file for reading.  Bundles up to
+        `BUNDLE_READ_SIZE` bytes are read with a single positional read
+        and decoded from memory.
+        """
+        if self.size <= BUNDLE_READ_SIZE:
+            data = self.read_at(self.offset, self.size)
+            if len(data) != self.size:
+                raise SBException('Unexpected end of superbundle')
+            rv = MMapTypeReader(data)
+        else:
+            rv = BufferedTypeReader(PositionalTypeReader(
+                self.read_at, self.offset, self.size))
+        rv.name = repr(self)
+        return rv
 
     def __repr__(self):
         return '<BundleFile %r>' % self.id
 
 
 class SBParser(object):
-    """Parses SB/Superbundle files.  Each value read is put on on a stack
-    temporarily until something else consumes it.  Even things such as
-    dictionary keys end up on there temporarily to aid debugging.
+    """Parses SB/Superbundle files.  Full documents are decoded by
+    :meth:`parse` which builds lists and dicts directly by dispatching on
+    the typecode.  :meth:`iterparse` walks the document with a compiled
+    selector and skips everything that cannot match.
+
+    For selector functions there is also an event based parser where each
+    value read is put on on a stack temporarily until something else
+    consumes it.  Even things such as dictionary keys end up on there
+    temporarily to aid debugging.
+
+    If `lazy_blobs` is enabled blobs are returned as
+    :class:`~libfb2.types.LazyBlob` objects that read the data from the
+    reader on demand instead of :class:`~libfb2.types.Blob` objects.  The
+    `name` is used to group the parser in :mod:`libfb2.stats`.
+
+    With `compact` enabled the decoded tree uses less memory: dict keys
+    are interned, dicts in lists become :class:`~libfb2.types.Record`
+    objects which share their keys per type and checksums and UUIDs are
+    stored as :class:`~libfb2.types.CompactSHA1` and
+    :class:`~libfb2.types.CompactUUID` strings.
 
     Instead of using this use :meth:`load`, :meth:`loads`, :meth:`iterload`
     and :meth:`iterloads`.
     """
 
-    def __init__(self, reader):
+    def __init__(self, reader, lazy_blobs=False, name='SBParser',
+                 compact=False):
         self.reader = reader
+        self.lazy_blobs = lazy_blobs
+        self.name = name
+        self.compact = compact
+        self._value_readers = self.make_value_readers()
 
     def parse(self):
         """Parse a single object from the reader."""
-        gen = self.read_object()
-        rv = self.make_object(gen)
-        try:
-            gen.next()
-        except StopIteration:
-            return rv
-        raise RuntimeError('Garbage left in stream')
+        if stats.active is None:
+            return self.read_value()
+        start = timer()
+        rv = self.read_value()
+        stats.active.add_parse(self.name, timer() - start,
+                               stats.count_objects(rv))
+        self.reader.count_consumed()
+        return rv
+
+    def make_value_readers(self):
+        """Creates the typecode dispatch table for :meth:`read_value`."""
+        reader = self.reader
+        rv = [None] * 32
+        rv[0] = lambda: None
+        rv[1] = self._read_list_value
+        rv[2] = self._read_dict_value
+        rv[5] = lambda: Unknown(5, reader.read(8))
+        rv[6] = lambda: bool(reader.read_byte())
+        rv[7] = reader.read_bstring
+        rv[8] = lambda: reader.read_sst('l')
+        rv[9] = lambda: reader.read_sst('q')
+        rv[15] = lambda: UUID(bytes=reader.read(16))
+        rv[16] = lambda: SHA1(reader.read(20))
+        if self.lazy_blobs:
+            rv[19] = self._read_lazy_blob
+        else:
+            rv[19] = lambda: Blob(reader.read(reader.read_varint()))
+        if self.compact:
+            rv[1] = self._read_compact_list_value
+            rv[2] = self._read_compact_dict_value
+            rv[15] = lambda: CompactUUID(reader.read(16))
+            rv[16] = lambda: CompactSHA1(reader.read(20))
+        return rv
+
+    def _read_lazy_blob(self):
+        length = self.reader.read_varint()
+        rv = LazyBlob(self.reader, self.reader.tell(), length)
+        self.reader.skip(length)
+        return rv
+
+    def read_value(self, typecode=None):
+        """Reads a single value directly without going through events."""
+        if typecode is None:
+            typecode = self.reader.read_byte()
+        func = self._value_readers[typecode & 0x1f]
+        if func is None:
+            self._fail_typecode(typecode)
+        return func()
+
+    def _fail_typecode(self, typecode):
+        raise SBException('Unknown type marker %x (type=%d)' %
+                          (typecode, typecode & 0x1f))
+
+    def _read_list_value(self):
+        reader = self.reader
+        readers = self._value_readers
+        # We don't need the size_info since the collection is delimited
+        reader.read_varint()
+        rv = []
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            func = readers[typecode & 0x1f]
+            if func is None:
+                self._fail_typecode(typecode)
+            rv.append(func())
+        return rv
+
+    def _read_dict_value(self):
+        reader = self.reader
+        readers = self._value_readers
+        # We don't need the size_info since the collection is delimited
+        reader.read_varint()
+        rv = {}
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            key = reader.read_cstring()
+            func = readers[typecode & 0x1f]
+            if func is None:
+                self._fail_typecode(typecode)
+            rv[key] = func()
+        return rv
+
+    def _read_compact_list_value(self):
+        reader = self.reader
+        readers = self._value_readers
+        read_record = self._read_record_value
+        reader.read_varint()
+        rv = []
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            if typecode & 0x1f == 2:
+                rv.append(read_record())
+                continue
+            func = readers[typecode & 0x1f]
+            if func is None:
+                self._fail_typecode(typecode)
+            rv.append(func())
+        return rv
+
+    def _read_compact_dict_value(self):
+        reader = self.reader
+        readers = self._value_readers
+        reader.read_varint()
+        rv = {}
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            key = intern(reader.read_cstring())
+            func = readers[typecode & 0x1f]
+            if func is None:
+                self._fail_typecode(typecode)
+            rv[key] = func()
+        return rv
+
+    def _read_record_value(self):
+        reader = self.reader
+        readers = self._value_readers
+        reader.read_varint()
+        keys = []
+        values = []
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            keys.append(reader.read_cstring())
+            func = readers[typecode & 0x1f]
+            if func is None:
+                self._fail_typecode(typecode)
+            values.append(func())
+        return make_record(tuple(keys), values)
 
     def iterparse(self, selector=None):
-        """Parses objects that are below one of the selector."""
-        if not callable(selector):
-            selector = self.make_selector_function(selector)
-
+        """Parses objects that are below one of the selector.  Selectors
+        are compiled (see :mod:`libfb2.selector`) so that subtrees which
+        cannot match are skipped without being decoded.  If a function is
+        passed instead it's invoked with the stack of keys for every value
+        in the document.
+        """
+        if callable(selector) and not isinstance(selector, Selector):
+            rv = self.iterparse_events(selector)
+        else:
+            selector = compile_selector(selector)
+            rv = self._iter_selected(selector, selector.initial_state,
+                                     self.reader.read_byte())
+        if stats.active is not None:
+            rv = _instrument_iter(rv, self._add_iterparse_stats)
+        return rv
+
+    def _add_iterparse_stats(self, seconds, objects):
+        stats.active.add_parse(self.name, seconds, objects)
+        self.reader.count_consumed()
+
+    def iterparse_events(self, selector):
+        """Like :meth:`iterparse` but drives a selector function with the
+        events from :meth:`read_object`.
+        """
         iterator = self.read_object()
         stack = []
 
@@ -119,7 +437,9 @@ class SBParser(object):
             event_type, event_value = event
             if event_type in ('list_start', 'dict_start'):
                 if selector(stack):
-                    yield self.make_object(chain([event], iterator))
+                    yield self.make_object(chain([event], iterator),
+                                           bool(stack) and
+                                           isinstance(stack[-1], int))
                 else:
                     stack.append(None)
             elif event_type in ('list_item', 'dict_key'):
@@ -130,37 +450,81 @@ class SBParser(object):
                 yield self.make_object(chain([event], iterator))
 
     def make_selector_function(self, selector):
-        if isinstance(selector, basestring):
-            selector = [x.strip() for x in selector.split(',')]
-        selectors = [self.parse_selector(x) for x in selector]
-        def selector_func(stack):
-            for selector in selectors:
-                if self.selector_matches(selector, stack):
-                    return True
-            return False
-        return selector_func
-
-    def selector_matches(self, selector, stack):
-        if len(stack) != len(selector):
-            return False
-        for stack_part, selector_part in izip(stack, selector):
-            if selector_part is not None and \
-               selector_part != stack_part:
-                return False
-        return True
-
-    def parse_selector(self, selector):
-        test_selector = []
-        for part in selector.split('.'):
-            if part == '*':
-                test_selector.append(None)
-            elif part.isdigit():
-                test_selector.append(int(part))
+        return compile_selector(selector)
+
+    def _read_item_value(self, typecode, in_list):
+        if in_list and self.compact and typecode & 0x1f == 2:
+            return self._read_record_value()
+        return self.read_value(typecode)
+
+    def _iter_selected(self, selector, state, typecode, in_list=False):
+        if selector.accepts(state):
+            yield self._read_item_value(typecode, in_list)
+            return
+        if not state:
+            self.skip_value(typecode)
+            return
+
+        reader = self.reader
+        container = typecode & 0x1f
+        if container not in (1, 2):
+            self.skip_value(typecode)
+            return
+
+        reader.read_varint()
+        idx = 0
+        while 1:
+            typecode = reader.read_byte()
+            if typecode == 0:
+                break
+            if container == 1:
+                key = idx
+                idx += 1
+            else:
+                key = reader.read_cstring()
+            child_state, checks = selector.advance(state, key)
+            if checks:
+                value = self._read_item_value(typecode, container == 1)
+                child_state = selector.apply_checks(child_state, checks, value)
+                for match in selector.iter_matches(value, child_state):
+                    yield match
+            elif child_state:
+                for match in self._iter_selected(selector, child_state,
+                                                 typecode, container == 1):
+                    yield match
             else:
-                test_selector.append(part)
-        return test_selector
+                self.skip_value(typecode)
 
-    def make_object(self, iterator):
+    def skip_value(self, typecode=None):
+        """Skips over a value without decoding it.  Lists, dicts, strings
+        and blobs are skipped by their size prefix.
+        """
+        reader = self.reader
+        if typecode is None:
+            typecode = reader.read_byte()
+        if isinstance(reader, MMapTypeReader):
+            buf, pos, end = reader.get_buffer()
+            reader.seek(skip_buffer_value(buf, pos, end, typecode) - pos, 1)
+            return
+        typecode &= 0x1f
+        size = _fixed_value_sizes.get(typecode)
+        if size is not None:
+            reader.skip(size)
+        elif typecode == 7 or typecode == 19:
+            reader.skip(reader.read_varint())
+        elif typecode == 1 or typecode == 2:
+            # the size info covers the items and the terminator so the
+            # collection is skipped in one go
+            size = reader.read_varint()
+            if size:
+                reader.skip(size - 1)
+            if not size or reader.read_byte() != 0:
+                raise SBException('Collection size does not match its '
+                                  'contents')
+        else:
+            self._fail_typecode(typecode)
+
+    def make_object(self, iterator, in_list=False):
         event_type, event_value = iterator.next()
         if event_type == 'value':
             return event_value
@@ -170,18 +534,22 @@ class SBParser(object):
                 if event[0] == 'list_end':
                     break
                 assert event[0] == 'list_item', 'expected list item'
-                rv.append(self.make_object(iterator))
+                rv.append(self.make_object(iterator, True))
             return rv
         elif event_type == 'dict_start':
-            rv = {}
+            keys = []
+            values = []
             for event in iterator:
                 if event[0] == 'dict_end':
                     break
                 assert event[0] == 'dict_key', 'expected dict key'
-                key = event[1]
-                value = self.make_object(iterator)
-                rv[key] = value
-            return rv
+                keys.append(event[1])
+                values.append(self.make_object(iterator))
+            if not self.compact:
+                return dict(izip(keys, values))
+            if in_list:
+                return make_record(tuple(keys), values)
+            return dict(izip(map(intern, keys), values))
         elif event_type == 'blob_start':
             rv = []
             for event in iterator:
@@ -218,10 +586,8 @@ class SBParser(object):
             yield 'value', self.reader.read_sst('l')
         elif typecode == 9:
             yield 'value', self.reader.read_sst('q')
-        elif typecode == 15:
-            yield 'value', UUID(bytes=self.reader.read(16))
-        elif typecode == 16:
-            yield 'value', SHA1(self.reader.read(20))
+        elif typecode == 15 or typecode == 16:
+            yield 'value', self._value_readers[typecode]()
         elif typecode == 19:
             for event in self.read_blob():
                 yield event
@@ -271,6 +637,39 @@ class SBParser(object):
         yield 'blob_end', None
 
 
+def skip_buffer_value(buf, pos, end, typecode):
+    """Skips over a value in a buffer starting at `pos` after the typecode
+    and returns the position after the value.  This is the fast path of
+    :meth:`SBParser.skip_value` for memory mapped readers.
+    """
+    code = typecode & 0x1f
+    size = _fixed_value_sizes.get(code)
+    if size is not None:
+        pos += size
+    elif code in (1, 2, 7, 19):
+        length = 0
+        shift = 0
+        while 1:
+            if pos >= end:
+                raise ValueError('Unexpected end of file')
+            byte = ord(buf[pos])
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            if not byte >> 7:
+                break
+            shift += 7
+        pos += length
+        if (code == 1 or code == 2) and pos <= end and \
+           (not length or buf[pos - 1] != '\x00'):
+            raise SBException('Collection size does not match its contents')
+    else:
+        raise SBException('Unknown type marker %x (type=%d)' %
+                          (typecode, code))
+    if pos > end:
+        raise ValueError('Unexpected end of file')
+    return pos
+
+
 class Bundle(object):
     """Gives access to a SB and SB bundle.  Pass it the basename
     (for instance UI, Weapons etc.) and it will add .toc for the SB
@@ -278,17 +677,51 @@ class Bundle(object):
 
     :attr:`files` gives access to all files by id in a sanish way.
     The contents of those files are not yet parsed.
+
+    Only the table of bundles is read from the TOC up front, the rest of
+    it is decoded when :attr:`root` is accessed.  If an
+    :class:`~libfb2.cache.IndexCache` is passed (or the catalog has one)
+    the table is loaded from there.  All bundle files share the pooled
+    handle of the .sb file (`pool` or the pool of the catalog if there is
+    one).  If neither is given the bundle opens its own pool which is
+    closed by :meth:`close`, at the end of a ``with`` block or when the
+    bundle is garbage collected.
     """
 
-    def __init__(self, basename, cat=None):
+    def __init__(self, basename, cat=None, index_cache=None, pool=None):
         self.basename = basename
+        self.sb_filename = basename + '.sb'
         self.cat = cat
+        if index_cache is None and cat is not None:
+            index_cache = cat.index_cache
+        self.index_cache = index_cache
+        self._owns_pool = pool is None and cat is None
+        if pool is None:
+            pool = cat is not None and cat.pool or FilePool(1)
+        self.pool = pool
         self.bundle_files = {}
-        self.root = load(basename + '.toc')
-
-        for bundle in self.root['bundles']:
-            if 'size' in bundle and 'offset' in bundle:
-                self.bundle_files[bundle['id']] = BundleFile(self, **bundle)
+        self._root = None
+
+        toc_filename = basename + '.toc'
+        table = None
+        if index_cache is not None:
+            table = index_cache.load_toc(toc_filename)
+        if table is None:
+            table = [(bundle['id'], bundle['offset'], bundle['size'])
+                     for bundle in iterload(toc_filename, 'bundles.*')
+                     if 'size' in bundle and 'offset' in bundle]
+            if index_cache is not None:
+                index_cache.store_toc(toc_filename, table)
+
+        for id, offset, size in table:
+            self.bundle_files[id] = BundleFile(self, id, offset, size)
+
+    @property
+    def root(self):
+        """The decoded TOC."""
+        if self._root is None:
+            self._root = load(self.basename + '.toc')
+        return self._root
 
     def list_files(self):
         """Lists all files in the bundle."""
@@ -302,23 +735,85 @@ class Bundle(object):
         """Opens a file by id."""
         return self.bundle_files.get(id)
 
+    def close(self):
+        """Closes the handle of the .sb file unless the pool is shared
+        with a catalog or was passed in.
+        """
+        if self._owns_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _iter_buffer_cas_entries(buf):
+    pos = 0
+    end = len(buf)
+    unpack_from = _cas_entry_header.unpack_from
+    while pos < end:
+        if pos + CAS_ENTRY_HEADER_SIZE > end:
+            raise CASException('Truncated entry header at %d' % pos)
+        magic, digest, size = unpack_from(buf, pos)
+        if magic != CAS_HEADER:
+            raise CASException('Expected cas header at %d, got %r' %
+                               (pos, magic))
+        pos += CAS_ENTRY_HEADER_SIZE
+        if size < 0 or pos + size > end:
+            raise CASException('Truncated entry at %d' % pos)
+        yield digest, pos, size
+        pos += size
+
+
+def _iter_stream_cas_entries(f):
+    reader = BufferedTypeReader(f, window=CAS_SCAN_WINDOW)
+    while not reader.eof:
+        pos = reader.tell()
+        header = reader.read(CAS_ENTRY_HEADER_SIZE)
+        if len(header) != CAS_ENTRY_HEADER_SIZE:
+            raise CASException('Truncated entry header at %d' % pos)
+        magic, digest, size = _cas_entry_header.unpack(header)
+        if magic != CAS_HEADER:
+            raise CASException('Expected cas header at %d, got %r' %
+                               (pos, magic))
+        offset = reader.tell()
+        try:
+            if size < 0:
+                raise ValueError()
+            reader.skip(size)
+        except ValueError:
+            raise CASException('Truncated entry at %d' % offset)
+        yield digest, offset, size
+
+
+def iter_cas_entries(fp_or_filename):
+    """Iterates over all entries of a CAS file as ``(digest, offset,
+    size)`` tuples where `digest` is the raw digest and `offset` is the
+    offset of the payload.  Only the entry headers are read, real files
+    are memory mapped and everything else is read sequentially.
+    """
+    with open_fp_or_filename(fp_or_filename) as f:
+        buf = open_mmap(f)
+        if buf is None:
+            for entry in _iter_stream_cas_entries(f):
+                yield entry
+            return
+        try:
+            for entry in _iter_buffer_cas_entries(buf):
+                yield entry
+        finally:
+            buf.close()
+
 
 def iter_cas_file(fp_or_filename):
-    """Iterates over all files in a CAS."""
+    """Iterates over all files in a CAS.  The files can be read as long
+    as the file is open.
+    """
     with open_fp_or_filename(fp_or_filename) as f:
-        reader = TypeReader(f)
-        while 1:
-            header = self.read(4)
-            if not header:
-                break
-            if header != CAS_HEADER:
-                raise ValueError('Expected cas header, got %r' % header)
-            sha1 = SHA1(self.read(20))
-            data_length = self.read_sst('i')
-            padding = self.read(4)
-            rv = CASFile(sha1, self._fp.tell(), data_length, fp=self._fp)
-            self._fp.seek(data_length, 1)
-            yield rv
+        for digest, offset, size in iter_cas_entries(f):
+            yield CASFile(SHA1(digest), offset, size, fp=f)
 
 
 class CASFile(CommonFileAccessMethodsMixin):
@@ -333,53 +828,635 @@ class CASFile(CommonFileAccessMethodsMixin):
         self.cas_num = cas_num
         self.cat = cat
 
-    def open(self):
+    def read_at(self, offset, length):
+        """Positional read from the CAS file this file is located in."""
         if self.fp is not None:
-            f = os.fdopen(os.dup(self.fp.fileno()))
+            return pread(self.fp.fileno(), offset, length)
+        return self.cat.pool.pread(self.cat.get_cas_filename(self.cas_num),
+                                   offset, length)
+
+    def should_verify(self, verify):
+        if verify is None:
+            return self.cat is not None and self.cat.verify_reads
+        return verify
+
+    def check_contents(self, data):
+        """Raises a :exc:`CASException` if the SHA1 of `data` does not
+        match the checksum of the file.
+        """
+        if sha1_hash(data).digest() != self.sha1.bytes:
+            raise CASException('Checksum mismatch for %s' % self.sha1.hex)
+
+    def open(self, verify=None):
+        """Opens the file for reading.  This is safe to call from multiple
+        threads as the reader does not share a file position.  Reads are
+        buffered so that small reads do not turn into system calls.
+
+        If `verify` is enabled (or it's `None` and the catalog was opened
+        with `verify_reads`) the whole file is read and checked against
+        its SHA1 first.
+        """
+        if self.should_verify(verify):
+            rv = MMapTypeReader(self.read_bytes(True))
         else:
-            f = self.cat.open_cas(self.cas_num)
-        f.seek(self.offset)
-        return TypeReader(f, self.size)
+            rv = BufferedTypeReader(PositionalTypeReader(
+                self.read_at, self.offset, self.size))
+        rv.name = repr(self)
+        return rv
+
+    def read_bytes(self, verify=None):
+        """Reads the whole contents of the file.  `verify` works like for
+        :meth:`open`.
+        """
+        rv = self.read_at(self.offset, self.size)
+        if len(rv) != self.size:
+            raise CASException('Unexpected end of CAS file')
+        if self.should_verify(verify):
+            self.check_contents(rv)
+        return rv
+
+    def get_cache_key(self):
+        # files are content addressed so the same file reached through
+        # another catalog or CAS shares the entry
+        return ('cas', self.sha1.bytes)
+
+    def get_raw_contents(self, cache=False):
+        key = ('raw',) + self.get_cache_key()
+        if cache:
+            rv = content_cache.get(key)
+            if rv is not None:
+                return rv
+        start = timer()
+        rv = self.read_bytes()
+        if stats.active is not None:
+            stats.active.add_file(self, timer() - start, length=len(rv))
+        if cache:
+            content_cache.set(key, rv)
+        return rv
 
     def __repr__(self):
         return '<CASFile %r>' % self.sha1.hex
 
 
+class PackedDigests(object):
+    """Sequence view over sorted, packed 20 byte digests in a string or
+    in a region of a buffer such as a memory mapped file that starts at
+    `offset` and is `size` bytes long.  :meth:`find` looks digests up
+    without unpacking them: a table with the first index of every two
+    byte prefix narrows the search down to a bucket of a few entries
+    which is then searched in the buffer.
+    """
+    __slots__ = ('data', 'offset', '_count', '_buckets')
+
+    def __init__(self, data, offset=0, size=None):
+        if size is None:
+            size = len(data) - offset
+        self.data = data
+        self.offset = offset
+        self._count = size // 20
+        self._buckets = None
+
+    def _make_buckets(self):
+        # within the run of a leading byte the second bytes are sorted
+        # too so both levels are binary searched on strided slices
+        data = self.data
+        base = self.offset
+        leading = data[base:base + self._count * 20:20]
+        starts = [bisect_left(leading, chr(x)) for x in xrange(256)]
+        starts.append(self._count)
+        rv = array('i')
+        for x in xrange(256):
+            lo, hi = starts[x], starts[x + 1]
+            second = data[base + lo * 20 + 1:base + hi * 20:20]
+            rv.extend(lo + bisect_left(second, chr(y)) for y in xrange(256))
+        rv.append(self._count)
+        return rv
+
+    def find(self, digest):
+        """Returns the index of a raw digest or `None`."""
+        buckets = self._buckets
+        if buckets is None:
+            buckets = self._buckets = self._make_buckets()
+        prefix = ord(digest[0]) << 8 | ord(digest[1])
+        base = self.offset
+        start = base + buckets[prefix] * 20
+        end = base + buckets[prefix + 1] * 20
+        data = self.data
+        offset = data.find(digest, start, end)
+        # a match that is not aligned spans two entries
+        while offset >= 0 and (offset - base) % 20:
+            offset = data.find(digest, offset + 1, end)
+        if offset >= 0:
+            return (offset - base) // 20
+
+    def tostring(self):
+        """Returns the packed digests as string."""
+        return self.data[self.offset:self.offset + self._count * 20]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        offset = self.offset + idx * 20
+        return self.data[offset:offset + 20]
+
+    def __iter__(self):
+        data = self.data
+        for offset in xrange(self.offset, self.offset + self._count * 20, 20):
+            yield data[offset:offset + 20]
+
+
+class CASCatalogFiles(Mapping):
+    """A lazy mapping view of all files in a catalog by hex digest.
+    :class:`CASFile` objects are only created when accessed.
+    """
+
+    def __init__(self, cat):
+        self.cat = cat
+
+    def __getitem__(self, sha1):
+        rv = self.cat.get_file(sha1)
+        if rv is None:
+            raise KeyError(sha1)
+        return rv
+
+    def __contains__(self, sha1):
+        return self.cat.find_entry(sha1) is not None
+
+    def __iter__(self):
+        for digest in self.cat.digests:
+            yield digest.encode('hex')
+
+    def __len__(self):
+        return len(self.cat.digests)
+
+    def itervalues(self):
+        for idx in xrange(len(self)):
+            yield self.cat.make_file(idx)
+
+    def iteritems(self):
+        for idx, digest in enumerate(self.cat.digests):
+            yield digest.encode('hex'), self.cat.make_file(idx)
+
+
 class CASCatalog(object):
-    """Reads CAT files."""
+    """Reads CAT files.  The entries are stored as columns sorted by digest:
+    :attr:`digests` holds the packed raw digests and :attr:`offsets`,
+    :attr:`sizes` and :attr:`cas_nums` are int32 arrays.  :attr:`files` is
+    a lazy mapping view by hex digest.
+
+    If an :class:`~libfb2.cache.IndexCache` is passed the columns are
+    loaded from there if the catalog did not change.  The cache is also
+    used for superbundles opened through the catalog.
+
+    The CAS files are read through :attr:`pool` which keeps at most
+    `max_open_files` file descriptors open.
+
+    Assets are looked up by name with :meth:`find_assets` through an
+    :class:`~libfb2.index.AssetIndex`.  If none is passed the index in the
+    cache directory is used.
 
-    def __init__(self, filename):
+    With `verify_reads` the contents of files are checked against their
+    SHA1 whenever they are read as a whole or opened.
+    """
+
+    def __init__(self, filename, index_cache=None, max_open_files=16,
+                 asset_index=None, verify_reads=False):
         self.filename = os.path.abspath(filename)
-        self.files = {}
+        self.index_cache = index_cache
+        self.verify_reads = verify_reads
+        self.asset_index = asset_index
+        self._asset_index_updated = False
+        self.pool = FilePool(max_open_files)
+        self.files = CASCatalogFiles(self)
+
+        if index_cache is not None:
+            columns = index_cache.load_catalog(self.filename)
+            if columns is not None:
+                self._set_columns(*columns)
+                return
+
         with open(filename, 'rb') as f:
-            reader = DecryptingTypeReader(f)
-            header = reader.read(len(CAS_CAT_HEADER))
-            if header != CAS_CAT_HEADER:
-                raise ValueError('Not a cas cat file')
-            while not reader.eof:
-                sha1 = SHA1(reader.read(20))
-                offset = reader.read_sst('i')
-                size = reader.read_sst('i')
-                cas_num = reader.read_sst('i')
-                self.files[sha1.hex] = CASFile(sha1, offset, size, cas_num,
-                                               cat=self)
+            reader = make_decrypting_reader(f)
+            try:
+                header = reader.read(len(CAS_CAT_HEADER))
+                if header != CAS_CAT_HEADER:
+                    raise ValueError('Not a cas cat file')
+                self._load_entries(reader.read())
+                if stats.active is not None:
+                    reader.count_consumed()
+            finally:
+                reader.release()
+
+        if index_cache is not None:
+            index_cache.store_catalog(self.filename,
+                                      self.digests.tostring(),
+                                      self.offsets, self.sizes,
+                                      self.cas_nums)
+
+    def _load_entries(self, data):
+        if len(data) % CAS_CAT_ENTRY_SIZE:
+            raise ValueError('Unexpected end of file')
+        records = [data[offset:offset + CAS_CAT_ENTRY_SIZE] for offset
+                   in xrange(0, len(data), CAS_CAT_ENTRY_SIZE)]
+        # stable sort so that for duplicate digests the last entry in the
+        # file wins like it did with a dictionary.
+        records.sort(key=lambda x: x[:20])
+        unique = []
+        for idx, record in enumerate(records):
+            if idx + 1 < len(records) and records[idx + 1][:20] == record[:20]:
+                continue
+            unique.append(record)
+
+        columns = array('i', ''.join(x[20:] for x in unique))
+        if sys.byteorder != 'little':
+            columns.byteswap()
+        self._set_columns(''.join(x[:20] for x in unique), columns[0::3],
+                          columns[1::3], columns[2::3])
+
+    def _set_columns(self, digests, offsets, sizes, cas_nums):
+        if not isinstance(digests, PackedDigests):
+            digests = PackedDigests(digests)
+        self.digests = digests
+        self.offsets = offsets
+        self.sizes = sizes
+        self.cas_nums = cas_nums
+
+    def find_entry(self, sha1):
+        """Returns the index of an entry by raw digest, hex digest or
+        :class:`SHA1` or `None` if the entry does not exist.
+        """
+        if isinstance(sha1, SHA1):
+            sha1 = sha1.bytes
+        elif len(sha1) == 40:
+            try:
+                sha1 = sha1.decode('hex')
+            except (TypeError, ValueError):
+                return None
+        if len(sha1) != 20:
+            return None
+        return self.digests.find(sha1)
+
+    def make_file(self, idx):
+        """Creates the :class:`CASFile` for the entry at an index."""
+        return CASFile(SHA1(self.digests[idx]), self.offsets[idx],
+                       self.sizes[idx], self.cas_nums[idx], cat=self)
 
     def get_file(self, sha1):
-        """Returns a file by its sha1 checksum."""
-        if hasattr(sha1, 'hex'):
-            sha1 = sha1.hex
-        return self.files.get(sha1)
+        """Returns a file by its sha1 checksum.  The checksum can be given as
+        raw digest, hex digest or :class:`SHA1`.
+        """
+        idx = self.find_entry(sha1)
+        if stats.active is not None:
+            stats.active.count_lookup(idx is not None)
+        if idx is not None:
+            return self.make_file(idx)
+
+    def get_cas_filename(self, num):
+        """Returns the filename of a CAS by number."""
+        directory, base = os.path.split(self.filename)
+        filename = '%s_%02d.cas' % (os.path.splitext(base)[0], num)
+        return os.path.join(directory, filename)
+
+    def get_entry_cas_filename(self, idx):
+        """Returns the filename of the CAS the entry at an index is in."""
+        return self.get_cas_filename(self.cas_nums[idx])
+
+    def get_cas_keys(self):
+        """Returns the column that identifies the CAS file of every entry.
+        For plain catalogs these are the CAS numbers.
+        """
+        return self.cas_nums
+
+    def get_catalog_key(self):
+        """Returns a string that changes whenever the catalog changes."""
+        return get_file_key(self.filename)
 
     def open_cas(self, num):
         """Opens a CAS by number.  This is usually not needed to use directly
-        since :meth:`get_file` opens the CAS as necessary.
+        since :meth:`get_file` reads from the CAS through :attr:`pool`.
         """
-        directory, base = os.path.split(self.filename)
-        filename = '%s_%02d.cas' % (os.path.splitext(base)[0], num)
-        full_filename = os.path.join(directory, filename)
+        full_filename = self.get_cas_filename(num)
         if os.path.isfile(full_filename):
             return open(full_filename, 'rb')
 
+    def close(self):
+        """Closes the pooled CAS file handles."""
+        self.pool.close()
+
+    def iter_locality_groups(self, indexes=None, chunk_size=None):
+        """Groups entries by CAS file and sorts them by offset so that each
+        CAS can be read sequentially.  Yields ``(cas_key, indexes)``
+        tuples where `cas_key` is the value from :meth:`get_cas_keys` (the
+        CAS number for plain catalogs).  If `chunk_size` is given the
+        groups are split into runs of at most that many bytes.
+        """
+        if indexes is None:
+            indexes = xrange(len(self.digests))
+        cas_nums = self.get_cas_keys()
+        offsets = self.offsets
+        sizes = self.sizes
+        order = sorted(indexes, key=lambda x: (cas_nums[x], offsets[x]))
+        group = []
+        group_size = 0
+        for idx in order:
+            if group and (cas_nums[idx] != cas_nums[group[0]] or
+                          (chunk_size is not None and
+                           group_size + sizes[idx] > chunk_size)):
+                yield cas_nums[group[0]], group
+                group = []
+                group_size = 0
+            group.append(idx)
+            group_size += sizes[idx]
+        if group:
+            yield cas_nums[group[0]], group
+
+    def extract_all(self, dst, workers=None, progress=None, resume=False,
+                    use_processes=False, indexes=None):
+        """Extracts all files into `dst` as ``hash[0]/hash[:2]/hash``.
+        If `indexes` is given only the entries at these indexes are
+        extracted (for instance the new files from
+        :func:`~libfb2.diff.diff_catalogs`).
+        The entries are grouped by CAS file and extracted in offset order
+        by a pool of `workers` threads (or processes if `use_processes` is
+        set) so that every CAS file is read sequentially.
+
+        `progress` is called as ``progress(files_done, total_files,
+        bytes_done)`` whenever a batch of files finished.  With `resume`
+        files that already exist with the right size are skipped.
+        Returns a dictionary with the number of extracted and skipped
+        files and the bytes written.
+        """
+        if indexes is not None:
+            indexes = list(indexes)
+        jobs_by_cas = {}
+        for cas_num, group in self.iter_locality_groups(
+                indexes, chunk_size=EXTRACT_BATCH_SIZE):
+            entries = [(self.digests[idx].encode('hex'), self.offsets[idx],
+                        self.sizes[idx]) for idx in group]
+            jobs_by_cas.setdefault(cas_num, []).append(
+                (self.get_entry_cas_filename(group[0]), dst, entries,
+                 resume))
+
+        # interleave the CAS files so that concurrent workers are likely
+        # to read from different files.
+        job_lists = [jobs_by_cas[x] for x in sorted(jobs_by_cas)]
+        jobs = [job for batch in izip_longest(*job_lists)
+                for job in batch if job is not None]
+
+        pool_cls = use_processes and Pool or ThreadPool
+        pool = pool_cls(workers)
+        rv = {'files': 0, 'skipped': 0, 'bytes': 0}
+        total = len(indexes if indexes is not None else self.digests)
+        try:
+            for files, skipped, written in pool.imap_unordered(
+                    _extract_entries, jobs):
+                rv['files'] += files
+                rv['skipped'] += skipped
+                rv['bytes'] += written
+                if progress is not None:
+                    progress(rv['files'] + rv['skipped'], total, rv['bytes'])
+        finally:
+            pool.close()
+            pool.join()
+        return rv
+
+    def verify(self, workers=None, checkpoint=None, progress=None,
+               use_processes=True):
+        """Checks that the contents of all files match their SHA1.  The
+        work is split by CAS file and handed to a pool of `workers`
+        processes (or threads if `use_processes` is disabled) which hash
+        the entries in offset order.
+
+        Yields ``(sha1, problem)`` tuples for broken entries as soon as
+        they are found where `problem` is ``'mismatch'`` or ``'missing'``
+        (the CAS file is missing or too short).  `progress` is called as
+        ``progress(files_done, total_files, bytes_done)`` after every
+        batch.
+
+        If a `checkpoint` filename is given finished batches are recorded
+        there and an interrupted run continues where it stopped (problems
+        found before are reported again).  The checkpoint is removed once
+        all entries were checked.
+        """
+        key = 'libfb2-verify:%d:%d:%s' % (VERIFY_CHECKPOINT_VERSION,
+                                         VERIFY_BATCH_SIZE,
+                                         self.get_catalog_key())
+        done = set()
+        if checkpoint is not None:
+            done, problems = _load_verify_checkpoint(checkpoint, key)
+            for hex, problem in problems:
+                yield SHA1(hex.decode('hex')), problem
+
+        total = len(self.digests)
+        files_done = bytes_done = 0
+        jobs_by_cas = {}
+        for cas_num, group in self.iter_locality_groups(
+                chunk_size=VERIFY_BATCH_SIZE):
+            batch = (cas_num, self.offsets[group[0]])
+            if batch in done:
+                files_done += len(group)
+                bytes_done += sum(self.sizes[idx] for idx in group)
+                continue
+            entries = [(self.digests[idx], self.offsets[idx],
+                        self.sizes[idx]) for idx in group]
+            jobs_by_cas.setdefault(cas_num, []).append(
+                (self.get_entry_cas_filename(group[0]), batch, entries))
+        job_lists = [jobs_by_cas[x] for x in sorted(jobs_by_cas)]
+        jobs = [job for batch in izip_longest(*job_lists)
+                for job in batch if job is not None]
+
+        out = None
+        if checkpoint is not None:
+            out = open(checkpoint, done and 'ab' or 'wb')
+            if not done:
+                out.write(key + '\n')
+        pool_cls = use_processes and Pool or ThreadPool
+        pool = pool_cls(workers)
+        finished = False
+        try:
+            for batch, checked, nbytes, bad in pool.imap_unordered(
+                    _verify_entries, jobs):
+                if out is not None:
+                    # the problems of a batch are only accepted on resume
+                    # if the done line of the batch made it to the file
+                    out.write(''.join('bad %d %d %s %s\n' % (
+                        batch + (digest.encode('hex'), problem))
+                        for digest, problem in bad) +
+                        'done %d %d\n' % batch)
+                    out.flush()
+                    os.fsync(out.fileno())
+                files_done += checked
+                bytes_done += nbytes
+                if progress is not None:
+                    progress(files_done, total, bytes_done)
+                for digest, problem in bad:
+                    yield SHA1(digest), problem
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+            if out is not None:
+                out.close()
+                if finished:
+                    os.remove(checkpoint)
+
+    def plan_reads(self, indexes, max_gap=FETCH_MAX_GAP,
+                   max_read=FETCH_MAX_READ):
+        """Groups entries into reads.  Entries are grouped by CAS file and
+        sorted by offset and entries that are at most `max_gap` bytes
+        apart are merged into reads of up to `max_read` bytes (larger
+        entries are read on their own).  Returns a list of ``(start, end,
+        indexes)`` tuples.
+        """
+        offsets = self.offsets
+        sizes = self.sizes
+        rv = []
+        for cas_key, group in self.iter_locality_groups(indexes):
+            run = []
+            start = end = None
+            for idx in group:
+                offset = offsets[idx]
+                entry_end = offset + sizes[idx]
+                if run and (offset - end > max_gap or
+                            max(end, entry_end) - start > max_read):
+                    rv.append((start, end, run))
+                    run = []
+                if not run:
+                    start = offset
+                    end = entry_end
+                run.append(idx)
+                end = max(end, entry_end)
+            if run:
+                rv.append((start, end, run))
+        return rv
+
+    def _read_run(self, run):
+        start, end, indexes = run
+        data = self.make_file(indexes[0]).read_at(start, end - start)
+        if len(data) != end - start:
+            raise CASException('Unexpected end of CAS file')
+        return [(idx, data[self.offsets[idx] - start:
+                           self.offsets[idx] - start + self.sizes[idx]])
+                for idx in indexes]
+
+    def fetch_many(self, sha1s, ordered=False, max_gap=FETCH_MAX_GAP,
+                   window=FETCH_WINDOW, workers=4):
+        """Reads the contents of many files at once.  The checksums can be
+        given in any form :meth:`find_entry` accepts.  Instead of reading
+        every file on its own the reads are planned with
+        :meth:`plan_reads` so that every CAS file is read in offset order
+        with few large reads that are executed by `workers` threads.
+
+        Yields ``(sha1, data)`` tuples in the order the reads complete
+        where `sha1` is the checksum as it was passed and `data` is `None`
+        for files that are not in the catalog.  At most `window` bytes are
+        read ahead of the consumer.  If `ordered` is enabled an ordered
+        dictionary in the order of `sha1s` is returned instead.
+        """
+        keys_by_index = {}
+        missing = []
+        for sha1 in sha1s:
+            idx = self.find_entry(sha1)
+            if stats.active is not None:
+                stats.active.count_lookup(idx is not None)
+            if idx is None:
+                missing.append(sha1)
+            else:
+                keys_by_index.setdefault(idx, []).append(sha1)
+        runs = self.plan_reads(keys_by_index, max_gap)
+        iterator = self._iter_fetch_results(runs, keys_by_index, missing,
+                                            window, workers)
+        if not ordered:
+            return iterator
+        rv = OrderedDict((sha1, None) for sha1 in sha1s)
+        for sha1, data in iterator:
+            rv[sha1] = data
+        return rv
+
+    def _iter_fetch_results(self, runs, keys_by_index, missing, window,
+                            workers):
+        for sha1 in missing:
+            yield sha1, None
+        if workers <= 1:
+            for run in runs:
+                for idx, data in self._read_run(run):
+                    for sha1 in keys_by_index[idx]:
+                        yield sha1, data
+            return
+
+        # plain threads instead of a ThreadPool as shutting down a pool
+        # takes longer than many small fetches
+        tasks = Queue()
+        results = Queue()
+
+        def worker():
+            while 1:
+                run = tasks.get()
+                if run is None:
+                    break
+                try:
+                    results.put((run, self._read_run(run), None))
+                except Exception:
+                    results.put((run, None, sys.exc_info()))
+
+        threads = [threading.Thread(target=worker)
+                   for x in xrange(min(workers, len(runs)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        pending = deque(runs)
+        in_flight = 0
+        active = 0
+        try:
+            while pending or active:
+                # always keep one read going even if it's larger than the
+                # window
+                while pending and (not active or in_flight +
+                                   pending[0][1] - pending[0][0] <= window):
+                    run = pending.popleft()
+                    in_flight += run[1] - run[0]
+                    active += 1
+                    tasks.put(run)
+                run, entries, exc_info = results.get()
+                in_flight -= run[1] - run[0]
+                active -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for idx, data in entries:
+                    for sha1 in keys_by_index[idx]:
+                        yield sha1, data
+        finally:
+            for thread in threads:
+                tasks.put(None)
+
+    def get_asset_index(self):
+        """Returns the asset index of the catalog.  The first call updates
+        the index, superbundles that did not change are not reindexed.
+        """
+        if self.asset_index is None:
+            from .index import AssetIndex
+            self.asset_index = AssetIndex.for_catalog(self)
+        if not self._asset_index_updated:
+            self.asset_index.update()
+            self._asset_index_updated = True
+        return self.asset_index
+
+    def find_assets(self, prefix, kind=None, superbundle=None):
+        """Finds all assets in all superbundles whose name starts with
+        `prefix`.  Returns a list of :class:`~libfb2.index.Asset` tuples
+        sorted by name.  The result can be limited to a kind (``'ebx'``,
+        ``'res'`` or ``'chunk'``) and to a superbundle.
+        """
+        return self.get_asset_index().find(prefix, kind, superbundle)
+
     def open_superbundle(self, name):
         """Opens a superbundle that is relative to the CAS catalog.  This bundle
         has to have a .toc and a .sb file.
@@ -390,35 +1467,354 @@ class CASCatalog(object):
             return Bundle(basename, cat=self)
 
 
+class LayeredCatalog(CASCatalog):
+    """Combines the catalogs of several layers of an install (for
+    instance the patch and the base game) into one catalog.  `catalogs`
+    are :class:`CASCatalog` objects or filenames with the layer that takes
+    precedence first.  If a digest is in more than one layer the entry of
+    the first layer wins.
+
+    The columns of all layers are merged into one set of columns when the
+    catalog is created so a lookup is a single binary search.
+    :attr:`layer_nums` holds the layer of every entry.  Every layer keeps
+    its own file pool for its CAS files.
+    """
+
+    def __init__(self, catalogs, index_cache=None, max_open_files=16,
+                 verify_reads=False):
+        self.layers = []
+        for cat in catalogs:
+            if isinstance(cat, basestring):
+                cat = CASCatalog(cat, index_cache, max_open_files,
+                                 verify_reads=verify_reads)
+            self.layers.append(cat)
+        if not self.layers:
+            raise ValueError('No catalogs given')
+        if len(self.layers) > 255:
+            raise ValueError('Too many layers')
+        self.filename = self.layers[0].filename
+        self.index_cache = index_cache
+        self.verify_reads = verify_reads
+        self.asset_index = None
+        self.pool = self.layers[0].pool
+        self.files = CASCatalogFiles(self)
+        self._merge_layers()
+
+    def _merge_layers(self):
+        # the layer number sorts entries with the same digest by
+        # precedence so the first one of every run is kept
+        record_lists = []
+        for layer_num, cat in enumerate(self.layers):
+            marker = chr(layer_num)
+            pack = _cat_entry_tail.pack
+            record_lists.append([digest + marker + pack(offset, size, cas_num)
+                                 for digest, offset, size, cas_num in
+                                 izip(cat.digests, cat.offsets, cat.sizes,
+                                      cat.cas_nums)])
+        unique = []
+        last = None
+        for record in merge(*record_lists):
+            if record[:20] != last:
+                unique.append(record)
+                last = record[:20]
+
+        columns = array('i', ''.join(x[21:] for x in unique))
+        if sys.byteorder != 'little':
+            columns.byteswap()
+        self._set_columns(''.join(x[:20] for x in unique), columns[0::3],
+                          columns[1::3], columns[2::3])
+        self.layer_nums = array('B', ''.join(x[20] for x in unique))
+        self._cas_keys = array('i', (layer_num << 16 | cas_num for
+                                     layer_num, cas_num in
+                                     izip(self.layer_nums, self.cas_nums)))
+
+    def make_file(self, idx):
+        return CASFile(SHA1(self.digests[idx]), self.offsets[idx],
+                       self.sizes[idx], self.cas_nums[idx],
+                       cat=self.layers[self.layer_nums[idx]])
+
+    def get_cas_filename(self, num, layer=0):
+        """Returns the filename of a CAS of a layer by number."""
+        return self.layers[layer].get_cas_filename(num)
+
+    def get_entry_cas_filename(self, idx):
+        return self.get_cas_filename(self.cas_nums[idx],
+                                     self.layer_nums[idx])
+
+    def get_cas_keys(self):
+        """Returns a column that combines layer and CAS number as
+        ``layer << 16 | cas_num``.
+        """
+        return self._cas_keys
+
+    def get_catalog_key(self):
+        return '|'.join(cat.get_catalog_key() for cat in self.layers)
+
+    def open_cas(self, num, layer=0):
+        return self.layers[layer].open_cas(num)
+
+    def close(self):
+        for cat in self.layers:
+            cat.close()
+
+    def get_asset_index(self):
+        """Returns a :class:`~libfb2.index.LayeredAssetIndex` over the
+        asset indexes of all layers.  Superbundles of a layer hide the
+        ones with the same name in the layers after it.
+        """
+        if self.asset_index is None:
+            from .index import LayeredAssetIndex
+            self.asset_index = LayeredAssetIndex(
+                cat.get_asset_index() for cat in self.layers)
+        return self.asset_index
+
+    def open_superbundle(self, name):
+        """Opens a superbundle from the first layer that has it.  The .sb
+        file is read through the pool of that layer.
+        """
+        for cat in self.layers:
+            basename = os.path.join(os.path.dirname(cat.filename), name)
+            if os.path.isfile(basename + '.toc'):
+                return Bundle(basename, cat=self, pool=cat.pool)
+
+
+def _extract_entries(job):
+    cas_filename, dst, entries, resume = job
+    files = skipped = written = 0
+    fd = os.open(cas_filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        for hex, offset, size in entries:
+            filename = os.path.join(dst, hex[0], hex[:2], hex)
+            if resume and os.path.isfile(filename) and \
+               os.path.getsize(filename) == size:
+                skipped += 1
+                continue
+            directory = os.path.dirname(filename)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+            with open(filename, 'wb') as out:
+                end = offset + size
+                while offset < end:
+                    chunk = pread(fd, offset, min(end - offset,
+                                                  EXTRACT_BLOCK_SIZE))
+                    if not chunk:
+                        raise CASException('Unexpected end of CAS file')
+                    out.write(chunk)
+                    offset += len(chunk)
+            files += 1
+            written += size
+    finally:
+        os.close(fd)
+    return files, skipped, written
+
+
+def find_cas_files(cat_filename):
+    """Returns the ``(cas_num, filename)`` tuples of all CAS files that
+    belong to a catalog (``cas_01.cas`` etc. for ``cas.cat``).  The
+    catalog itself does not have to exist.
+    """
+    directory, base = os.path.split(os.path.abspath(cat_filename))
+    pattern = re.compile(r'^%s_(\d+)\.cas$' %
+                         re.escape(os.path.splitext(base)[0]), re.I)
+    rv = []
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match is not None:
+            rv.append((int(match.group(1)),
+                       os.path.join(directory, filename)))
+    rv.sort()
+    return rv
+
+
+def _scan_cas_file(job):
+    cas_num, filename = job
+    start = timer()
+    pack = _cat_entry_tail.pack
+    entries = ''.join(digest + pack(offset, size, cas_num) for
+                      digest, offset, size in iter_cas_entries(filename))
+    return (cas_num, filename, entries, os.path.getsize(filename),
+            timer() - start)
+
+
+def rebuild_catalog(cat_filename, workers=None, progress=None,
+                    use_processes=True, output=None, force=False):
+    """Rebuilds a catalog from the CAS files next to it so that damaged
+    or missing catalogs can be recovered.  The CAS files are scanned in
+    parallel by a pool of `workers` processes (or threads if
+    `use_processes` is disabled).
+
+    The new catalog is written unencrypted to `output` which defaults to
+    the catalog filename with ``.rebuilt`` appended.  As the CAS files
+    are found by the name of the catalog it has to be moved into place
+    to be opened.  An existing file is only replaced if `force` is
+    enabled and is then kept with ``.bak`` appended.  To recover a
+    missing catalog pass its own filename as `output`.
+
+    `progress` is called as ``progress(cas_filename, entries, bytes,
+    seconds)`` for every scanned CAS file.  Returns a dictionary with the
+    filename written, the number of CAS files and entries, the bytes
+    scanned, the time it took and the throughput.
+    """
+    if output is None:
+        output = cat_filename + '.rebuilt'
+    if os.path.exists(output) and not force:
+        raise CASException('%r already exists, pass force=True to '
+                           'replace it' % output)
+    cas_files = find_cas_files(cat_filename)
+    if not cas_files:
+        raise CASException('No CAS files found for %r' % cat_filename)
+
+    start = timer()
+    pool_cls = use_processes and Pool or ThreadPool
+    pool = pool_cls(workers)
+    results = {}
+    rv = {'filename': output, 'cas_files': len(cas_files), 'entries': 0,
+          'bytes': 0}
+    try:
+        for cas_num, filename, entries, scanned, seconds in \
+                pool.imap_unordered(_scan_cas_file, cas_files):
+            results[cas_num] = entries
+            count = len(entries) // CAS_CAT_ENTRY_SIZE
+            rv['entries'] += count
+            rv['bytes'] += scanned
+            if progress is not None:
+                progress(filename, count, scanned, seconds)
+    finally:
+        pool.close()
+        pool.join()
+
+    # entries of later CAS files win over earlier ones if a digest shows
+    # up more than once, just like in the order the catalog is read.
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CAS_CAT_HEADER)
+            for cas_num in sorted(results):
+                f.write(results[cas_num])
+        if os.path.exists(output):
+            shutil.copy2(output, output + '.bak')
+        rename_over(tmp_filename, output)
+    except:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+    rv['seconds'] = timer() - start
+    rv['mb_per_s'] = rv['seconds'] and \
+        rv['bytes'] / rv['seconds'] / (1024 * 1024) or None
+    return rv
+
+
+def _load_verify_checkpoint(filename, key):
+    """Returns the finished batches and the problems recorded in a
+    verification checkpoint.  Checkpoints of other catalogs or catalog
+    versions are ignored.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            lines = f.read().split('\n')
+    except IOError:
+        return set(), []
+    if lines[0] != key:
+        return set(), []
+    done = set()
+    problems = []
+    # the last line is either empty or was cut off by an interruption
+    for line in lines[1:-1]:
+        parts = line.split()
+        if parts[0] == 'done':
+            done.add((int(parts[1]), int(parts[2])))
+        elif parts[0] == 'bad':
+            problems.append(((int(parts[1]), int(parts[2])),
+                             parts[3], parts[4]))
+    return done, [(hex, problem) for batch, hex, problem in problems
+                  if batch in done]
+
+
+def _verify_entries(job):
+    cas_filename, batch, entries = job
+    bad = []
+    nbytes = 0
+    try:
+        fd = os.open(cas_filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return batch, len(entries), 0, [(x[0], 'missing') for x in entries]
+    try:
+        for digest, offset, size in entries:
+            h = sha1_hash()
+            end = offset + size
+            while offset < end:
+                chunk = pread(fd, offset, min(end - offset,
+                                              EXTRACT_BLOCK_SIZE))
+                if not chunk:
+                    break
+                h.update(chunk)
+                offset += len(chunk)
+            nbytes += size
+            if offset < end:
+                bad.append((digest, 'missing'))
+            elif h.digest() != digest:
+                bad.append((digest, 'mismatch'))
+    finally:
+        os.close(fd)
+    return batch, len(entries), nbytes, bad
+
+
 def decrypt(filename, new_filename=None):
     """Decrypts a file for debugging."""
     if new_filename is None:
         new_filename = filename + '.decrypt'
     with open(new_filename, 'wb') as f:
-        with DecryptingTypeReader(filename) as reader:
-            shutil.copyfileobj(reader, f)
+        with DecryptingTypeReader(open(filename, 'rb')) as reader:
+            while not reader.eof:
+                f.write(reader.read(DECRYPT_BLOCK_SIZE))
 
 
-def loads(string):
+def loads(string, lazy_blobs=False, compact=False):
     """Loads an SB object from a string."""
-    return load(StringIO(string))
+    return SBParser(DecryptingMMapTypeReader(string), lazy_blobs,
+                    compact=compact).parse()
 
 
-def load(fp_or_filename):
-    """Loads an SB object from a file."""
+def load(fp_or_filename, lazy_blobs=False, compact=False):
+    """Loads an SB object from a file.  If `lazy_blobs` is enabled blobs
+    are returned as :class:`~libfb2.types.LazyBlob` objects.  These stay
+    readable after the file was closed if it was memory mapped which is
+    the case for all real files.  With `compact` enabled the tree is
+    decoded in the compact form described in :class:`SBParser`.
+    """
     with open_fp_or_filename(fp_or_filename) as f:
-        reader = DecryptingTypeReader(f)
-        return SBParser(reader).parse()
+        reader = make_decrypting_reader(f)
+        try:
+            return SBParser(reader, lazy_blobs, compact=compact).parse()
+        finally:
+            # lazy blobs keep reading from the mapping
+            if not lazy_blobs and reader is not f:
+                reader.release()
 
 
-def iterloads(string, selector):
+def iterloads(string, selector, lazy_blobs=False, compact=False):
     """Loads SB objects iteratively from from a string that match a selector."""
-    return iterload(StringIO(string), selector)
+    parser = SBParser(DecryptingMMapTypeReader(string), lazy_blobs,
+                      compact=compact)
+    return parser.iterparse(selector)
 
 
-def iterload(fp_or_filename, selector):
+def iterload(fp_or_filename, selector, lazy_blobs=False, compact=False):
     """Loads SB objects iteratively from from a file that match a selector."""
     with open_fp_or_filename(fp_or_filename) as f:
-        reader = DecryptingTypeReader(f)
-        for obj in SBParser(reader).iterparse(selector):
-            yield obj
+        reader = make_decrypting_reader(f)
+        try:
+            parser = SBParser(reader, lazy_blobs, compact=compact)
+            for obj in parser.iterparse(selector):
+                yield obj
+        finally:
+            if not lazy_blobs and reader is not f:
+                reader.release()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.selector
+    ~~~~~~~~~~~~~~~
+
+    Compiled selectors for iterative SB parsing.  A selector is a dotted
+    path into the document where each part can be one of the following:
+
+        ``name``            matches a dictionary key
+        ``42``              matches a list index
+        ``*``               matches any key or index
+        ``**``              matches any number of keys or indexes
+        ``ebx|res``         matches any of the alternatives
+        ``*[name^=foo/]``   matches if the value at that position is a
+                            dictionary and passes the predicate
+
+    Predicates support ``=``, ``!=``, ``^=`` (prefix), ``$=`` (suffix) and
+    ``*=`` (contains) and multiple predicates can be attached to one part.
+    Whitespace around the value is ignored, values can be quoted with
+    single or double quotes (``*[name ^= 'foo bar']``).
+    Multiple selectors can be combined with commas.
+
+    The compiled selector knows which subtrees can never match so the
+    parser can skip them without decoding.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+
+from .types import Record
+
+
+_predicate_re = re.compile(r'^\s*([^\s=!^$*]+)\s*(=|!=|\^=|\$=|\*=)(.*)$')
+
+_predicate_ops = {
+    '=': lambda value, arg: value == arg,
+    '!=': lambda value, arg: value != arg,
+    '^=': lambda value, arg: value.startswith(arg),
+    '$=': lambda value, arg: value.endswith(arg),
+    '*=': lambda value, arg: arg in value,
+}
+
+_transition_cache_size = 4096
+
+
+class SelectorException(Exception):
+    pass
+
+
+def _parse_predicate_arg(arg):
+    arg = arg.strip()
+    if len(arg) >= 2 and arg[0] in '\'"' and arg[-1] == arg[0]:
+        return arg[1:-1]
+    if arg and arg[0] in '\'"':
+        raise SelectorException('Unterminated predicate value %r' % arg)
+    return arg
+
+
+def _value_to_string(value):
+    # checked first as the compact checksums and UUIDs are strings too
+    if hasattr(value, 'hex') and not callable(value.hex):
+        return value.hex
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+class Predicate(object):
+    """A key/value test on a dictionary."""
+
+    def __init__(self, key, op, arg):
+        if op not in _predicate_ops:
+            raise SelectorException('Unknown predicate operator %r' % op)
+        self.key = key
+        self.op = op
+        self.arg = arg
+        self._func = _predicate_ops[op]
+
+    def __call__(self, value):
+        if not isinstance(value, (dict, Record)) or self.key not in value:
+            return self.op == '!='
+        return self._func(_value_to_string(value[self.key]), self.arg)
+
+    def __repr__(self):
+        return '[%s%s%s]' % (self.key, self.op, self.arg)
+
+
+class Step(object):
+    """One part of a selector path."""
+
+    def __init__(self, alternatives, deep=False, predicates=()):
+        self.alternatives = alternatives
+        self.deep = deep
+        self.predicates = tuple(predicates)
+
+    def matches_key(self, key):
+        return self.alternatives is None or key in self.alternatives
+
+    def check(self, value):
+        for predicate in self.predicates:
+            if not predicate(value):
+                return False
+        return True
+
+    def __repr__(self):
+        if self.deep:
+            rv = '**'
+        elif self.alternatives is None:
+            rv = '*'
+        else:
+            rv = '|'.join(map(str, sorted(self.alternatives)))
+        return rv + ''.join(map(repr, self.predicates))
+
+
+def _split_outside_brackets(string, sep):
+    rv = []
+    depth = 0
+    buf = []
+    for char in string:
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        if char == sep and depth == 0:
+            rv.append(''.join(buf))
+            buf = []
+        else:
+            buf.append(char)
+    rv.append(''.join(buf))
+    return rv
+
+
+def parse_step(part):
+    """Parses a single part of a selector into a :class:`Step`."""
+    part = part.strip()
+    bracket = part.find('[')
+    predicates = []
+    if bracket >= 0:
+        rest = part[bracket:]
+        part = part[:bracket].strip()
+        while rest:
+            end = rest.find(']')
+            if not rest.startswith('[') or end < 0:
+                raise SelectorException('Invalid predicate in %r' % rest)
+            match = _predicate_re.match(rest[1:end])
+            if match is None:
+                raise SelectorException('Invalid predicate %r' % rest[:end + 1])
+            key, op, arg = match.groups()
+            predicates.append(Predicate(key, op, _parse_predicate_arg(arg)))
+            rest = rest[end + 1:].strip()
+    if part == '**':
+        if predicates:
+            raise SelectorException('Deep wildcards cannot have predicates')
+        return Step(None, deep=True)
+    if part == '*':
+        return Step(None, predicates=predicates)
+    if not part:
+        raise SelectorException('Empty selector part')
+    alternatives = set()
+    for alternative in part.split('|'):
+        alternative = alternative.strip()
+        if alternative.isdigit():
+            alternative = int(alternative)
+        alternatives.add(alternative)
+    return Step(frozenset(alternatives), predicates=predicates)
+
+
+def parse_pattern(pattern):
+    """Parses a single dotted selector into a list of steps."""
+    return [parse_step(x) for x in _split_outside_brackets(pattern, '.')]
+
+
+class Selector(object):
+    """A compiled selector.  The matcher state for a position in the
+    document is a frozenset of ``(pattern_index, step_index)`` tuples,
+    an empty state means that nothing below that position can match.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [parse_pattern(x) if isinstance(x, basestring)
+                         else x for x in patterns]
+        self._transitions = {}
+        self.initial_state = self._closure(
+            [(idx, 0) for idx in xrange(len(self.patterns))])
+
+    def _closure(self, states):
+        rv = set()
+        pending = list(states)
+        while pending:
+            state = pending.pop()
+            if state in rv:
+                continue
+            rv.add(state)
+            pattern_idx, step_idx = state
+            steps = self.patterns[pattern_idx]
+            if step_idx < len(steps) and steps[step_idx].deep:
+                pending.append((pattern_idx, step_idx + 1))
+        return frozenset(rv)
+
+    def advance(self, state, key):
+        """Advances the state by a key or list index.  Returns a tuple in
+        the form ``(state, checks)`` where `checks` is a tuple of
+        ``(state, step)`` tuples that only become part of the state if the
+        value at the position passes the predicates of the step.
+        """
+        cache_key = (state, key)
+        rv = self._transitions.get(cache_key)
+        if rv is not None:
+            return rv
+
+        unconditional = []
+        conditional = []
+        for pattern_idx, step_idx in state:
+            steps = self.patterns[pattern_idx]
+            if step_idx >= len(steps):
+                continue
+            step = steps[step_idx]
+            if step.deep:
+                unconditional.append((pattern_idx, step_idx))
+            elif step.matches_key(key):
+                if step.predicates:
+                    conditional.append(((pattern_idx, step_idx + 1), step))
+                else:
+                    unconditional.append((pattern_idx, step_idx + 1))
+
+        new_state = self._closure(unconditional)
+        checks = tuple((self._closure([target]), step)
+                       for target, step in conditional
+                       if target not in new_state)
+        rv = (new_state, checks)
+        if len(self._transitions) >= _transition_cache_size:
+            self._transitions.clear()
+        self._transitions[cache_key] = rv
+        return rv
+
+    def apply_checks(self, state, checks, value):
+        """Adds the states of all checks the value passes to the state."""
+        if not checks:
+            return state
+        rv = set(state)
+        for target, step in checks:
+            if step.check(value):
+                rv.update(target)
+        return frozenset(rv)
+
+    def accepts(self, state):
+        """Checks if the state is a full match."""
+        for pattern_idx, step_idx in state:
+            if step_idx == len(self.patterns[pattern_idx]):
+                return True
+        return False
+
+    def iter_matches(self, value, state):
+        """Matches an already decoded value in memory."""
+        if self.accepts(state):
+            yield value
+            return
+        if not state:
+            return
+        if isinstance(value, (dict, Record)):
+            items = value.iteritems()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return
+        for key, child in items:
+            child_state, checks = self.advance(state, key)
+            child_state = self.apply_checks(child_state, checks, child)
+            for match in self.iter_matches(child, child_state):
+                yield match
+
+    def __call__(self, stack):
+        """Checks if a stack of keys matches the selector ignoring the
+        predicates.  This keeps compiled selectors usable wherever the
+        old selector functions were accepted.
+        """
+        state = self.initial_state
+        for key in stack:
+            state, checks = self.advance(state, key)
+            for target, step in checks:
+                state = state | target
+        return self.accepts(state)
+
+    def __repr__(self):
+        return '<Selector %s>' % ', '.join(
+            '.'.join(map(repr, steps)) for steps in self.patterns)
+
+
+def compile_selector(selector):
+    """Compiles a selector string (or a list of selector strings) into a
+    :class:`Selector`.  Compiled selectors are returned unchanged.
+    """
+    if isinstance(selector, Selector):
+        return selector
+    if isinstance(selector, basestring):
+        selector = _split_outside_brackets(selector, ',')
+    return Selector([x.strip() for x in selector])
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.server
+    ~~~~~~~~~~~~~
+
+    A small HTTP server that keeps a catalog and its superbundles open so
+    that tools do not have to pay for opening them separately::
+
+        $ python -m libfb2.server "C:/.../Battlefield 3/Data/cas.cat"
+
+    Endpoints:
+
+    ``/cas/<sha1>``
+        the raw contents of a file, single byte ranges are supported.
+    ``/bundle/<superbundle>/<id>``
+        the decoded contents of a bundle file as JSON.
+    ``/stats``
+        latency and cache counters as JSON.
+
+    Requests are handled by a fixed pool of threads and recently used
+    contents are kept in a byte limited LRU cache.  :class:`AssetClient`
+    talks to the server.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import json
+import base64
+import urllib
+import urllib2
+import argparse
+import threading
+from collections import deque
+from contextlib import closing
+from uuid import UUID
+from timeit import default_timer as timer
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+
+from .sb import CASCatalog, LayeredCatalog, EXTRACT_BLOCK_SIZE
+from .cache import LRUCache
+from .types import Blob, SHA1, Unknown
+
+
+DEFAULT_PORT = 8040
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# files larger than this are streamed and never cached as a whole
+DEFAULT_MAX_ENTRY_SIZE = 16 * 1024 * 1024
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Parses the value of a `Range` header for a file of `size` bytes.
+    Returns ``(start, end)`` with an exclusive end or `None` if the whole
+    file should be sent (no header or one that is not understood, which
+    includes multiple ranges).
+    """
+    if not header:
+        return None
+    match = _range_re.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        start = max(0, size - int(last))
+        end = size
+    else:
+        start = int(first)
+        end = last and min(int(last) + 1, size) or size
+        if end <= start and last:
+            return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def to_json_value(obj):
+    """Converts the values of decoded SB files that JSON does not know."""
+    if isinstance(obj, SHA1):
+        return obj.hex
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, Blob):
+        return {'blob': base64.b64encode(obj.bytes)}
+    if isinstance(obj, Unknown):
+        return {'typecode': obj.code, 'hex': obj.bytes.encode('hex')}
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+class RouteStats(object):
+    """Latency counters of a route.  Percentiles are calculated over the
+    last `window` requests.
+    """
+
+    def __init__(self, window=1024):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, seconds, error=False):
+        self.requests += 1
+        self.errors += error
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.recent.append(seconds)
+
+    def to_dict(self):
+        recent = sorted(self.recent)
+
+        def percentile(value):
+            if recent:
+                idx = min(len(recent) - 1, int(len(recent) * value))
+                return recent[idx] * 1000
+
+        return {'requests': self.requests, 'errors': self.errors,
+                'avg_ms': self.requests and
+                self.seconds / self.requests * 1000 or None,
+                'max_ms': self.max_seconds * 1000,
+                'p50_ms': percentile(0.5),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99)}
+
+
+class AssetRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'libfb2'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        start = timer()
+        path = urllib.unquote(self.path.split('?', 1)[0])
+        route = 'other'
+        error = True
+        try:
+            if path.startswith('/cas/'):
+                route = 'cas'
+                error = self.serve_cas(path[5:], send_body)
+            elif path.startswith('/bundle/'):
+                route = 'bundle'
+                error = self.serve_bundle(path[8:], send_body)
+            elif path == '/stats':
+                route = 'stats'
+                error = self.serve_json(self.server.get_stats(), send_body)
+            else:
+                self.send_error(404)
+        finally:
+            self.server.record(route, timer() - start, error)
+
+    def serve_cas(self, sha1, send_body):
+        file = self.server.cat.get_file(sha1)
+        if file is None:
+            self.send_error(404)
+            return True
+        try:
+            byte_range = parse_range(self.headers.get('Range'), file.size)
+        except RangeNotSatisfiable:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % file.size)
+            self.end_headers()
+            return True
+
+        start, end = byte_range or (0, file.size)
+        self.send_response(byte_range and 206 or 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s"' % file.sha1.hex)
+        if byte_range is not None:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end - 1, file.size))
+        self.end_headers()
+        if send_body:
+            for chunk in self.server.iter_file_contents(file, start, end):
+                self.wfile.write(chunk)
+        return False
+
+    def serve_bundle(self, path, send_body):
+        body = self.server.get_bundle_json(path)
+        if body is None:
+            self.send_error(404)
+            return True
+        return self.send_body(body, 'application/json', send_body)
+
+    def serve_json(self, value, send_body):
+        return self.send_body(json.dumps(value), 'application/json',
+                              send_body)
+
+    def send_body(self, body, mimetype, send_body):
+        self.send_response(200)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+        return False
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class AssetServer(HTTPServer):
+    """Serves the files of a catalog and the bundles of its superbundles.
+    Requests are handled by a pool of `workers` threads, contents are
+    cached up to `cache_size` bytes.  Files larger than `max_entry_size`
+    are streamed from the CAS files instead.
+    """
+
+    def __init__(self, cat, address=('127.0.0.1', DEFAULT_PORT), workers=16,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 max_entry_size=DEFAULT_MAX_ENTRY_SIZE, verbose=False):
+        HTTPServer.__init__(self, address, AssetRequestHandler)
+        self.cat = cat
+        self.cache = LRUCache(cache_size)
+        self.max_entry_size = max_entry_size
+        self.verbose = verbose
+        self.workers = ThreadPool(workers)
+        self.route_stats = {}
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self.workers.apply_async(self._process_request,
+                                 (request, client_address))
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.workers.terminate()
+        self.workers.join()
+
+    def record(self, route, seconds, error=False):
+        with self._lock:
+            stats = self.route_stats.get(route)
+            if stats is None:
+                stats = self.route_stats[route] = RouteStats()
+            stats.add(seconds, error)
+
+    def get_stats(self):
+        with self._lock:
+            routes = dict((key, value.to_dict()) for key, value
+                          in self.route_stats.iteritems())
+        return {'routes': routes, 'cache': self.cache.get_stats(),
+                'superbundles': len(self._bundles),
+                'files': len(self.cat.files)}
+
+    def get_file_contents(self, file):
+        """Returns the whole contents of a file through the cache."""
+        key = ('cas', file.sha1.bytes)
+        rv = self.cache.get(key)
+        if rv is None:
+            rv = file.read_bytes()
+            self.cache.set(key, rv)
+        return rv
+
+    def iter_file_contents(self, file, start, end):
+        """Iterates over the contents of a file from `start` to `end` in
+        chunks.  Files up to :attr:`max_entry_size` are read as a whole
+        and cached.
+        """
+        if file.size <= self.max_entry_size:
+            yield self.get_file_contents(file)[start:end]
+            return
+        while start < end:
+            length = min(end - start, EXTRACT_BLOCK_SIZE)
+            chunk = file.read_at(file.offset + start, length)
+            if not chunk:
+                break
+            yield chunk
+            start += len(chunk)
+
+    def get_superbundle(self, name):
+        with self._lock:
+            rv = self._bundles.get(name)
+        if rv is None:
+            rv = self.cat.open_superbundle(name)
+            if rv is not None:
+                with self._lock:
+                    rv = self._bundles.setdefault(name, rv)
+        return rv
+
+    def find_bundle_file(self, path):
+        """Finds a bundle file by ``superbundle/id``.  Both parts contain
+        slashes so every split is tried.
+        """
+        parts = path.strip('/').split('/')
+        for idx in xrange(1, len(parts)):
+            bundle = self.get_superbundle('/'.join(parts[:idx]))
+            if bundle is not None:
+                rv = bundle.get_file('/'.join(parts[idx:]))
+                if rv is not None:
+                    return rv
+
+    def get_bundle_json(self, path):
+        """Returns the decoded contents of a bundle file as JSON."""
+        key = ('bundle', path)
+        rv = self.cache.get(key)
+        if rv is None:
+            bundle_file = self.find_bundle_file(path)
+            if bundle_file is None:
+                return None
+            rv = json.dumps(bundle_file.get_parsed_contents(cache=False),
+                            default=to_json_value, encoding='latin-1')
+            self.cache.set(key, rv)
+        return rv
+
+
+class AssetClient(object):
+    """A client for the :class:`AssetServer`."""
+
+    def __init__(self, url='http://127.0.0.1:%d/' % DEFAULT_PORT):
+        self.url = url.rstrip('/')
+
+    def _open(self, path, headers=None):
+        request = urllib2.Request(self.url + urllib.quote(path),
+                                  headers=headers or {})
+        try:
+            return urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def get_file(self, sha1, start=None, end=None):
+        """Returns the contents of a file or `None` if it does not exist.
+        `start` and `end` select a range like a slice.
+        """
+        if isinstance(sha1, SHA1):
+            sha1 = sha1.hex
+        headers = {}
+        if start is not None or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (
+                start or 0, end is not None and str(end - 1) or '')
+        response = self._open('/cas/' + sha1, headers)
+        if response is not None:
+            with closing(response):
+                return response.read()
+
+    def get_bundle(self, superbundle, id):
+        """Returns the decoded contents of a bundle file."""
+        response = self._open('/bundle/%s/%s' % (superbundle, id))
+        if response is not None:
+            with closing(response):
+                return json.load(response)
+
+    def get_stats(self):
+        with closing(self._open('/stats')) as response:
+            return json.load(response)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serves the assets of a '
+                                     'catalog over HTTP.')
+    parser.add_argument('catalogs', nargs='+', metavar='CAT',
+                        help='the catalog to serve, if more than one is '
+                        'given the first one takes precedence (patches)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--cache-size', type=int,
+                        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='the size of the content cache in MB')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    options = parser.parse_args(args)
+
+    if len(options.catalogs) == 1:
+        cat = CASCatalog(options.catalogs[0])
+    else:
+        cat = LayeredCatalog(options.catalogs)
+    server = AssetServer(cat, (options.host, options.port), options.workers,
+                         options.cache_size * 1024 * 1024,
+                         verbose=options.verbose)
+    print 'Serving %d files on http://%s:%d/' % ((len(cat.files),) +
+                                                 server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cat.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    libfb2.stats
+    ~~~~~~~~~~~~
+
+    Optional instrumentation of the readers, the parser and the catalog.
+    Nothing is recorded unless a block of work is wrapped in
+    :func:`collect_stats`::
+
+        with collect_stats() as stats:
+            bundle = cat.open_superbundle('Win32/Levels/MP_001/MP_001')
+            ...
+        print stats.render()
+
+    When disabled every hook costs a single global lookup.  For every file
+    (or reader) two things are counted: the read calls that actually
+    went to the file with the bytes they returned, and the bytes that
+    were consumed by decoding.  The latter is counted after every parse
+    and when a reader is closed so the primitives are not instrumented.
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import threading
+from contextlib import contextmanager
+
+from .types import Record
+
+
+#: the :class:`Stats` object that currently collects or `None`
+active = None
+
+
+def count_objects(value):
+    """Counts the values in a decoded SB tree."""
+    if isinstance(value, (dict, Record)):
+        return 1 + sum(count_objects(x) for x in value.itervalues())
+    if isinstance(value, list):
+        return 1 + sum(count_objects(x) for x in value)
+    return 1
+
+
+def get_reader_name(reader):
+    """Returns the name the reads of a reader are counted under: its
+    :attr:`~libfb2.utils.TypeReader.name`, the name of the file it reads
+    from or the class and identity of the reader.
+    """
+    if reader.name is not None:
+        return reader.name
+    name = getattr(getattr(reader, '_fp', None), 'name', None)
+    if isinstance(name, basestring):
+        return name
+    return '<%s at 0x%x>' % (type(reader).__name__, id(reader))
+
+
+class Stats(object):
+    """Collects counters and timings.  All methods are thread safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.readers = {}
+        self.decrypt_calls = 0
+        self.decrypt_bytes = 0
+        self.decrypt_seconds = 0.0
+        self.parsers = {}
+        self.files = {}
+        self.lookup_hits = 0
+        self.lookup_misses = 0
+
+    def _get_reader_counters(self, name):
+        counters = self.readers.get(name)
+        if counters is None:
+            counters = self.readers[name] = {'reads': 0, 'read_bytes': 0,
+                                             'bytes': 0}
+        return counters
+
+    def count_read(self, name, length):
+        """Counts a read call that went to a file and returned `length`
+        bytes.  `name` is the filename or the name of the reader (see
+        :func:`get_reader_name`).
+        """
+        with self._lock:
+            counters = self._get_reader_counters(name)
+            counters['reads'] += 1
+            counters['read_bytes'] += length
+
+    def count_consumed(self, reader, length):
+        """Counts `length` bytes consumed by a reader."""
+        name = get_reader_name(reader)
+        with self._lock:
+            self._get_reader_counters(name)['bytes'] += length
+
+    def add_decrypt(self, length, seconds):
+        with self._lock:
+            self.decrypt_calls += 1
+            self.decrypt_bytes += length
+            self.decrypt_seconds += seconds
+
+    def add_parse(self, name, seconds, objects):
+        """Records a parse run of an SBParser."""
+        with self._lock:
+            counters = self.parsers.get(name)
+            if counters is None:
+                counters = self.parsers[name] = {'parses': 0, 'seconds': 0.0,
+                                                 'objects': 0}
+            counters['parses'] += 1
+            counters['seconds'] += seconds
+            counters['objects'] += objects
+
+    def add_file(self, file, seconds, objects=0, length=0):
+        """Records work done on a bundle file or CAS file."""
+        key = repr(file)
+        with self._lock:
+            counters = self.files.get(key)
+            if counters is None:
+                counters = self.files[key] = {'accesses': 0, 'seconds': 0.0,
+                                              'objects': 0, 'bytes': 0}
+            counters['accesses'] += 1
+            counters['seconds'] += seconds
+            counters['objects'] += objects
+            counters['bytes'] += length
+
+    def count_lookup(self, hit):
+        """Counts a catalog lookup."""
+        with self._lock:
+            if hit:
+                self.lookup_hits += 1
+            else:
+                self.lookup_misses += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'readers': dict((k, dict(v)) for k, v in
+                                self.readers.iteritems()),
+                'decrypt': {'calls': self.decrypt_calls,
+                            'bytes': self.decrypt_bytes,
+                            'seconds': self.decrypt_seconds},
+                'parsers': dict((k, dict(v)) for k, v in
+                                self.parsers.iteritems()),
+                'files': dict((k, dict(v)) for k, v in
+                              self.files.iteritems()),
+                'lookups': {'hits': self.lookup_hits,
+                            'misses': self.lookup_misses},
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def render(self, max_files=20):
+        """Renders a human readable report."""
+        data = self.to_dict()
+        readers = sorted(data['readers'].iteritems(),
+                         key=lambda x: (-x[1]['reads'], -x[1]['bytes']))
+        rv = ['Readers (%d, most reads first):' % len(readers)]
+        for name, counters in readers[:max_files]:
+            rv.append('  %-50s %8d reads %12d read %12d consumed' % (
+                name[:50], counters['reads'], counters['read_bytes'],
+                counters['bytes']))
+        rv.append('Decryption: %d calls, %d bytes, %.3fs' % (
+            self.decrypt_calls, self.decrypt_bytes, self.decrypt_seconds))
+        rv.append('Parsers:')
+        for name, counters in sorted(data['parsers'].iteritems()):
+            rv.append('  %-28s %6d parses %10d objects %9.3fs' % (
+                name, counters['parses'], counters['objects'],
+                counters['seconds']))
+        files = sorted(data['files'].iteritems(),
+                       key=lambda x: -x[1]['seconds'])
+        rv.append('Files (%d, slowest first):' % len(files))
+        for name, counters in files[:max_files]:
+            rv.append('  %-50s %4d x %10d objects %12d bytes %9.3fs' % (
+                name[:50], counters['accesses'], counters['objects'],
+                counters['bytes'], counters['seconds']))
+        rv.append('Catalog lookups: %d hits, %d misses' % (
+            self.lookup_hits, self.lookup_misses))
+        return '\n'.join(rv)
+
+
+@contextmanager
+def collect_stats(stats=None):
+    """Enables the instrumentation for the duration of the block and
+    yields the :class:`Stats` object the data is collected in.
+    """
+    global active
+    if stats is None:
+        stats = Stats()
+    old = active
+    active = stats
+    try:
+        yield stats
+    finally:
+        active = old
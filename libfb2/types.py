@@ -8,6 +8,17 @@
     :copyright: (c) Copyright 2011 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+import re
+import threading
+from collections import Mapping
+from uuid import UUID
+
+
+# record types are only created for keys that can be slot names
+_record_key_re = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+#: dicts with more keys than this stay dicts in compact mode
+MAX_RECORD_FIELDS = 32
 
 
 class PrimitiveWrapper(object):
@@ -57,6 +68,51 @@ class Blob(BytesPrimitiveWrapper):
     __slots__ = ()
 
 
+class LazyBlob(object):
+    """Represents a blob that was not read yet.  It remembers the reader
+    it came from together with the offset and length and reads (and
+    decrypts) the data on demand.  The reader has to stay usable for that
+    which is the case for memory mapped files and positional readers.
+    """
+    __slots__ = ('source', 'offset', 'length')
+
+    def __init__(self, source, offset, length):
+        self.source = source
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        """Reads the whole blob."""
+        return self.source.read_at(self.offset, self.length)
+
+    def memoryview(self):
+        """Returns the blob as memory view.  For memory mapped sources this
+        does not copy the data.
+        """
+        return self.source.view_at(self.offset, self.length)
+
+    def iter_chunks(self, chunk_size=65536):
+        """Iterates over the blob in chunks."""
+        offset = self.offset
+        end = offset + self.length
+        while offset < end:
+            chunk = self.source.read_at(offset, min(chunk_size, end - offset))
+            if not chunk:
+                raise ValueError('Unexpected end of file')
+            yield chunk
+            offset += len(chunk)
+
+    def to_blob(self):
+        """Reads the data into a :class:`Blob`."""
+        return Blob(self.read())
+
+    def __repr__(self):
+        return '<LazyBlob offset=%d length=%d>' % (self.offset, self.length)
+
+
 class SHA1(BytesPrimitiveWrapper):
     """SHA1 hashes are used for content hashes as it seems."""
     __slots__ = ()
@@ -78,3 +134,170 @@ class Unknown(BytesPrimitiveWrapper):
     def __init__(self, code, bytes):
         self.code = code
         self.bytes = bytes
+
+
+class CompactSHA1(str):
+    """The compact form of :class:`SHA1` used by the compact decoding
+    mode.  It is the raw 20 byte digest itself so it can be used directly
+    wherever raw digests are accepted.  The hex form is computed on
+    access.
+    """
+    __slots__ = ()
+
+    @property
+    def bytes(self):
+        return str.__str__(self)
+
+    @property
+    def hex(self):
+        return self.encode('hex')
+
+    def to_sha1(self):
+        return SHA1(self.bytes)
+
+    def __repr__(self):
+        return '<CompactSHA1 %s>' % self.hex
+
+
+class CompactUUID(str):
+    """The compact form of a :class:`uuid.UUID` used by the compact
+    decoding mode.  It is the 16 raw bytes but converts to the usual
+    string form with :func:`str`.
+    """
+    __slots__ = ()
+
+    @property
+    def bytes(self):
+        return str.__str__(self)
+
+    @property
+    def hex(self):
+        return self.encode('hex')
+
+    def to_uuid(self):
+        return UUID(bytes=self.bytes)
+
+    def __str__(self):
+        return str(self.to_uuid())
+
+    def __repr__(self):
+        return '<CompactUUID %s>' % self
+
+
+class Record(object):
+    """Base class of the record types the compact decoding mode uses for
+    dicts in lists.  Records store their values in slots and share the
+    keys with all records of the same type.  They are read-only mappings
+    and compare equal to dicts with the same items.
+    """
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    _setters = ()
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self._field_set:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, x) for x in self._fields]
+
+    def items(self):
+        return [(x, getattr(self, x)) for x in self._fields]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self._fields:
+            yield getattr(self, key)
+
+    def iteritems(self):
+        for key in self._fields:
+            yield key, getattr(self, key)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other.items())
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        if rv is NotImplemented:
+            return rv
+        return not rv
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return make_record, (self._fields, self.values())
+
+    def __repr__(self):
+        return '<Record %s>' % ', '.join('%s=%r' % x for x in
+                                         self.iteritems())
+
+
+Mapping.register(Record)
+
+_record_types = {}
+_record_types_lock = threading.Lock()
+
+
+def get_record_type(fields):
+    """Returns the :class:`Record` type for a tuple of keys or `None` if
+    the keys cannot be stored in a record.  Types are created once per
+    set of keys and shared by the whole process.
+    """
+    rv = _record_types.get(fields)
+    if rv is not None or fields in _record_types:
+        return rv
+    with _record_types_lock:
+        if fields in _record_types:
+            return _record_types[fields]
+        rv = None
+        if len(fields) <= MAX_RECORD_FIELDS and \
+           len(set(fields)) == len(fields) and \
+           all(_record_key_re.match(x) is not None and
+               not hasattr(Record, x) for x in fields):
+            fields = tuple(intern(x) for x in fields)
+            rv = type('Record', (Record,), {
+                '__slots__': fields,
+                '_fields': fields,
+                '_field_set': frozenset(fields),
+            })
+            rv._setters = tuple(rv.__dict__[x].__set__ for x in fields)
+        _record_types[fields] = rv
+        return rv
+
+
+def make_record(fields, values):
+    """Creates a record from a tuple of keys and a list of values.  Falls
+    back to a dict with interned keys if no record type can be used.
+    """
+    cls = get_record_type(fields)
+    if cls is None:
+        return dict(zip(map(intern, fields), values))
+    rv = cls.__new__(cls)
+    for setter, value in zip(cls._setters, values):
+        setter(rv, value)
+    return rv
@@ -8,11 +8,22 @@
     :copyright: (c) Copyright 2011 by Armin Ronacher, Richard Lacharite, Pilate.
     :license: BSD, see LICENSE for more details.
 """
+import os
+import mmap
 import struct
-from array import array
-from itertools import imap, count
+import threading
+from collections import OrderedDict
+from itertools import count
+from timeit import default_timer as timer
 from contextlib import contextmanager
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import stats
+
 
 DICE_HEADER = '\x00\xd1\xce\x00'
 HASH_OFFSET = 0x08
@@ -22,13 +33,94 @@ MAGIC_SIZE = 257
 MAGIC_XOR = 0x7b
 DATA_OFFSET = 0x022c
 
+# the default read-ahead window of buffered readers
+DEFAULT_WINDOW = 64 * 1024
+
+# reads shorter than this are decrypted byte by byte as setting up the
+# block machinery costs more than it saves.
+SMALL_XOR_SIZE = 64
+
 
 _structcache = {}
+_os_pread = getattr(os, 'pread', None)
+_pread_lock = threading.Lock()
+_xor_tables = [''.join(chr(x ^ key) for x in xrange(256))
+               for key in xrange(256)]
+
+
+class SBException(Exception):
+    pass
+
+
+class XORDecrypter(object):
+    """Block decryption engine for the XOR obfuscation of DICE files.  The
+    257 byte magic is XORed with ``0x7b`` once and then tiled to the read
+    position so that whole buffers can be decrypted in one operation.  If
+    NumPy is available it's used, otherwise every keystream position is
+    decrypted for the whole buffer at once with `str.translate`.
+    """
+
+    def __init__(self, magic):
+        if not isinstance(magic, basestring):
+            magic = ''.join(map(chr, magic))
+        if len(magic) != MAGIC_SIZE:
+            raise ValueError('Magic has to be %d bytes' % MAGIC_SIZE)
+        self.keystream = ''.join(chr(ord(c) ^ MAGIC_XOR) for c in magic)
+        self._key_bytes = map(ord, self.keystream)
+        self._tables = [_xor_tables[x] for x in self._key_bytes]
+        self._tiled = self.keystream
+
+    def get_keystream(self, pos, length):
+        """Returns the keystream for `length` bytes starting at data
+        offset `pos`.
+        """
+        phase = pos % MAGIC_SIZE
+        needed = phase + length
+        if len(self._tiled) < needed:
+            self._tiled = self.keystream * (needed // MAGIC_SIZE + 1)
+        return self._tiled[phase:needed]
+
+    def decrypt(self, data, pos=0):
+        """Decrypts `data` which was located at offset `pos` of the
+        encrypted payload.
+        """
+        if stats.active is None:
+            return self._decrypt(data, pos)
+        start = timer()
+        rv = self._decrypt(data, pos)
+        stats.active.add_decrypt(len(data), timer() - start)
+        return rv
+
+    def _decrypt(self, data, pos):
+        length = len(data)
+        phase = pos % MAGIC_SIZE
+        if length < SMALL_XOR_SIZE:
+            key = self._key_bytes
+            return ''.join([chr(ord(c) ^ key[(phase + idx) % MAGIC_SIZE])
+                            for idx, c in enumerate(data)])
+        if numpy is not None:
+            return numpy.bitwise_xor(
+                numpy.frombuffer(data, dtype=numpy.uint8),
+                numpy.frombuffer(self.get_keystream(pos, length),
+                                 dtype=numpy.uint8)).tostring()
+        tables = self._tables
+        rv = bytearray(length)
+        for idx in xrange(min(length, MAGIC_SIZE)):
+            rv[idx::MAGIC_SIZE] = data[idx::MAGIC_SIZE].translate(
+                tables[(phase + idx) % MAGIC_SIZE])
+        return str(rv)
 
 
 class TypeReader(object):
     """A simple type reader that wraps a Python fd"""
 
+    #: the name the consumed bytes are counted under in
+    #: :mod:`libfb2.stats`.  If not set the name of the file is used.
+    name = None
+
+    # the position up to which consumed bytes were counted
+    _counted_pos = 0
+
     def __init__(self, fp, limit=None):
         self._fp = fp
         self._offset = fp.tell()
@@ -86,11 +178,48 @@ class TypeReader(object):
         else:
             length = min(length, self.limit - self.pos)
         rv = self._fp.read(length)
+        if stats.active is not None:
+            stats.active.count_read(stats.get_reader_name(self), len(rv))
         if len(rv) != length:
             raise ValueError('Unexpected end of file')
         self.pos += length
         return rv
 
+    def read_view(self, length=None):
+        """Like :meth:`read` but readers that can avoid the copy return a
+        memory view instead of a string.
+        """
+        return self.read(length)
+
+    def read_at(self, pos, length):
+        """Reads up to `length` bytes at `pos` without moving the reader.
+        Reads are clamped to the limit of the reader.
+        """
+        length = max(0, min(length, self.limit - pos))
+        current = self._fp.tell()
+        try:
+            self._fp.seek(self._offset + pos)
+            rv = self._fp.read(length)
+        finally:
+            self._fp.seek(current)
+        if stats.active is not None:
+            stats.active.count_read(stats.get_reader_name(self), len(rv))
+        return rv
+
+    def view_at(self, pos, length):
+        """Like :meth:`read_at` but may return a memory view."""
+        return self.read_at(pos, length)
+
+    def skip(self, length):
+        """Skips over `length` bytes."""
+        if self.pos + length > self.limit:
+            raise ValueError('Unexpected end of file')
+        self.seek(length, 1)
+
+    def skip_cstring(self):
+        """Skips over a C string."""
+        self.read_cstring()
+
     def tell(self):
         return self.pos
 
@@ -109,7 +238,26 @@ class TypeReader(object):
         self._fp.seek(self._offset + target, 0)
         self.pos = target
 
+    def count_consumed(self):
+        """Counts the bytes the reader advanced over since the last call
+        in the active :class:`~libfb2.stats.Stats`.  The parsers call this
+        after every parse and readers when they are closed, so the
+        primitives do not pay for the instrumentation.
+        """
+        pos = self.tell()
+        length = pos - self._counted_pos
+        self._counted_pos = pos
+        if length > 0 and stats.active is not None:
+            stats.active.count_consumed(self, length)
+
+    def release(self):
+        """Frees resources the reader holds besides the file object such
+        as memory mappings.  Nothing can be read afterwards.
+        """
+
     def close(self):
+        if stats.active is not None:
+            self.count_consumed()
         self._fp.close()
 
     def __enter__(self):
@@ -127,6 +275,7 @@ class DecryptingTypeReader(TypeReader):
         if header != DICE_HEADER:
             self.hash = None
             self.magic = None
+            self.decrypter = None
             data_offset = 0
         else:
             data_offset = DATA_OFFSET
@@ -141,6 +290,7 @@ class DecryptingTypeReader(TypeReader):
             self.magic = map(ord, fp.read(MAGIC_SIZE))
             if len(self.magic) != MAGIC_SIZE:
                 raise SBException('Magic incomplete')
+            self.decrypter = XORDecrypter(self.magic)
 
         fp.seek(0, 2)
         limit = fp.tell() - data_offset
@@ -150,13 +300,583 @@ class DecryptingTypeReader(TypeReader):
     def read(self, length=None):
         start_pos = self.pos
         rv = super(DecryptingTypeReader, self).read(length)
-        if self.magic is None:
+        if self.decrypter is None:
+            return rv
+        return self.decrypter.decrypt(rv, start_pos)
+
+    def read_at(self, pos, length):
+        rv = super(DecryptingTypeReader, self).read_at(pos, length)
+        if self.decrypter is None:
+            return rv
+        return self.decrypter.decrypt(rv, pos)
+
+
+class MMapTypeReader(TypeReader):
+    """Works like the simple TypeReader but decodes straight from a memory
+    mapped file (or any other buffer such as a string) by offset instead
+    of reading each primitive from a file object.
+    """
+
+    def __init__(self, buf, offset=0, limit=None, fp=None):
+        self._buf = buf
+        self._fp = fp
+        self._offset = offset
+        if limit is None:
+            limit = len(buf) - offset
+        self.limit = limit
+        self.pos = 0
+
+    def read_st(self, typecode, arch='<'):
+        st = get_cached_struct(arch + typecode)
+        pos = self.pos
+        if pos + st.size > self.limit:
+            raise ValueError('Unexpected end of file')
+        self.pos = pos + st.size
+        return st.unpack_from(self._buf, self._offset + pos)
+
+    def read_sst(self, typecode, arch='<'):
+        return self.read_st(typecode, arch)[0]
+
+    def read_varint(self):
+        buf = self._buf
+        offset = self._offset
+        pos = self.pos
+        limit = self.limit
+        rv = 0
+        shift = 0
+        while 1:
+            if pos >= limit:
+                raise ValueError('Unexpected end of file')
+            byte = ord(buf[offset + pos])
+            pos += 1
+            rv |= (byte & 0x7f) << shift
+            if not byte >> 7:
+                break
+            shift += 7
+        self.pos = pos
+        return rv
+
+    def read_byte(self):
+        pos = self.pos
+        if pos >= self.limit:
+            raise ValueError('Unexpected end of file')
+        self.pos = pos + 1
+        return ord(self._buf[self._offset + pos])
+
+    def read_cstring(self):
+        start = self._offset + self.pos
+        end = self._buf.find('\x00', start, self._offset + self.limit)
+        if end < 0:
+            raise ValueError('Unexpected end of file')
+        self.pos = end + 1 - self._offset
+        return self._buf[start:end]
+
+    def skip_cstring(self):
+        end = self._buf.find('\x00', self._offset + self.pos,
+                             self._offset + self.limit)
+        if end < 0:
+            raise ValueError('Unexpected end of file')
+        self.pos = end + 1 - self._offset
+
+    def read(self, length=None):
+        start = self._offset + self.pos
+        if length is None:
+            length = self.limit - self.pos
+        else:
+            length = min(length, self.limit - self.pos)
+        self.pos += length
+        return self._buf[start:start + length]
+
+    def read_at(self, pos, length):
+        start = self._offset + pos
+        return self._buf[start:start + max(0, min(length, self.limit - pos))]
+
+    def view_at(self, pos, length):
+        return make_view(self._buf, self._offset + pos,
+                         max(0, min(length, self.limit - pos)))
+
+    def get_buffer(self):
+        """Returns ``(buffer, position, end)`` with the absolute position
+        of the reader in the underlying buffer.
+        """
+        return self._buf, self._offset + self.pos, self._offset + self.limit
+
+    def read_view(self, length=None):
+        start = self._offset + self.pos
+        if length is None:
+            length = self.limit - self.pos
+        else:
+            length = min(length, self.limit - self.pos)
+        self.pos += length
+        return make_view(self._buf, start, length)
+
+    def seek(self, delta, how=0):
+        if how == 0:
+            target = max(0, min(delta, self.limit))
+        elif how == 1:
+            target = max(0, min(delta + self.pos, self.limit))
+        elif how == 2:
+            target = max(0, min(self.limit - delta, self.limit))
+        else:
+            raise ValueError('Invalid seek method')
+        self.pos = target
+
+    def release(self):
+        # on 2.x mappings keep a duplicate of the file descriptor open
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+    def close(self):
+        if stats.active is not None:
+            self.count_consumed()
+        self.release()
+        if self._fp is not None:
+            self._fp.close()
+
+
+class DecryptingMMapTypeReader(MMapTypeReader):
+    """Works like the :class:`DecryptingTypeReader` but for memory mapped
+    files.  Encrypted payloads are decrypted as a whole with the block
+    engine and then decoded from memory.  If the decrypted `payload` is
+    already known (for instance from the
+    :class:`~libfb2.cache.PayloadCache`) only the header is checked.
+    """
+
+    def __init__(self, buf, fp=None, payload=None):
+        self.hash = None
+        self.magic = None
+        self.decrypter = None
+        if buf[:len(DICE_HEADER)] != DICE_HEADER:
+            MMapTypeReader.__init__(self, buf, fp=fp)
+            return
+
+        hash_end = HASH_OFFSET + HASH_SIZE + 1
+        if buf[HASH_OFFSET:HASH_OFFSET + 1] != 'x':
+            raise SBException('Hash start marker not found')
+        if buf[hash_end:hash_end + 1] != 'x':
+            raise SBException('Hash end marker not found')
+        self.hash = buf[HASH_OFFSET + 1:hash_end]
+        magic = buf[MAGIC_OFFSET:MAGIC_OFFSET + MAGIC_SIZE]
+        if len(magic) != MAGIC_SIZE:
+            raise SBException('Magic incomplete')
+        self.magic = map(ord, magic)
+        self.decrypter = XORDecrypter(magic)
+        if payload is None:
+            payload = self.decrypter.decrypt(buf[DATA_OFFSET:])
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        MMapTypeReader.__init__(self, payload, fp=fp)
+
+
+class PositionalTypeReader(TypeReader):
+    """Works like the simple TypeReader but reads with positional reads
+    through a `read_at(offset, length)` function.  Because it does not
+    share a seek position with anything else multiple readers can be used
+    on the same file from different threads.
+    """
+
+    def __init__(self, read_at, offset, limit):
+        self._read_at = read_at
+        self._offset = offset
+        self.limit = limit
+        self.pos = 0
+
+    def read(self, length=None):
+        if length is None:
+            length = self.limit - self.pos
+        else:
+            length = min(length, self.limit - self.pos)
+        if not length:
+            return ''
+        rv = self._read_at(self._offset + self.pos, length)
+        if len(rv) != length:
+            raise ValueError('Unexpected end of file')
+        self.pos += length
+        return rv
+
+    def read_at(self, pos, length):
+        return self._read_at(self._offset + pos, length)
+
+    def seek(self, delta, how=0):
+        if how == 0:
+            target = max(0, min(delta, self.limit))
+        elif how == 1:
+            target = max(0, min(delta + self.pos, self.limit))
+        elif how == 2:
+            target = max(0, min(self.limit - delta, self.limit))
+        else:
+            raise ValueError('Invalid seek method')
+        self.pos = target
+
+    def close(self):
+        pass
+
+
+class BufferedTypeReader(TypeReader):
+    """Works like the simple TypeReader but reads ahead in windows of
+    `window` bytes and decodes primitives, C strings and varints by
+    scanning the buffer.  If a `decrypter` is given a whole window is
+    decrypted at once.  This also works for streams that cannot seek such
+    as pipes; if the length of those is not known :attr:`limit` is `None`
+    and the end of the stream is the limit.  Seeking backwards outside of
+    the buffer is not possible on such streams.
+
+    `initial` is data that was already read from the stream at the
+    current position (such as a header that was peeked at).
+    """
+
+    def __init__(self, fp, limit=None, window=DEFAULT_WINDOW, decrypter=None,
+                 initial=''):
+        self._fp = fp
+        self.window = window
+        self.decrypter = decrypter
+        self._seekable = is_seekable(fp)
+        if self._seekable:
+            self._offset = fp.tell() - len(initial)
+            if limit is None:
+                fp.seek(0, 2)
+                limit = fp.tell() - self._offset
+                fp.seek(self._offset + len(initial))
+        else:
+            self._offset = 0
+        self.limit = limit
+        self._buf = ''
+        self._buf_pos = 0
+        self._idx = 0
+        if initial:
+            self._buf = self._decrypt(initial[:limit], 0)
+
+    def _get_pos(self):
+        return self._buf_pos + self._idx
+
+    def _set_pos(self, value):
+        self.seek(value)
+
+    pos = property(_get_pos, _set_pos)
+    del _get_pos, _set_pos
+
+    def _decrypt(self, data, pos):
+        if self.decrypter is None:
+            return data
+        return self.decrypter.decrypt(data, pos)
+
+    def _count_read(self, length):
+        # readers below count their own reads
+        if stats.active is not None and not isinstance(self._fp, TypeReader):
+            stats.active.count_read(stats.get_reader_name(self), length)
+
+    def _fill(self, length):
+        """Makes sure that `length` bytes are buffered after the current
+        position.  Returns `False` if the data ends before that.
+        """
+        available = len(self._buf) - self._idx
+        if available >= length:
+            return True
+        chunks = [self._buf[self._idx:]]
+        self._buf_pos += self._idx
+        self._idx = 0
+        end = self._buf_pos + available
+        missing = length - available
+        to_read = max(missing, self.window)
+        if self.limit is not None:
+            to_read = min(to_read, self.limit - end)
+        while missing > 0 and to_read > 0:
+            data = self._fp.read(to_read)
+            self._count_read(len(data))
+            if not data:
+                break
+            chunks.append(self._decrypt(data, end))
+            end += len(data)
+            to_read -= len(data)
+            missing -= len(data)
+        self._buf = ''.join(chunks)
+        return missing <= 0
+
+    @property
+    def eof(self):
+        if self.limit is not None:
+            return self.pos >= self.limit
+        return not self._fill(1)
+
+    def read_st(self, typecode, arch='<'):
+        st = get_cached_struct(arch + typecode)
+        if not self._fill(st.size):
+            raise ValueError('Unexpected end of file')
+        rv = st.unpack_from(self._buf, self._idx)
+        self._idx += st.size
+        return rv
+
+    def read_sst(self, typecode, arch='<'):
+        return self.read_st(typecode, arch)[0]
+
+    def read_byte(self):
+        if self._idx >= len(self._buf) and not self._fill(1):
+            raise ValueError('Unexpected end of file')
+        self._idx += 1
+        return ord(self._buf[self._idx - 1])
+
+    def read_varint(self):
+        rv = 0
+        shift = 0
+        while 1:
+            if self._idx >= len(self._buf) and not self._fill(1):
+                raise ValueError('Unexpected end of file')
+            byte = ord(self._buf[self._idx])
+            self._idx += 1
+            rv |= (byte & 0x7f) << shift
+            if not byte >> 7:
+                return rv
+            shift += 7
+
+    def read_cstring(self):
+        # `scanned` is relative to the current position as filling the
+        # buffer moves the data to the start of it
+        scanned = 0
+        while 1:
+            end = self._buf.find('\x00', self._idx + scanned)
+            if end >= 0:
+                rv = self._buf[self._idx:end]
+                self._idx = end + 1
+                return rv
+            scanned = len(self._buf) - self._idx
+            if not self._fill(scanned + 1):
+                raise ValueError('Unexpected end of file')
+
+    def _read_to_end(self):
+        # the chunks are joined once at the end, growing the buffer for
+        # every window would copy it over and over again
+        chunks = [self._buf[self._idx:]]
+        end = self._buf_pos + len(self._buf)
+        while 1:
+            data = self._fp.read(self.window)
+            self._count_read(len(data))
+            if not data:
+                break
+            chunks.append(self._decrypt(data, end))
+            end += len(data)
+        self._buf = ''
+        self._buf_pos = end
+        self._idx = 0
+        return ''.join(chunks)
+
+    def read(self, length=None):
+        if length is None:
+            if self.limit is None:
+                return self._read_to_end()
+            length = self.limit - self.pos
+        elif self.limit is not None:
+            length = min(length, self.limit - self.pos)
+        if not self._fill(length):
+            if self.limit is not None:
+                raise ValueError('Unexpected end of file')
+            length = len(self._buf) - self._idx
+        rv = self._buf[self._idx:self._idx + length]
+        self._idx += length
+        return rv
+
+    def read_at(self, pos, length):
+        if self.limit is not None:
+            length = max(0, min(length, self.limit - pos))
+        start = pos - self._buf_pos
+        if start >= 0 and start + length <= len(self._buf):
+            return self._buf[start:start + length]
+        if not self._seekable:
+            raise ValueError('Cannot read outside of the buffer of a '
+                             'non-seekable stream')
+        current = self._fp.tell()
+        try:
+            self._fp.seek(self._offset + pos)
+            data = self._fp.read(length)
+        finally:
+            self._fp.seek(current)
+        self._count_read(len(data))
+        return self._decrypt(data, pos)
+
+    def skip(self, length):
+        target = self.pos + length
+        if self.limit is not None and target > self.limit:
+            raise ValueError('Unexpected end of file')
+        self.seek(length, 1)
+        if self.pos != target:
+            raise ValueError('Unexpected end of file')
+
+    def seek(self, delta, how=0):
+        if how == 0:
+            target = delta
+        elif how == 1:
+            target = delta + self.pos
+        elif how == 2:
+            if self.limit is None:
+                raise ValueError('Cannot seek relative to the end of a '
+                                 'stream of unknown length')
+            target = self.limit - delta
+        else:
+            raise ValueError('Invalid seek method')
+        target = max(0, target)
+        if self.limit is not None:
+            target = min(target, self.limit)
+
+        buf_end = self._buf_pos + len(self._buf)
+        if self._buf_pos <= target <= buf_end:
+            self._idx = target - self._buf_pos
+            return
+        if self._seekable:
+            self._fp.seek(self._offset + target)
+        elif target < self._buf_pos:
+            raise ValueError('Cannot seek backwards in a non-seekable '
+                             'stream')
+        else:
+            end = buf_end
+            while end < target:
+                data = self._fp.read(min(target - end, self.window))
+                if not data:
+                    break
+                end += len(data)
+            target = end
+        self._buf = ''
+        self._buf_pos = target
+        self._idx = 0
+
+
+class BufferedDecryptingTypeReader(BufferedTypeReader):
+    """Works like the :class:`DecryptingTypeReader` but on top of the
+    :class:`BufferedTypeReader`.  The header is read sequentially so this
+    works for streams that cannot seek.
+    """
+
+    def __init__(self, fp, window=DEFAULT_WINDOW):
+        header = read_exactly(fp, len(DICE_HEADER))
+        self.hash = None
+        self.magic = None
+        if header != DICE_HEADER:
+            BufferedTypeReader.__init__(self, fp, window=window,
+                                        initial=header)
+            return
+
+        header += read_exactly(fp, DATA_OFFSET - len(header))
+        hash_end = HASH_OFFSET + HASH_SIZE + 1
+        if header[HASH_OFFSET:HASH_OFFSET + 1] != 'x':
+            raise SBException('Hash start marker not found')
+        if header[hash_end:hash_end + 1] != 'x':
+            raise SBException('Hash end marker not found')
+        if len(header) != DATA_OFFSET:
+            raise SBException('Magic incomplete')
+        self.hash = header[HASH_OFFSET + 1:hash_end]
+        magic = header[MAGIC_OFFSET:MAGIC_OFFSET + MAGIC_SIZE]
+        self.magic = map(ord, magic)
+        BufferedTypeReader.__init__(self, fp, window=window,
+                                    decrypter=XORDecrypter(magic))
+
+
+class _PooledFile(object):
+    __slots__ = ('fd', 'refs', 'evicted', 'lock')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.refs = 0
+        self.evicted = False
+        self.lock = threading.Lock()
+
+
+class FilePool(object):
+    """A bounded pool of read-only file descriptors.  The least recently
+    used descriptors are closed when more than `max_handles` files are
+    open, descriptors that are still in use are closed once released.
+    All reads are positional so the pool can be used from many threads.
+    """
+
+    def __init__(self, max_handles=16):
+        if max_handles < 1:
+            raise ValueError('The pool needs at least one handle')
+        self.max_handles = max_handles
+        self.opened = 0
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, filename):
+        """Returns a handle for a file which has to be released with
+        :meth:`release`.
+        """
+        with self._lock:
+            handle = self._handles.pop(filename, None)
+            if handle is None:
+                handle = _PooledFile(os.open(filename, os.O_RDONLY |
+                                             getattr(os, 'O_BINARY', 0)))
+                self.opened += 1
+            handle.refs += 1
+            self._handles[filename] = handle
+            while len(self._handles) > self.max_handles:
+                old = self._handles.popitem(last=False)[1]
+                old.evicted = True
+                if not old.refs:
+                    os.close(old.fd)
+            return handle
+
+    def release(self, handle):
+        with self._lock:
+            handle.refs -= 1
+            if handle.evicted and not handle.refs:
+                os.close(handle.fd)
+
+    def pread(self, filename, offset, length):
+        """Reads `length` bytes at `offset` from a file."""
+        handle = self.acquire(filename)
+        try:
+            rv = pread(handle.fd, offset, length, handle.lock)
+        finally:
+            self.release(handle)
+        if stats.active is not None:
+            stats.active.count_read(filename, len(rv))
+        return rv
+
+    def close(self):
+        """Closes all descriptors that are not in use."""
+        with self._lock:
+            while self._handles:
+                handle = self._handles.popitem()[1]
+                handle.evicted = True
+                if not handle.refs:
+                    os.close(handle.fd)
+
+    def __del__(self):
+        # unlike file objects raw descriptors are not closed when they
+        # are garbage collected
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def pread(fd, offset, length, lock=None):
+    """Reads `length` bytes at `offset` from a file descriptor without
+    changing its position.  Where :func:`os.pread` is not available the
+    descriptor is seeked under `lock` instead.
+    """
+    if _os_pread is not None:
+        rv = _os_pread(fd, length, offset)
+        if len(rv) == length or not rv:
             return rv
-        data = array('c', rv)
-        for off, b in enumerate(imap(ord, data)):
-            i = start_pos + off
-            data[off] = chr(b ^ self.magic[i % MAGIC_SIZE] ^ MAGIC_XOR)
-        return data.tostring()
+        chunks = [rv]
+        read = len(rv)
+        while read < length:
+            chunk = _os_pread(fd, length - read, offset + read)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            read += len(chunk)
+        return ''.join(chunks)
+
+    with lock or _pread_lock:
+        os.lseek(fd, offset, 0)
+        chunks = []
+        read = 0
+        while read < length:
+            chunk = os.read(fd, length - read)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            read += len(chunk)
+        return ''.join(chunks)
 
 
 def get_cached_struct(typecode):
@@ -168,6 +888,92 @@ def get_cached_struct(typecode):
     return rv
 
 
+def make_view(buf, offset, length):
+    """Returns a zero-copy view into a buffer."""
+    try:
+        return memoryview(buf)[offset:offset + length]
+    except TypeError:
+        # mmap objects only support the old buffer interface on 2.x
+        return buffer(buf, offset, length)
+
+
+def open_mmap(fp):
+    """Memory maps the file behind a file object for reading.  If the
+    file object is not backed by a real file (or it cannot be mapped)
+    `None` is returned.
+    """
+    try:
+        fileno = fp.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, OverflowError):
+        return None
+
+
+def is_seekable(fp):
+    """Checks if a file object can seek."""
+    seekable = getattr(fp, 'seekable', None)
+    if seekable is not None:
+        try:
+            return seekable()
+        except ValueError:
+            return False
+    try:
+        fp.seek(fp.tell())
+    except (AttributeError, EnvironmentError, ValueError):
+        return False
+    return True
+
+
+def read_exactly(fp, length):
+    """Reads `length` bytes from a stream that might return less."""
+    chunks = []
+    while length > 0:
+        chunk = fp.read(length)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+
+def make_reader(fp, limit=None):
+    """Creates the best reader for a file object positioned at the start
+    of the data.  Real files are memory mapped, everything else is read
+    through a :class:`BufferedTypeReader`.
+    """
+    buf = open_mmap(fp)
+    if buf is None:
+        return BufferedTypeReader(fp, limit)
+    return MMapTypeReader(buf, fp.tell(), limit, fp=fp)
+
+
+def make_decrypting_reader(fp):
+    """Like :func:`make_reader` but for files that might be encrypted.
+    Readers can be passed as well, memory mapped readers are used directly
+    if they are not encrypted.  The decrypted payloads of encrypted files
+    are cached on disk by the :data:`~libfb2.cache.payload_cache` if it
+    was enabled.
+    """
+    if isinstance(fp, MMapTypeReader):
+        buf, pos, end = fp.get_buffer()
+        if buf[pos:pos + len(DICE_HEADER)] != DICE_HEADER:
+            return fp
+        return DecryptingMMapTypeReader(buf[pos:end])
+    if isinstance(fp, BufferedTypeReader) and fp.decrypter is None and \
+       fp.read_at(fp.pos, len(DICE_HEADER)) != DICE_HEADER:
+        return fp
+    buf = open_mmap(fp)
+    if buf is None:
+        return BufferedDecryptingTypeReader(fp)
+    if buf[:len(DICE_HEADER)] == DICE_HEADER:
+        from .cache import payload_cache
+        return payload_cache.make_reader(buf, fp)
+    return DecryptingMMapTypeReader(buf, fp=fp)
+
+
 @contextmanager
 def open_fp_or_filename(fp_or_filename, mode='rb'):
     if isinstance(fp_or_filename, basestring):
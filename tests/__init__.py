@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    tests
+    ~~~~~
+
+    Tests for libfb2 that run on the synthetic game data from
+    :mod:`benchmarks.generate`::
+
+        $ python -m unittest discover -s tests -t .
+
+    :copyright: (c) Copyright 2011 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Gives every test a fresh temporary directory that is also used as
+    cache directory so that tests never touch the user's caches.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='libfb2-test-')
+        self._old_cache_dir = os.environ.get('LIBFB2_CACHE_DIR')
+        os.environ['LIBFB2_CACHE_DIR'] = os.path.join(self.directory,
+                                                      'cache')
+
+    def tearDown(self):
+        if self._old_cache_dir is None:
+            os.environ.pop('LIBFB2_CACHE_DIR', None)
+        else:
+            os.environ['LIBFB2_CACHE_DIR'] = self._old_cache_dir
+        shutil.rmtree(self.directory)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
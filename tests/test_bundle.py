@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import unittest
+
+from benchmarks import generate
+from libfb2.sb import Bundle, CASCatalog
+from tests import TempDirTestCase
+
+
+def count_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+class BundleTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.basename = self.path('Data', 'Win32', 'MP_001')
+        generate.write_superbundle(self.basename, bundle_count=3,
+                                   ebx_count=10)
+
+    def test_files(self):
+        with Bundle(self.basename) as bundle:
+            files = sorted(bundle.list_files(), key=lambda x: x.id)
+            self.assertEqual(len(files), 3)
+            meta = files[0].get_parsed_contents(cache=False)
+            self.assertEqual(len(meta['ebx']), 10)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'),
+                         'needs /proc/self/fd')
+    def test_no_fd_leak(self):
+        before = count_open_fds()
+        for _ in xrange(50):
+            with Bundle(self.basename) as bundle:
+                for bundle_file in bundle.iter_files():
+                    bundle_file.get_raw_contents()
+        self.assertEqual(count_open_fds(), before)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'),
+                         'needs /proc/self/fd')
+    def test_no_fd_leak_without_close(self):
+        before = count_open_fds()
+        for _ in xrange(50):
+            bundle = Bundle(self.basename)
+            for bundle_file in bundle.iter_files():
+                bundle_file.get_raw_contents()
+        del bundle, bundle_file
+        # bundles and their files reference each other
+        gc.collect()
+        self.assertEqual(count_open_fds(), before)
+
+    def test_catalog_pool_is_not_closed(self):
+        generate.write_catalog(self.path('Data'), file_count=10)
+        cat = CASCatalog(self.path('Data', 'cas.cat'))
+        with Bundle(self.basename, cat=cat) as bundle:
+            bundle.list_files()[0].get_raw_contents()
+        self.assertEqual(len(cat.pool._handles), 1)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+
+from benchmarks import generate
+from libfb2 import sb
+from libfb2 import cache
+from libfb2.cache import PayloadCache
+from tests import TempDirTestCase
+
+
+class PayloadCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.cache = PayloadCache(self.path('payloads'), max_bytes=1000,
+                                  min_size=0)
+
+    def list_payloads(self):
+        return sorted(x for x in os.listdir(self.cache.directory)
+                      if x.endswith('.payload'))
+
+    def test_roundtrip(self):
+        data = generate.dumps(generate.Generator(0).bundle(20))
+        filename = self.path('MP_001.toc')
+        with open(filename, 'wb') as f:
+            f.write(generate.encrypt(data))
+        self.cache.max_bytes = len(data)
+        for _ in xrange(2):
+            with open(filename, 'rb') as f:
+                reader = self.cache.make_reader(sb.open_mmap(f), f)
+                self.assertEqual(reader.read(), data)
+                reader.close()
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 1))
+
+    def test_scans_only_when_over_budget(self):
+        scans = []
+        evict = self.cache.evict
+        def counting_evict():
+            scans.append(1)
+            evict()
+        self.cache.evict = counting_evict
+        for idx in xrange(4):
+            self.cache.store('key-%d' % idx, 'x' * 200)
+        # the first store has to find out how much is cached already
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(len(self.list_payloads()), 4)
+        self.cache.store('key-4', 'x' * 300)
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(len(self.list_payloads()), 4)
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+        self.cache.store('key-5', 'x' * 100)
+        self.assertEqual(len(scans), 2)
+        self.cache.store('key-6', 'x' * 100)
+        self.assertEqual(len(scans), 3)
+
+    def test_directory_change_rescans(self):
+        self.cache.store('key', 'x' * 600)
+        self.cache.directory = self.path('other')
+        self.cache.store('key', 'x' * 600)
+        self.cache.directory = self.path('payloads')
+        self.cache.store('other-key', 'x' * 600)
+        self.assertEqual(len(self.list_payloads()), 1)
+
+    def test_disabled_by_default(self):
+        data = generate.dumps(generate.Generator(0).bundle(3000))
+        self.assertTrue(len(data) > cache.PAYLOAD_CACHE_MIN_SIZE)
+        filename = self.path('MP_001.toc')
+        with open(filename, 'wb') as f:
+            f.write(generate.encrypt(data))
+        self.assertEqual(sb.load(filename), sb.loads(data))
+        self.assertFalse(os.path.exists(cache.payload_cache.directory))
+        self.assertEqual(cache.get_payload_cache_stats()['stores'], 0)
+
+    def test_clear(self):
+        for idx in xrange(3):
+            self.cache.store('key-%d' % idx, 'x' * 100)
+        self.cache.clear()
+        self.assertEqual(self.list_payloads(), [])
+        self.cache.store('key', 'x' * 100)
+        self.assertEqual(len(self.list_payloads()), 1)
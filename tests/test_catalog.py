@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+
+from benchmarks import generate
+from libfb2.sb import CASCatalog, CASException, PackedDigests, \
+     rebuild_catalog
+from libfb2.types import SHA1
+from tests import TempDirTestCase
+
+
+class PackedDigestsTestCase(TempDirTestCase):
+
+    def test_find(self):
+        digests = sorted(generate.Generator(0).bytes(20)
+                         for _ in xrange(2000))
+        # neighbours that share a prefix and the edges of the table
+        digests = sorted(set(digests + ['\x00' * 20, '\xff' * 20,
+                                        '\x12\x34' + 'a' * 18,
+                                        '\x12\x34' + 'b' * 18]))
+        packed = PackedDigests(''.join(digests))
+        self.assertEqual(len(packed), len(digests))
+        for idx, digest in enumerate(digests):
+            self.assertEqual(packed.find(digest), idx)
+        self.assertEqual(packed.find('\x12\x34' + 'c' * 18), None)
+        self.assertEqual(packed.find('\x00' * 19 + '\x01'), None)
+
+    def test_unaligned_match(self):
+        digests = ['\x01' * 10 + '\x02' * 10, '\x02' * 10 + '\x03' * 10]
+        packed = PackedDigests(''.join(digests))
+        self.assertEqual(packed.find('\x02' * 20), None)
+        self.assertEqual(packed.find(digests[1]), 1)
+
+    def test_empty(self):
+        self.assertEqual(PackedDigests('').find('\x00' * 20), None)
+
+
+class CASCatalogTestCase(TempDirTestCase):
+
+    def test_get_file(self):
+        entries = generate.write_catalog(self.path('Data'), file_count=300)
+        cat = CASCatalog(self.path('Data', 'cas.cat'))
+        self.assertEqual(len(cat.files), 300)
+        for digest, size in entries:
+            for key in digest, digest.hex, digest.bytes:
+                self.assertEqual(cat.get_file(key).size, size)
+        self.assertEqual(cat.get_file(SHA1('\x00' * 20)), None)
+        self.assertEqual(cat.get_file('zz' * 20), None)
+        data = cat.get_file(entries[0][0]).get_raw_contents()
+        self.assertEqual(len(data), entries[0][1])
+
+    def test_rebuild(self):
+        generate.write_catalog(self.path('Data'), file_count=300)
+        filename = self.path('Data', 'cas.cat')
+        with open(filename, 'rb') as f:
+            original = f.read()
+        expected = list(CASCatalog(filename).files)
+
+        rv = rebuild_catalog(filename, use_processes=False)
+        self.assertEqual(rv['filename'], filename + '.rebuilt')
+        self.assertEqual(rv['entries'], 300)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), original)
+        self.assertRaises(CASException, rebuild_catalog, filename,
+                          use_processes=False)
+        rebuild_catalog(filename, use_processes=False, force=True)
+        self.assertTrue(os.path.isfile(filename + '.rebuilt.bak'))
+
+        os.remove(filename)
+        rebuild_catalog(filename, use_processes=False, output=filename)
+        self.assertEqual(list(CASCatalog(filename).files), expected)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+
+from benchmarks import generate
+from libfb2.cache import IndexCache
+from libfb2.columns import ColumnFile, IntColumn, write_columns, \
+     pack_ints, unpack_ints
+from libfb2.sb import CASCatalog, PackedDigests
+from tests import TempDirTestCase
+
+
+class ColumnFileTestCase(TempDirTestCase):
+
+    def test_roundtrip(self):
+        filename = self.path('test.fb2c')
+        values = range(-5000, 5000, 3)
+        write_columns(filename, [('ints', '<i8', pack_ints(values)),
+                                 ('small', '<i4', pack_ints(values, '<i')),
+                                 ('raw', 'S1', ['abc', 'def'])],
+                      meta='meta')
+        with ColumnFile(filename) as cf:
+            self.assertEqual(cf.meta, 'meta')
+            self.assertEqual(cf.column_names, ['ints', 'small', 'raw'])
+            self.assertEqual(cf.get_bytes('raw'), 'abcdef')
+            for name in 'ints', 'small':
+                column = cf.get_ints(name)
+                self.assertEqual(len(column), len(values))
+                self.assertEqual(list(column), values)
+                self.assertEqual(column[-1], values[-1])
+                self.assertRaises(IndexError, column.__getitem__,
+                                  len(values))
+
+    def test_long_names(self):
+        filename = self.path('test.fb2c')
+        self.assertRaises(ValueError, write_columns, filename,
+                          [('x' * 33, 'S1', '')])
+        self.assertRaises(ValueError, write_columns, filename,
+                          [('x', '<i4' * 3, '')])
+        self.assertFalse(os.path.exists(filename))
+        write_columns(filename, [('x' * 32, 'S1', 'abc')])
+        with ColumnFile(filename) as cf:
+            self.assertEqual(cf.get_bytes('x' * 32), 'abc')
+
+    def test_int_column_batches(self):
+        values = range(10000)
+        column = IntColumn(pack_ints(values, '<i'), 0, len(values) * 4, '<i')
+        self.assertEqual(list(column), values)
+        self.assertEqual(unpack_ints(pack_ints(values)), tuple(values))
+
+
+class CatalogIndexCacheTestCase(TempDirTestCase):
+
+    def test_cached_catalog(self):
+        generate.write_catalog(self.path('Data'), file_count=500)
+        index_cache = IndexCache(self.path('index'))
+        filename = self.path('Data', 'cas.cat')
+        fresh = CASCatalog(filename, index_cache=index_cache)
+        cached = CASCatalog(filename, index_cache=index_cache)
+        self.assertEqual(index_cache.hits, 1)
+        self.assertTrue(isinstance(cached.digests, PackedDigests))
+        self.assertTrue(isinstance(cached.offsets, IntColumn))
+        self.assertEqual(list(cached.digests), list(fresh.digests))
+        self.assertEqual(list(cached.offsets), list(fresh.offsets))
+        self.assertEqual(list(cached.sizes), list(fresh.sizes))
+        self.assertEqual(list(cached.cas_nums), list(fresh.cas_nums))
+        for key in list(fresh.files)[::7]:
+            self.assertEqual(cached.get_file(key).get_raw_contents(),
+                             fresh.get_file(key).get_raw_contents())
+        self.assertEqual(cached.get_file('00' * 20), None)
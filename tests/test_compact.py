@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from uuid import UUID
+
+from benchmarks import generate
+from libfb2 import sb
+from libfb2.types import SHA1, CompactSHA1, CompactUUID, Record
+from tests import TempDirTestCase
+
+
+def expand(value):
+    """Converts a tree decoded in compact mode into the regular form."""
+    if isinstance(value, CompactSHA1):
+        return SHA1(str.__str__(value))
+    if isinstance(value, CompactUUID):
+        return UUID(bytes=str.__str__(value))
+    if isinstance(value, (dict, Record)):
+        return dict((key, expand(value[key])) for key in value)
+    if isinstance(value, list):
+        return map(expand, value)
+    return value
+
+
+class CompactDecodingTestCase(TempDirTestCase):
+
+    def make_documents(self):
+        for seed in xrange(3):
+            gen = generate.Generator(seed)
+            yield generate.dumps(gen.bundle(30 * seed + 5,
+                                            blob_size=seed * 100))
+
+    def test_equal_to_full_decode(self):
+        for data in self.make_documents():
+            full = sb.loads(data)
+            compact = sb.loads(data, compact=True)
+            self.assertEqual(expand(compact), full)
+            self.assertTrue(isinstance(compact['ebx'][0], Record))
+            self.assertTrue(isinstance(compact['ebx'][0]['sha1'],
+                                       CompactSHA1))
+            self.assertEqual(compact['ebx'][0]['sha1'].hex,
+                             full['ebx'][0]['sha1'].hex)
+            self.assertEqual(str(compact['chunks'][0]['id']),
+                             str(full['chunks'][0]['id']))
+
+    def test_equal_from_files(self):
+        filename = self.path('bundle.sb')
+        for data in self.make_documents():
+            with open(filename, 'wb') as f:
+                f.write(data)
+            self.assertEqual(expand(sb.load(filename, compact=True)),
+                             sb.load(filename))
+
+    def test_bundle_files(self):
+        basename = self.path('Data', 'Win32', 'MP_001')
+        generate.write_superbundle(basename, bundle_count=3, ebx_count=20)
+        with sb.Bundle(basename) as bundle:
+            for bundle_file in bundle.iter_files():
+                full = bundle_file.get_parsed_contents(cache=False)
+                compact = bundle_file.get_parsed_contents(cache=False,
+                                                          compact=True)
+                self.assertEqual(expand(compact), full)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from benchmarks import generate
+from libfb2.diff import diff_catalogs
+from libfb2.sb import CASCatalog, LayeredCatalog
+from tests import TempDirTestCase
+
+
+class LayeredCatalogTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.game_entries = generate.write_catalog(
+            self.path('game'), file_count=200, seed=1)
+        self.patch_entries = generate.write_catalog(
+            self.path('patch'), file_count=20, seed=2)
+        for name, seed in ('MP_001', 1), ('MP_002', 2):
+            generate.write_superbundle(self.path('game', 'Win32', name),
+                                       bundle_count=2, ebx_count=4,
+                                       seed=seed)
+        generate.write_superbundle(self.path('patch', 'Win32', 'MP_001'),
+                                   bundle_count=1, ebx_count=4, seed=3)
+        self.game = CASCatalog(self.path('game', 'cas.cat'))
+        self.patch = CASCatalog(self.path('patch', 'cas.cat'))
+        self.cat = LayeredCatalog([self.patch, self.game])
+
+    def tearDown(self):
+        self.cat.close()
+        TempDirTestCase.tearDown(self)
+
+    def test_file_precedence(self):
+        self.assertEqual(len(self.cat.files), 220)
+        for digest, size in self.patch_entries:
+            self.assertEqual(self.cat.files[digest].cat, self.patch)
+        for digest, size in self.game_entries[:20]:
+            self.assertEqual(self.cat.files[digest].cat, self.game)
+
+    def test_asset_precedence(self):
+        assets = self.cat.find_assets('ebx/', kind='ebx')
+        by_superbundle = {}
+        for asset in assets:
+            by_superbundle.setdefault(asset.superbundle, []).append(asset)
+        self.assertEqual(sorted(by_superbundle),
+                         ['Win32/MP_001', 'Win32/MP_002'])
+        self.assertEqual(len(by_superbundle['Win32/MP_001']), 4)
+        self.assertEqual(len(by_superbundle['Win32/MP_002']), 8)
+        patch_assets = self.patch.find_assets('ebx/', kind='ebx')
+        self.assertEqual(by_superbundle['Win32/MP_001'], patch_assets)
+
+        index = self.cat.get_asset_index()
+        self.assertEqual(index.list_superbundles(),
+                         ['Win32/MP_001', 'Win32/MP_002'])
+        hidden = self.game.find_assets('ebx/', superbundle='Win32/MP_001')
+        self.assertEqual(index.find_by_sha1(hidden[0].sha1), [])
+        self.assertEqual(index.find_by_sha1(patch_assets[0].sha1),
+                         [patch_assets[0]])
+        self.assertEqual(index.get(patch_assets[0].name, kind='ebx'),
+                         [patch_assets[0]] +
+                         index.get(patch_assets[0].name,
+                                   superbundle='Win32/MP_002'))
+
+    def test_diff_assets(self):
+        changes = list(diff_catalogs(self.game, self.cat, assets=True))
+        added = [x for x in changes if x.status == 'added']
+        self.assertEqual(len(added), 20)
+        self.assertEqual(sorted(x.sha1.bytes for x in added),
+                         sorted(digest.bytes for digest, size in
+                                self.patch_entries))
+        for change in changes:
+            self.assertEqual(change.assets, [])
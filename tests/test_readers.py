@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from StringIO import StringIO
+from timeit import default_timer as timer
+
+from libfb2.utils import BufferedTypeReader, MMapTypeReader, TypeReader
+from tests import TempDirTestCase
+
+
+class ReaderTestCase(TempDirTestCase):
+
+    def make_readers(self, data, offset, limit):
+        fp = StringIO(data)
+        fp.seek(offset)
+        yield TypeReader(fp, limit)
+        fp = StringIO(data)
+        fp.seek(offset)
+        yield BufferedTypeReader(fp, limit, window=4)
+        yield MMapTypeReader(data, offset, limit)
+
+    def test_primitives(self):
+        data = 'xx' + '\x96\x01' + 'abc\x00' + '\x2a\x00\x00\x00' + 'rest'
+        for reader in self.make_readers(data, 2, len(data) - 2):
+            self.assertEqual(reader.read_varint(), 150)
+            self.assertEqual(reader.read_cstring(), 'abc')
+            self.assertEqual(reader.read_sst('i'), 42)
+            self.assertEqual(reader.read(), 'rest')
+            self.assertTrue(reader.eof)
+
+    def test_read_at_respects_limit(self):
+        data = '0123456789abcdef'
+        for reader in self.make_readers(data, 2, 6):
+            # inside the buffer and outside of it for the buffered reader
+            self.assertEqual(reader.read_at(4, 10), '67')
+            reader.read(1)
+            self.assertEqual(reader.read_at(4, 10), '67')
+            self.assertEqual(reader.read_at(6, 1), '')
+            self.assertEqual(reader.read(), '34567')
+
+    def test_read_pipe_to_end(self):
+        chunk = ''.join(chr(x) for x in xrange(256)) * 4096
+        count = 32
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            with os.fdopen(write_fd, 'wb') as f:
+                for _ in xrange(count):
+                    f.write(chunk)
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            with os.fdopen(read_fd, 'rb') as f:
+                reader = BufferedTypeReader(f)
+                self.assertEqual(reader.limit, None)
+                self.assertEqual(reader.read(3), chunk[:3])
+                start = timer()
+                data = reader.read()
+                seconds = timer() - start
+                self.assertTrue(reader.eof)
+                self.assertEqual(reader.read(), '')
+        finally:
+            thread.join()
+        self.assertEqual(len(data), len(chunk) * count - 3)
+        self.assertEqual(data[-len(chunk):], chunk)
+        # growing the buffer per window took seconds for 32MB
+        self.assertTrue(seconds < 2, seconds)
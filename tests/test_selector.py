@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+from StringIO import StringIO
+
+from benchmarks import generate
+from libfb2 import sb
+from libfb2.selector import SelectorException, compile_selector
+from libfb2.stats import collect_stats
+from libfb2.types import Blob
+from libfb2.utils import TypeReader
+
+
+class SelectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = generate.dumps(generate.Generator(0).bundle(40))
+        self.doc = sb.loads(self.data)
+
+    def select(self, selector):
+        rv = list(sb.iterloads(self.data, selector))
+        compact = list(sb.iterloads(self.data, selector, compact=True))
+        self.assertEqual(len(rv), len(compact))
+        return rv
+
+    def test_paths(self):
+        self.assertEqual(self.select('ebx.*'), self.doc['ebx'])
+        self.assertEqual(self.select('ebx.*.name'),
+                         [x['name'] for x in self.doc['ebx']])
+        self.assertEqual(self.select('res.3'), [self.doc['res'][3]])
+        # values come in document order
+        self.assertEqual(sorted(self.select('path, ebx.0.size')),
+                         sorted([self.doc['path'],
+                                 self.doc['ebx'][0]['size']]))
+
+    def test_predicates(self):
+        ebx = self.doc['ebx']
+        prefix = 'ebx/weapons/'
+        expected = [x for x in ebx if x['name'].startswith(prefix)]
+        self.assertTrue(expected)
+        for selector in ('ebx.*[name^=%s]', 'ebx.*[name ^= %s]',
+                         'ebx.*[ name^= \'%s\' ]', 'ebx.*[name^="%s"]'):
+            self.assertEqual(self.select(selector % prefix), expected)
+        self.assertEqual(self.select('ebx.*[name!=%s]' % ebx[0]['name']),
+                         ebx[1:])
+        self.assertEqual(self.select('ebx.*[name$=%s]' % ebx[5]['name'][-6:]),
+                         [ebx[5]])
+        self.assertEqual(self.select('ebx.*[name*=weapons][size=%d].name' %
+                                     expected[0]['size']),
+                         [expected[0]['name']])
+        digest = ebx[7]['sha1'].hex
+        self.assertEqual(self.select('ebx.*[sha1 = %s]' % digest), [ebx[7]])
+        self.assertEqual(self.select('ebx.*[name=\' %s\']' % ebx[0]['name']),
+                         [])
+
+    def test_invalid(self):
+        for selector in ('ebx.*[name]', 'ebx.*[name^=foo', '**[name=x]',
+                         'ebx.*[name=\'foo]'):
+            self.assertRaises(SelectorException, compile_selector, selector)
+
+    def test_skips_by_size(self):
+        doc = {'a': [{'name': 'x' * 10, 'size': idx} for idx in xrange(500)],
+               'b': Blob('x' * 10000), 'c': 42}
+        data = generate.dumps(doc)
+        self.assertEqual(list(sb.iterloads(data, 'c')), [42])
+        with collect_stats() as stats:
+            reader = TypeReader(StringIO(data))
+            reader.name = 'doc'
+            parser = sb.SBParser(reader)
+            self.assertEqual(list(parser.iterparse('c')), [42])
+        # typecodes, keys, size prefixes and the terminators only
+        self.assertTrue(stats.to_dict()['readers']['doc']['reads'] < 40)
+
+    def test_invalid_size(self):
+        data = generate.dumps({'a': [1, 2, 3], 'c': 42})
+        # the list's size prefix follows the typecode and key
+        pos = data.index('a\x00') + 2
+        data = data[:pos] + chr(ord(data[pos]) + 1) + data[pos + 1:]
+        self.assertRaises(sb.SBException, list, sb.iterloads(data, 'c'))
+        parser = sb.SBParser(TypeReader(StringIO(data)))
+        self.assertRaises(sb.SBException, list, parser.iterparse('c'))
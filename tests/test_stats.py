@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+from StringIO import StringIO
+
+from benchmarks import generate
+from libfb2 import sb
+from libfb2.stats import collect_stats
+from libfb2.utils import BufferedTypeReader, TypeReader
+from tests import TempDirTestCase
+
+
+class StatsTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.basename = self.path('Data', 'Win32', 'MP_001')
+        generate.write_superbundle(self.basename, bundle_count=3,
+                                   ebx_count=10)
+
+    def test_bytes_per_file(self):
+        filename = self.basename + '.toc'
+        with collect_stats() as stats:
+            sb.load(filename)
+        counters = stats.to_dict()['readers']
+        self.assertEqual(counters.keys(), [filename])
+        self.assertEqual(counters[filename]['bytes'],
+                         os.path.getsize(filename))
+
+    def test_bytes_per_bundle_file(self):
+        with sb.Bundle(self.basename) as bundle:
+            files = bundle.list_files()
+            with collect_stats() as stats:
+                for bundle_file in files:
+                    bundle_file.get_parsed_contents(cache=False,
+                                                    compact=True)
+                files[0].get_raw_contents()
+        counters = stats.to_dict()['readers']
+        sb_filename = self.basename + '.sb'
+        self.assertEqual(sorted(counters),
+                         sorted([sb_filename] + [repr(x) for x in files]))
+        for bundle_file in files:
+            self.assertEqual(counters[repr(bundle_file)]['bytes'],
+                             bundle_file.size * (bundle_file is files[0]
+                                                 and 2 or 1))
+            self.assertEqual(counters[repr(bundle_file)]['reads'], 0)
+        # every bundle file is fetched with a single pread
+        self.assertEqual(counters[sb_filename]['reads'], len(files) + 1)
+        self.assertEqual(counters[sb_filename]['read_bytes'],
+                         sum(x.size for x in files) + files[0].size)
+        self.assertEqual(counters[sb_filename]['bytes'], 0)
+
+    def test_read_calls(self):
+        data = 'x' * 100
+        with collect_stats() as stats:
+            reader = BufferedTypeReader(StringIO(data), window=16)
+            reader.name = 'buffered'
+            for _ in xrange(10):
+                reader.read(10)
+            reader.close()
+            reader = TypeReader(StringIO(data))
+            reader.name = 'unbuffered'
+            for _ in xrange(10):
+                reader.read(10)
+            reader.close()
+        counters = stats.to_dict()['readers']
+        self.assertEqual(counters['buffered'],
+                         {'reads': 7, 'read_bytes': 100, 'bytes': 100})
+        self.assertEqual(counters['unbuffered'],
+                         {'reads': 10, 'read_bytes': 100, 'bytes': 100})